@@ -0,0 +1,137 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from browser import is_lazy
+
+
+class PageArchive:
+    """
+    Append-only archive of the raw pages fetched by a scraper, so the outputs can be extracted again
+    (reextract.py) without going back to the site.
+    Every page is a WARC-like record (WARC headers + html) compressed alone as one zstd frame and appended to
+    a segment file of the archive folder, one segment per process and run. An sqlite index gives the segment,
+    offset and length of each record by url and fetch time.
+    """
+    def __init__(self, path, level=10):
+        import zstandard
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.segment = "pages-%s-%s-%d.warc.zst" % (time.strftime('%Y%m%d%H%M%S'), socket.gethostname(), os.getpid())
+        self.output = open(os.path.join(path, self.segment), 'ab')
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.connection = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA busy_timeout=30000")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+            url TEXT NOT NULL, fetched_at REAL NOT NULL, kind TEXT NOT NULL, section TEXT, statut TEXT,
+            segment TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS pages_url ON pages (url, fetched_at)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS pages_section ON pages (kind, section)")
+        self.connection.commit()
+
+    def add_page(self, url, page_source, kind='detail', section=None, statut=None):
+        """Appends one fetched page (str or bytes) to the archive."""
+        if isinstance(page_source, str):
+            page_source = page_source.encode('utf-8')
+        fetched_at = time.time()
+        headers = [('WARC-Type', 'response'), ('WARC-Record-ID', '<urn:uuid:%s>' % uuid.uuid4()),
+                   ('WARC-Date', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(fetched_at))),
+                   ('WARC-Target-URI', url), ('Content-Type', 'text/html; charset=utf-8'),
+                   ('Content-Length', str(len(page_source))), ('X-Page-Kind', kind)]
+        if section is not None:
+            headers.append(('X-Section', section))
+        if statut is not None:
+            headers.append(('X-Statut', statut))
+        record = ("WARC/1.0\r\n" + "".join("%s: %s\r\n" % header for header in headers) + "\r\n").encode('utf-8')
+        frame = self.compressor.compress(record + page_source + b"\r\n\r\n")
+        with self.lock:
+            offset = self.output.tell()
+            self.output.write(frame)
+            self.output.flush()
+            self.connection.execute("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (url, fetched_at, kind, section, statut, self.segment, offset, len(frame)))
+            self.connection.commit()
+        self.local.added = True
+
+    def track(self, section, scrape_state):
+        """
+        Wraps scrape_state(driver, property_details_dic) to archive the detail page it leaves in the browser.
+        Engines that download the page themselves (http) call add_detail_page and the browser is left alone.
+        """
+        def scrape_and_archive(driver, property_details_dic):
+            link = property_details_dic['link']
+            self.local.added = False
+            self.local.section = section
+            self.local.statut = property_details_dic.get('statut')
+            try:
+                return scrape_state(driver, property_details_dic)
+            finally:
+                # pages that failed to extract are kept too, they are the ones a fixed parser needs
+                if not self.local.added and not (is_lazy(driver) and driver.driver is None):
+                    try:
+                        page_source = driver.page_source
+                    except Exception:
+                        page_source = None
+                    if page_source is not None:
+                        self.add_page(link, page_source, 'detail', section, self.local.statut)
+        return scrape_and_archive
+
+    def add_detail_page(self, url, page_source):
+        """add_page for an engine running inside track(), the section and statut come from the state being scraped."""
+        self.add_page(url, page_source, 'detail', getattr(self.local, 'section', None), getattr(self.local, 'statut', None))
+
+    def close(self):
+        with self.lock:
+            self.output.close()
+            self.connection.close()
+
+
+def archived_pages(path, kind='detail', latest=True):
+    """
+    This function responsible for listing the index rows (dictionaries) of the pages of a kind in the archive at path,
+    ordered by section and first fetch. With latest only the last fetch of every url is returned.
+    """
+    connection = sqlite3.connect(os.path.join(path, 'index.db'))
+    try:
+        if latest:
+            cursor = connection.execute(
+                "SELECT url, fetched_at, kind, section, statut, segment, offset, length FROM pages "
+                "JOIN (SELECT MAX(rowid) AS last_rowid, MIN(rowid) AS first_rowid FROM pages WHERE kind = ? GROUP BY url) "
+                "ON pages.rowid = last_rowid ORDER BY section, first_rowid", (kind,))
+        else:
+            cursor = connection.execute(
+                "SELECT url, fetched_at, kind, section, statut, segment, offset, length FROM pages "
+                "WHERE kind = ? ORDER BY section, rowid", (kind,))
+        columns = ['url', 'fetched_at', 'kind', 'section', 'statut', 'segment', 'offset', 'length']
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+# decompressor and open segments of the current process, reused by every read_page call
+readers = threading.local()
+
+
+def read_page(path, segment, offset, length):
+    """
+    This function responsible for reading one record of an archive, returns its WARC headers (dictionary)
+    and the page (bytes).
+    """
+    import zstandard
+    if getattr(readers, 'decompressor', None) is None:
+        readers.decompressor = zstandard.ZstdDecompressor()
+        readers.segments = {}
+    segment_path = os.path.join(path, segment)
+    if segment_path not in readers.segments:
+        readers.segments[segment_path] = open(segment_path, 'rb')
+    source = readers.segments[segment_path]
+    source.seek(offset)
+    record = readers.decompressor.decompress(source.read(length))
+    head, body = record.split(b"\r\n\r\n", 1)
+    headers = dict(line.split(": ", 1) for line in head.decode('utf-8').split("\r\n")[1:])
+    return headers, body[:int(headers['Content-Length'])]
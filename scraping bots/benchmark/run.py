@@ -0,0 +1,136 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRAPERS_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, SCRAPERS_DIR)
+from metrics import read_rss, children_pids
+from server import Corpus, serve_corpus
+
+# detail engines of every scraper, and the sections each one walks
+ENGINES = {'properstar': ['selenium', 'js', 'http'], 'remax': ['selenium', 'js']}
+SECTIONS = {'properstar': 4, 'remax': 2}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def watch_memory(pid, peak, stop, every=0.1):
+    """Keeps in peak['rss'] the highest resident memory of the scraper and its drivers and browsers together."""
+    while not stop.is_set():
+        pids = [pid] + children_pids(pid) if os.path.isdir('/proc') else []
+        peak['rss'] = max(peak['rss'], sum(read_rss(process) or 0 for process in pids))
+        stop.wait(every)
+
+
+def run_engine(site, engine, server, corpus, args):
+    """
+    This function responsible for running one scraper with one detail engine against the local corpus,
+    in a scratch folder, and returning what it measured.
+    """
+    base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as scratch:
+        command = [sys.executable, os.path.join(SCRAPERS_DIR, site + '.py'), '--base-url', base_url, '--engine', engine,
+                   '--workers', str(args.workers), '--browser', args.browser,
+                   '--frontier', os.path.join(scratch, 'frontier.db'),
+                   '--dead-letter', os.path.join(scratch, 'dead_letter.jsonl'),
+                   '--metrics-dir', scratch, '--output-format', 'csv',
+                   # the local server is not the site, nothing to be polite about
+                   '--rate', '1000', '--max-rate', '1000']
+        if args.lean:
+            command.append('--lean')
+        if site == 'properstar':
+            command.extend(['--discovery', args.discovery])
+        peak = {'rss': 0}
+        stop = threading.Event()
+        requests_before = server.requests
+        start = time.perf_counter()
+        with open(os.path.join(scratch, 'output.log'), 'w') as log:
+            process = subprocess.Popen(command, cwd=scratch, stdout=log, stderr=subprocess.STDOUT)
+            watcher = threading.Thread(target=watch_memory, args=(process.pid, peak, stop), daemon=True)
+            watcher.start()
+            returncode = process.wait()
+        seconds = time.perf_counter() - start
+        stop.set()
+        watcher.join()
+        latencies = []
+        errors = 0
+        metrics_path = os.path.join(scratch, site + '_metrics.jsonl')
+        if os.path.exists(metrics_path):
+            with open(metrics_path, encoding='utf-8') as source:
+                for line in source:
+                    entry = json.loads(line)
+                    if entry['event'] == 'state':
+                        latencies.append(entry['seconds'])
+                        errors = errors + (entry['error'] is not None)
+        if returncode != 0:
+            with open(os.path.join(scratch, 'output.log')) as log:
+                print(log.read()[-2000:])
+        states = len(latencies) - errors
+        return {'site': site, 'engine': engine, 'returncode': returncode, 'expected_states': corpus.states() * SECTIONS[site],
+                'states': states, 'errors': errors, 'seconds': round(seconds, 2),
+                'pages_per_second': round(states / seconds, 2) if seconds else None,
+                # throughput of the detail pages alone, without the listing discovery
+                'detail_pages_per_second': round(states * args.workers / sum(latencies), 2) if latencies else None,
+                'latency_p50_ms': round(percentile(latencies, 0.5) * 1000) if latencies else None,
+                'latency_p90_ms': round(percentile(latencies, 0.9) * 1000) if latencies else None,
+                'latency_p99_ms': round(percentile(latencies, 0.99) * 1000) if latencies else None,
+                'peak_rss_mb': round(peak['rss'] / 1e6, 1) if peak['rss'] else None,
+                'requests': server.requests - requests_before}
+
+
+def print_table(results):
+    columns = ['site', 'engine', 'states', 'errors', 'seconds', 'pages_per_second', 'detail_pages_per_second',
+               'latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms', 'peak_rss_mb', 'requests']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the scrapers against a local copy of both sites and compare their detail engines")
+    parser.add_argument("--sites", default="properstar,remax", help="scrapers to run, separated by commas")
+    parser.add_argument("--engines", default="selenium,js,http",
+                        help="detail engines to compare, separated by commas (each scraper runs the ones it has)")
+    parser.add_argument("--pages", type=int, default=3, help="listing pages of every section")
+    parser.add_argument("--per-page", type=int, default=10, help="states of every listing page")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus, the same seed serves the same pages")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--browser", choices=['firefox', 'chrome'], default='firefox')
+    parser.add_argument("--lean", action="store_true")
+    parser.add_argument("--discovery", choices=['selenium', 'async', 'sitemap'], default='selenium', help="listing discovery of properstar")
+    parser.add_argument("--output", help="json file receiving the results and the machine they were measured on")
+    args = parser.parse_args()
+    corpus = Corpus(args.pages, args.per_page, args.seed)
+    server = serve_corpus(corpus)
+    print("serving the corpus on http://127.0.0.1:%d" % server.server_address[1])
+    results = []
+    for site in args.sites.split(","):
+        for engine in args.engines.split(","):
+            if engine not in ENGINES[site]:
+                continue
+            if engine == 'http' and importlib.util.find_spec('lxml') is None:
+                print("skipping ", site, " ", engine, ": lxml is not installed")
+                continue
+            print("running ", site, " with the ", engine, " engine")
+            results.append(run_engine(site, engine, server, corpus, args))
+    server.shutdown()
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'machine': platform.platform(), 'cpus': os.cpu_count(), 'corpus': vars(args),
+                       'results': results}, output, indent=2)
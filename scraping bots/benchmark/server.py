@@ -0,0 +1,210 @@
+import argparse
+import gzip
+import html
+import json
+import os
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# the listing paths of properstar.py, served under the same names
+PROPERSTAR_SECTIONS = {'/tunisie/louer/commercial': ('Location', 'Local commercial'),
+                       '/tunisie/acheter/commercial': ('Vente', 'Local commercial'),
+                       '/tunisie/louer/appartement-maison': ('Location', 'Appartement'),
+                       '/tunisie/acheter/appartement-maison': ('Vente', 'Maison')}
+# transaction types of the remax.py gallery links
+REMAX_SECTIONS = {'260': 'A Louer', '261': 'A Vendre'}
+CITIES = ['Tunis, La Marsa', 'Tunis, Carthage', 'Ariana, Ennasr', 'Sousse, Khezama', 'Nabeul, Hammamet',
+          'Monastir, Skanes', 'Sfax, Route de Tunis', 'Ben Arous, Ezzahra', 'Bizerte, Corniche', 'Tunis, Lac 2']
+AMENITIES = ['Climatisation', 'Chauffage central', 'Ascenseur', 'Parking', 'Piscine', 'Jardin', 'Terrasse',
+             'Cuisine équipée', 'Vue sur mer', 'Balcon', 'Gardiennage', 'Meublé']
+WORDS = ('lumineux spacieux proche commodités transport écoles calme résidence sécurisée standing vue dégagée '
+         'rénové récemment quartier recherché double vitrage placards').split()
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as source:
+        return Template(source.read())
+
+
+class Corpus:
+    """
+    Pages of both sites built from the fixtures: `pages` listing pages of `per_page` states for every section,
+    and the detail page of each state. The content only depends on the seed, so every run sees the same pages.
+    About one detail page in ten has a layout gap (a missing row, a feature without value) like the real sites.
+    """
+    def __init__(self, pages=3, per_page=10, seed=0):
+        self.pages = pages
+        self.per_page = per_page
+        self.seed = seed
+        self.templates = {name: load_fixture(name + '.html') for name in
+                          ('properstar_listing', 'properstar_detail', 'remax_gallery', 'remax_detail')}
+
+    def states(self):
+        return self.pages * self.per_page
+
+    def random(self, *key):
+        return random.Random('%s/%s' % (self.seed, '/'.join(str(part) for part in key)))
+
+    def description(self, rng):
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+
+    def properstar_listing(self, path, page):
+        statut, kind = PROPERSTAR_SECTIONS[path]
+        cards = []
+        if 1 <= page <= self.pages:
+            for index in range((page - 1) * self.per_page, page * self.per_page):
+                link = '/fr/annonce%s/%d' % (path, index)
+                cards.append('<article class="item-adaptive card-basic vendor-hidden"><div class="card-image">'
+                             '<img src="/static/photo.jpg" alt=""></div><div class="card-content">'
+                             '<a class="link" href="%s">%s %s %d</a></div></article>' % (link, kind, statut, index))
+        pager = " ".join('<a href="%s?p=%d">%d</a>' % (path, number, number) for number in range(1, self.pages + 1))
+        return self.templates['properstar_listing'].safe_substitute(
+            title=html.escape(kind + ' - ' + statut), count=self.states(), cards="\n".join(cards), pager=pager)
+
+    def properstar_detail(self, path, index):
+        statut, kind = PROPERSTAR_SECTIONS[path]
+        rng = self.random('properstar', path, index)
+        features = [('Surface habitable', '%d m²' % rng.randint(40, 400)), ('Pièces', str(rng.randint(1, 8))),
+                    ('Chambres', str(rng.randint(1, 5))), ('Salles de bains', str(rng.randint(1, 3))),
+                    ('Étage', str(rng.randint(0, 9))), ('Année de construction', str(rng.randint(1970, 2024)))]
+        rows = ['<div class="feature-content"><span class="property-key">%s</span>'
+                '<span class="property-value">%s</span></div>' % (html.escape(key), html.escape(value))
+                for key, value in features[:rng.randint(3, len(features))]]
+        rows.extend('<div class="feature-content"><span class="property-value">%s</span></div>' % html.escape(amenity)
+                    for amenity in rng.sample(AMENITIES, rng.randint(0, 6)))
+        if rng.random() < 0.1:
+            rows.append('<div class="feature-content"><span class="property-key">Charges</span></div>')
+        price = rng.randint(300, 5000) if statut == 'Location' else rng.randint(80, 2000) * 1000
+        return self.templates['properstar_detail'].safe_substitute(
+            title=html.escape('%s %s %d' % (kind, statut, index)), address=html.escape(rng.choice(CITIES)),
+            price='{:,} TND'.format(price).replace(',', ' '), features="\n".join(rows),
+            description=self.description(rng))
+
+    def properstar_sitemap(self, host):
+        """Sitemap index of the properstar listings, one gzipped url set per section."""
+        entries = "\n".join('<sitemap><loc>http://%s/sitemap-annonces-%d.xml.gz</loc></sitemap>' % (host, number)
+                            for number in range(1, len(PROPERSTAR_SECTIONS) + 1))
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+                '%s\n</sitemapindex>' % entries)
+
+    def properstar_sitemap_section(self, host, number):
+        path = list(PROPERSTAR_SECTIONS)[number - 1]
+        entries = "\n".join('<url><loc>http://%s/fr/annonce%s/%d</loc></url>' % (host, path, index)
+                            for index in range(self.states()))
+        return gzip.compress(('<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+                              '%s\n</urlset>' % entries).encode('utf-8'))
+
+    def remax_cards(self, tt):
+        cards = []
+        for index in range(self.states()):
+            rng = self.random('remax', tt, index)
+            price = rng.randint(300, 5000) if tt == '260' else rng.randint(80, 2000) * 1000
+            cards.append({'id': '%s-%d' % (tt, index), 'statut': REMAX_SECTIONS[tt],
+                          'price': '{:,} TND'.format(price).replace(',', ' '), 'title': 'Bien %s %d' % (tt, index)})
+        return cards
+
+    def remax_gallery(self):
+        listings = {tt: self.remax_cards(tt) for tt in REMAX_SECTIONS}
+        return self.templates['remax_gallery'].safe_substitute(
+            listings=json.dumps(listings, ensure_ascii=False), per_page=self.per_page)
+
+    def remax_detail(self, listing_id):
+        tt, index = listing_id.split('-')
+        rng = self.random('remax', tt, int(index))
+        card = self.remax_cards(tt)[int(index)]
+        icons = [('Chambres', str(rng.randint(1, 5))), ('Salles de bains', str(rng.randint(1, 3))),
+                 ('Surface habitable', '%d m²' % rng.randint(40, 400))]
+        no_icons = [('Surface terrain', '%d m²' % rng.randint(100, 1000)), ('Année de construction', str(rng.randint(1970, 2024))),
+                    ('Étage', str(rng.randint(0, 9))), ('Nombre de pièces', str(rng.randint(1, 8)))]
+        rows = ['<div class="attributes-data-row">' + "".join(
+            '<div class="attributes-icons attributes-data-col"><span>%s</span><span>%s</span></div>' % pair
+            for pair in icons) + '</div>']
+        # some listings only have the first row
+        if rng.random() >= 0.1:
+            rows.append('<div class="attributes-data-row">' + "".join(
+                '<div class="attributes-no-icons attributes-data-col"><span>%s</span><span>%s</span></div>' % pair
+                for pair in no_icons) + '</div>')
+        caracteristiques = "\n".join('<div class="col-xs-6 col-sm-4 col-md-3 fts-mark"><span>%s</span></div>' % amenity
+                                     for amenity in rng.sample(AMENITIES, rng.randint(0, 6)))
+        return self.templates['remax_detail'].safe_substitute(
+            title=html.escape(card['title']), price=card['price'], address=html.escape(rng.choice(CITIES)),
+            status='Disponible', attribute_rows="\n".join(rows), caracteristiques=caracteristiques,
+            description=self.description(rng))
+
+
+def serve_corpus(corpus, host='127.0.0.1', port=0):
+    """
+    This function responsible for serving the corpus on host:port (0 picks a free port) from a background thread.
+    Returns the running server, server.requests counts the pages served.
+    """
+    class CorpusHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            page_source = None
+            content_type = 'text/html; charset=utf-8'
+            sitemap = re.match(r'/sitemap-annonces-(\d+)\.xml\.gz$', url.path)
+            if url.path == '/sitemap.xml':
+                page_source = corpus.properstar_sitemap(self.headers.get('Host'))
+                content_type = 'application/xml'
+            elif sitemap and 1 <= int(sitemap.group(1)) <= len(PROPERSTAR_SECTIONS):
+                # served as a gzip file, not with a Content-Encoding, like the .xml.gz sitemaps of the sites
+                page_source = corpus.properstar_sitemap_section(self.headers.get('Host'), int(sitemap.group(1)))
+                content_type = 'application/x-gzip'
+            elif url.path in PROPERSTAR_SECTIONS:
+                page = query.get('p', ['1'])[0]
+                page_source = corpus.properstar_listing(url.path, int(page) if page.isdigit() else 1)
+            elif url.path.startswith('/fr/annonce/'):
+                match = re.match(r'/fr/annonce(/.+)/(\d+)$', url.path)
+                if match and match.group(1) in PROPERSTAR_SECTIONS and int(match.group(2)) < corpus.states():
+                    page_source = corpus.properstar_detail(match.group(1), int(match.group(2)))
+            elif url.path == '/PublicListingList.aspx':
+                page_source = corpus.remax_gallery()
+            elif url.path == '/PublicListing.aspx':
+                listing_id = query.get('id', [''])[0]
+                if re.match(r'(260|261)-\d+$', listing_id) and int(listing_id.split('-')[1]) < corpus.states():
+                    page_source = corpus.remax_detail(listing_id)
+            with lock:
+                server.requests = server.requests + 1
+            if page_source is None:
+                self.send_error(404)
+                return
+            body = page_source if isinstance(page_source, bytes) else page_source.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    lock = threading.Lock()
+    server = ThreadingHTTPServer((host, port), CorpusHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, name="corpus", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the benchmark corpus of both sites, e.g. to run a scraper by hand with --base-url")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--pages", type=int, default=3, help="listing pages of every section")
+    parser.add_argument("--per-page", type=int, default=10, help="states of every listing page")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = serve_corpus(Corpus(args.pages, args.per_page, args.seed), port=args.port)
+    print("serving the benchmark corpus on http://127.0.0.1:%d" % server.server_address[1])
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,362 @@
+import atexit
+import base64
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from selenium import webdriver
+from selenium.webdriver.firefox.service import Service
+from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.chrome.service import Service as ChromeService
+from selenium.webdriver.chrome.options import Options as ChromeOptions
+from metrics import read_rss, children_pids
+
+# driver binary of every browser, resolved once and shared by every browser of the run
+driver_paths = {}
+driver_paths_lock = threading.Lock()
+# where the resolved paths are kept between runs, so a run starts without the network
+DRIVER_CACHE = os.getenv("SCRAPER_DRIVER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "scraper_drivers.json"))
+DRIVERS = {'firefox': ('GECKODRIVER_PATH', 'geckodriver'), 'chrome': ('CHROMEDRIVER_PATH', 'chromedriver')}
+# lifecycle of the browsers, changed with configure(): a browser is replaced after max_pages pages or once
+# its processes use more than max_rss_mb (checked every rss_every pages), 0 never replaces it
+settings = {'max_pages': 0, 'max_rss_mb': 0, 'rss_every': 20}
+lifecycle = {'started': 0, 'recycled': 0, 'warm': 0}
+lifecycle_lock = threading.Lock()
+
+# what the lean profile never downloads in chrome (firefox does it with preferences)
+BLOCKED_URL_PATTERNS = ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico',
+                        '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot', '*.mp4', '*.webm', '*.mp3']
+
+
+def lean_pac(allowed_hosts):
+    """
+    Proxy auto-config script sending every host outside allowed_hosts (and their subdomains)
+    to a closed local port, which blocks third-party requests in both browsers.
+    """
+    checks = " || ".join('host == "%s" || dnsDomainIs(host, ".%s")' % (host, host) for host in allowed_hosts)
+    return 'function FindProxyForURL(url, host) { if (%s) return "DIRECT"; return "PROXY 127.0.0.1:9"; }' % (checks or 'true')
+
+
+def new_firefox_driver(lean=False, allowed_hosts=()):
+    """
+    This function responsible for starting a headless Firefox with the options used by the scrapers.
+    The lean profile loads pages eagerly and skips images, media, web fonts, the disk cache, trackers
+    and every host outside allowed_hosts.
+    """
+    options = Options()
+    options.headless = True  # Run in headless mode (no browser UI)
+    options.add_argument("--disable-gpu")  # Disable GPU (fixes some headless issues)
+    options.add_argument("--no-sandbox")  # Avoid sandboxing issues
+    options.add_argument("--disable-dev-shm-usage")  # Improve performance in Docker/Linux
+    if lean:
+        options.page_load_strategy = 'eager'  # driver.get returns at DOMContentLoaded
+        options.set_preference("permissions.default.image", 2)
+        options.set_preference("media.autoplay.default", 5)
+        options.set_preference("media.preload.default", 0)
+        options.set_preference("browser.display.use_document_fonts", 0)
+        options.set_preference("gfx.downloadable_fonts.enabled", False)
+        options.set_preference("browser.cache.disk.enable", False)
+        options.set_preference("browser.cache.offline.enable", False)
+        options.set_preference("network.prefetch-next", False)
+        options.set_preference("network.dns.disablePrefetch", True)
+        options.set_preference("privacy.trackingprotection.enabled", True)
+        if allowed_hosts:
+            options.set_preference("network.proxy.type", 2)
+            options.set_preference("network.proxy.autoconfig_url",
+                                   "data:application/x-ns-proxy-autoconfig," + quote(lean_pac(allowed_hosts)))
+    service = Service(driver_path('firefox'))
+    return webdriver.Firefox(service=service, options=options)
+
+
+def new_chrome_driver(lean=False, allowed_hosts=()):
+    """
+    This function responsible for starting a headless Chrome (driver from CHROMEDRIVER_PATH), with the same lean profile.
+    """
+    options = ChromeOptions()
+    options.add_argument("--headless")  # Run Chrome in headless mode
+    options.add_argument("--disable-gpu")  # Disable GPU acceleration (recommended for headless mode)
+    options.add_argument("--no-sandbox")  # Helps avoid permission issues
+    options.add_argument("--disable-dev-shm-usage")  # Useful for Docker environments
+    if lean:
+        options.page_load_strategy = 'eager'
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--autoplay-policy=user-gesture-required")
+        options.add_argument("--mute-audio")
+        options.add_argument("--disk-cache-size=1")
+        options.add_argument("--disable-background-networking")
+        options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+        if allowed_hosts:
+            pac = base64.b64encode(lean_pac(allowed_hosts).encode()).decode()
+            options.add_argument("--proxy-pac-url=data:application/x-javascript-config;base64," + pac)
+    service = ChromeService(executable_path=driver_path('chrome'))
+    driver = webdriver.Chrome(service=service, options=options)
+    if lean:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+    return driver
+
+
+def driver_path(browser='firefox'):
+    """
+    This function responsible for finding the driver binary of a browser without going to the network when it can:
+    GECKODRIVER_PATH / CHROMEDRIVER_PATH, then the path cached by an earlier run, then the PATH. Only geckodriver
+    is ever downloaded (webdriver_manager), once, and its path is cached for the next runs.
+    None lets selenium find the chrome driver itself.
+    """
+    with driver_paths_lock:
+        if browser in driver_paths:
+            return driver_paths[browser]
+        variable, binary = DRIVERS[browser]
+        cached = {}
+        if os.path.exists(DRIVER_CACHE):
+            try:
+                with open(DRIVER_CACHE) as source:
+                    cached = json.load(source)
+            except ValueError:
+                cached = {}
+        for path in (os.getenv(variable), cached.get(browser), shutil.which(binary)):
+            if path and os.path.isfile(path) and os.access(path, os.X_OK):
+                break
+        else:
+            path = None
+            if browser == 'firefox':
+                from webdriver_manager.firefox import GeckoDriverManager
+                path = GeckoDriverManager().install()
+        if path and cached.get(browser) != path:
+            cached[browser] = path
+            os.makedirs(os.path.dirname(DRIVER_CACHE), exist_ok=True)
+            with open(DRIVER_CACHE + '.tmp', 'w') as output:
+                json.dump(cached, output, indent=2)
+            os.replace(DRIVER_CACHE + '.tmp', DRIVER_CACHE)
+        driver_paths[browser] = path
+        return path
+
+
+def configure(**values):
+    """Changes the lifecycle settings (max_pages, max_rss_mb, rss_every) of the browsers started from now on."""
+    unknown = set(values) - set(settings)
+    if unknown:
+        raise ValueError("unknown browser settings: " + ", ".join(sorted(unknown)))
+    settings.update(values)
+
+
+def count(event):
+    with lifecycle_lock:
+        lifecycle[event] = lifecycle[event] + 1
+
+
+class WarmDrivers:
+    """
+    Same interface as the function returned by new_driver_factory, keeps one browser started in the background
+    so a new or recycled browser is ready at once instead of after a few seconds of startup.
+    The spare is only started with the first browser asked for, a run that never opens one (http engine) starts none.
+    The spare browser left at the end of the run is closed with the process.
+    """
+    def __init__(self, new_driver):
+        self.new_driver = new_driver
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm-browser")
+        self.spare = None
+        atexit.register(self.close)
+
+    def __call__(self):
+        with self.lock:
+            spare = self.spare
+            self.spare = self.executor.submit(self.new_driver)
+        if spare is not None:
+            try:
+                driver = spare.result()
+                count('warm')
+                return driver
+            except Exception as error:
+                print("the warm browser failed to start (", repr(error), "), starting one now")
+        return self.new_driver()
+
+    def close(self):
+        with self.lock:
+            spare = self.spare
+            self.spare = None
+        self.executor.shutdown(wait=True)
+        if spare is not None and spare.exception() is None:
+            spare.result().quit()
+
+
+def new_driver_factory(browser='firefox', lean=False, allowed_hosts=(), warm=False):
+    """
+    This function responsible for returning the function that starts the browsers of a run,
+    with warm a browser is always kept ready for the next call (see WarmDrivers).
+    """
+    new_driver = new_chrome_driver if browser == 'chrome' else new_firefox_driver
+    if warm:
+        return WarmDrivers(lambda: new_driver(lean, allowed_hosts))
+    return lambda: new_driver(lean, allowed_hosts)
+
+
+def driver_rss(driver):
+    """RSS in bytes of the driver process of a session and of the browser processes it started, None when unknown."""
+    try:
+        pid = driver.service.process.pid
+    except AttributeError:
+        return None
+    if not os.path.isdir('/proc'):
+        return None
+    return sum(read_rss(process) or 0 for process in [pid] + children_pids(pid))
+
+
+class LazyDriver:
+    """
+    Starts the browser on first use, so engines that only need it as a fallback do not pay for it.
+    The browser is replaced by a fresh one before a navigation once it served settings['max_pages'] pages or grew
+    over settings['max_rss_mb']: the crawl goes on with the page it was about to open, nothing else held the old one.
+    """
+    def __init__(self, new_driver):
+        self.new_driver = new_driver
+        self.driver = None
+        self.pages = 0
+        self.max_pages = settings['max_pages']
+        self.max_rss = settings['max_rss_mb'] * 1e6
+        self.rss_every = settings['rss_every']
+
+    def start(self):
+        self.driver = self.new_driver()
+        self.pages = 0
+        count('started')
+
+    def __getattr__(self, name):
+        if self.driver is None:
+            self.start()
+        return getattr(self.driver, name)
+
+    def worn_out(self):
+        if self.max_pages and self.pages >= self.max_pages:
+            return "%d pages" % self.pages
+        if self.max_rss and self.pages and self.pages % self.rss_every == 0:
+            rss = driver_rss(self.driver)
+            if rss is not None and rss > self.max_rss:
+                return "%d MB after %d pages" % (rss / 1e6, self.pages)
+        return None
+
+    def get(self, url):
+        if self.driver is not None:
+            reason = self.worn_out()
+            if reason is not None:
+                print("recycling the browser (", reason, ")")
+                self.quit()
+                count('recycled')
+        if self.driver is None:
+            self.start()
+        self.pages = self.pages + 1
+        return self.driver.get(url)
+
+    def quit(self):
+        if self.driver is not None:
+            driver, self.driver = self.driver, None
+            try:
+                driver.quit()
+            except Exception as error:
+                # a browser that already died cannot be quit, its processes are gone with it
+                print("could not quit the browser (", repr(error), ")")
+
+
+class ThreadDrivers:
+    """
+    One LazyDriver per thread behind a single name, for the code written around the global driver of a scraper
+    once its sections run in several threads. driver, get(), quit() and every other attribute are the ones of the
+    LazyDriver of the calling thread.
+    """
+    def __init__(self, new_driver):
+        self.new_driver = new_driver
+        self.local = threading.local()
+
+    def current(self):
+        if getattr(self.local, 'driver', None) is None:
+            self.local.driver = LazyDriver(self.new_driver)
+        return self.local.driver
+
+    @property
+    def driver(self):
+        return self.current().driver
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def get(self, url):
+        return self.current().get(url)
+
+    def quit(self):
+        self.current().quit()
+
+
+def is_lazy(driver):
+    """True for the drivers starting their browser on first use (LazyDriver, ThreadDrivers), their driver is None until then."""
+    return isinstance(driver, (LazyDriver, ThreadDrivers))
+
+
+# bytes transferred by the last navigation and its resources, and the time until DOMContentLoaded
+PAGE_STATS_JS = '''
+var navigation = performance.getEntriesByType('navigation')[0];
+var bytes = navigation ? navigation.transferSize : 0;
+performance.getEntriesByType('resource').forEach(function (entry) { bytes += entry.transferSize || 0; });
+return {bytes: bytes, load_ms: navigation ? navigation.domContentLoadedEventEnd - navigation.startTime : 0};
+'''
+
+
+class BrowserStats:
+    """
+    Bandwidth and page load time of the detail pages of a run. The averages of the last full (not lean) run
+    are kept in a json file, so a lean run can report what it saved. Every site has its own file: the sites
+    run at the same time (scheduler.py) and their pages do not weigh the same.
+    """
+    def __init__(self, profile, path='browser_stats.json'):
+        self.profile = profile
+        self.path = path
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.bytes = 0
+        self.load_ms = 0.0
+
+    def track(self, scrape_state):
+        """Wraps scrape_state(driver, property_details_dic) to measure the page it leaves in the browser."""
+        def scrape_and_measure(driver, property_details_dic):
+            property_details_dic = scrape_state(driver, property_details_dic)
+            if is_lazy(driver) and driver.driver is None:
+                # the page never went through a browser (http engine)
+                return property_details_dic
+            try:
+                stats = driver.execute_script(PAGE_STATS_JS)
+            except Exception:
+                return property_details_dic
+            with self.lock:
+                self.pages = self.pages + 1
+                self.bytes = self.bytes + int(stats['bytes'] or 0)
+                self.load_ms = self.load_ms + float(stats['load_ms'] or 0)
+            return property_details_dic
+        return scrape_and_measure
+
+    def report(self):
+        """Prints the totals of the run, saves its averages and returns them."""
+        if lifecycle['started']:
+            print("browsers started: ", lifecycle['started'], ", recycled: ", lifecycle['recycled'],
+                  ", taken warm: ", lifecycle['warm'])
+        if not self.pages:
+            return {}
+        averages = {'pages': self.pages, 'bytes_per_page': self.bytes / self.pages, 'load_ms_per_page': self.load_ms / self.pages}
+        print("browser profile ", self.profile, ": ", self.pages, " pages, ", round(self.bytes / 1e6, 1), " MB, ",
+              round(averages['load_ms_per_page']), " ms per page")
+        saved = {}
+        if os.path.exists(self.path):
+            with open(self.path) as source:
+                saved = json.load(source)
+        full = saved.get('full')
+        if self.profile == 'lean' and full:
+            print("saved by the lean profile: ",
+                  round((full['bytes_per_page'] - averages['bytes_per_page']) * self.pages / 1e6, 1), " MB and ",
+                  round((full['load_ms_per_page'] - averages['load_ms_per_page']) * self.pages / 1000), " s of page loads")
+        saved[self.profile] = averages
+        temporary = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(temporary, 'w') as output:
+            json.dump(saved, output, indent=2)
+        os.replace(temporary, self.path)
+        return averages
@@ -0,0 +1,207 @@
+import argparse
+import collections
+import os
+import time
+import numpy as np
+import pandas as pd
+from listing import label_field
+
+# "1 250 000", "1.250.000", "1,250,000" or "950" (spaces, dots and commas as thousand separators),
+# then at most 2 decimals
+AMOUNT_RE = r'(\d{1,3}(?:[\s.,]\d{3})+|\d+)(?:[.,](\d{1,2}))?(?!\d)'
+# "150 m²", "1 200,5 m2", "2 ha"
+SURFACE_RE = r'(\d{1,3}(?:[\s.]\d{3})+|\d+)(?:[.,](\d+))?\s*(m²|m2|m\b|ha\b)?'
+# tunisian room notation, S+3 is a living room and 3 bedrooms
+S_PLUS_RE = r'\bs\s*\+\s*(\d{1,2})\b'
+PRICE_ON_REQUEST_RE = r'sur demande|nous consulter|a consulter|à consulter|on request|n\.?c\.?$'
+# plausible ranges, anything outside is rejected rather than guessed
+PRICE_RANGE = (10, 1e9)
+SURFACE_RANGE = (5, 1e6)
+ROOMS_RANGE = (0, 50)
+# why a value is rejected, a row is counted under the first reason that applies only
+PRICE_REASONS = ['missing', 'on_request', 'unparsed', 'not_tnd', 'per_m2', 'out_of_range']
+RANGE_REASONS = ['unparsed', 'out_of_range']
+
+
+def amount(text, pattern):
+    """Vectorised number of the first match of pattern in every row (thousand separators removed), NaN when none."""
+    parts = text.str.extract(pattern)
+    whole = parts[0].str.replace(r'\D', '', regex=True)
+    number = pd.to_numeric(whole, errors='coerce')
+    decimals = parts[1].fillna('')
+    fraction = pd.to_numeric('0.' + decimals.where(decimals != '', '0'), errors='coerce')
+    return number + fraction, parts
+
+
+def by_value(raw, parse):
+    """
+    This function responsible for running parse (a function of a Series of text) on the distinct values of raw
+    only and spreading its result back over the rows of raw: scraped columns repeat a few thousand values over
+    millions of rows, and the string methods of pandas run python code for every value they are given.
+    """
+    codes, uniques = pd.factorize(raw)
+    # the missing value goes last, where the -1 code of the missing rows points to
+    parsed = parse(pd.Series(uniques, dtype='string').reindex(range(len(uniques) + 1)))
+    return parsed.take(codes).set_axis(raw.index)
+
+
+def reject(rejections, rule, reasons, rejected):
+    """Counts the rows rejected for every reason under rule_reason, rejected gives the one reason of every row ('' when kept)."""
+    counts = rejected.value_counts()
+    for reason in reasons:
+        rejections[rule + '_' + reason] = rejections[rule + '_' + reason] + int(counts.get(reason, 0))
+
+
+def field_columns(frame):
+    """Columns of frame per typed field of listing.py, whatever label the site gave them."""
+    fields = collections.defaultdict(list)
+    for column in frame.columns:
+        field = column if column in ('prix', 'title') else label_field(column)
+        if field is not None:
+            fields[field].append(column)
+    return fields
+
+
+def first_filled(frame, columns):
+    """For every row the first non empty value of columns (a site may use several labels for one field)."""
+    if not columns:
+        return pd.Series(pd.NA, index=frame.index, dtype='string')
+    filled = None
+    for column in columns:
+        values = frame[column].astype('string')
+        blank = by_value(values, lambda text: text.str.strip().eq('').fillna(False).to_frame())[0]
+        values = values.mask(blank.astype(bool))
+        filled = values if filled is None else filled.fillna(values)
+    return filled
+
+
+def parse_prices(raw):
+    text = raw.str.lower().str.strip()
+    missing = text.isna() | text.isin(['', '0'])
+    on_request = ~missing & text.str.contains(PRICE_ON_REQUEST_RE, regex=True, na=False)
+    price, _ = amount(text, AMOUNT_RE)
+    multiplier = np.where(text.str.contains(r'\bmillions?\b|\bmd\b', regex=True, na=False), 1e6,
+                          np.where(text.str.contains(r'\bmille\b|\d\s*k\b', regex=True, na=False), 1e3, 1.0))
+    price = price.where(~missing) * multiplier
+    currency = pd.Series(np.select([text.str.contains(r'tnd|\bdt\b|dinar', regex=True, na=False),
+                                    text.str.contains(r'€|eur', regex=True, na=False),
+                                    text.str.contains(r'\$|usd', regex=True, na=False)],
+                                   ['TND', 'EUR', 'USD'], default=''), index=raw.index)
+    per_m2 = text.str.contains(r'/\s*m[²2]', regex=True, na=False)
+    per_month = text.str.contains(r'/\s*mois|par mois|mensuel', regex=True, na=False)
+    unparsed = ~missing & ~on_request & price.isna()
+    foreign = price.notna() & currency.isin(['EUR', 'USD'])
+    out_of_range = price.notna() & ~foreign & ~per_m2 & ((price < PRICE_RANGE[0]) | (price > PRICE_RANGE[1]))
+    valid = price.notna() & ~foreign & ~per_m2 & ~out_of_range
+    # every row under one rule only, the first that applies
+    rejected = np.select([missing, on_request, unparsed, foreign, per_m2 & price.notna(), out_of_range],
+                         PRICE_REASONS, default='')
+    return pd.DataFrame({'price_tnd': price.where(valid).astype('float64'),
+                         'price_currency': currency.where(price.notna(), '').replace('', pd.NA).astype('category'),
+                         'price_on_request': on_request,
+                         'price_per_month': per_month & valid,
+                         'rejected': rejected})
+
+
+def clean_prices(raw, rejections):
+    prices = by_value(raw, parse_prices)
+    reject(rejections, 'price', PRICE_REASONS, prices.pop('rejected'))
+    return prices
+
+
+def parse_surface(raw):
+    text = raw.str.lower()
+    surface, parts = amount(text, SURFACE_RE)
+    surface = surface * np.where(parts[2].eq('ha').fillna(False).astype(bool), 1e4, 1.0)
+    unparsed = raw.notna() & surface.isna()
+    out_of_range = surface.notna() & ((surface < SURFACE_RANGE[0]) | (surface > SURFACE_RANGE[1]))
+    return pd.DataFrame({'value': surface.where(~out_of_range),
+                         'rejected': np.select([unparsed, out_of_range], RANGE_REASONS, default='')})
+
+
+def clean_surface(raw, rule, rejections):
+    surface = by_value(raw, parse_surface)
+    reject(rejections, rule, RANGE_REASONS, surface['rejected'])
+    return surface['value'].astype('float32')
+
+
+def parse_count(raw):
+    count = pd.to_numeric(raw.str.extract(r'(\d+)')[0], errors='coerce')
+    unparsed = raw.notna() & count.isna()
+    out_of_range = count.notna() & ((count < ROOMS_RANGE[0]) | (count > ROOMS_RANGE[1]))
+    return pd.DataFrame({'value': count.where(~out_of_range),
+                         'rejected': np.select([unparsed, out_of_range], RANGE_REASONS, default='')})
+
+
+def clean_count(raw, rule, rejections):
+    count = by_value(raw, parse_count)
+    reject(rejections, rule, RANGE_REASONS, count['rejected'])
+    return count['value'].astype('Int16')
+
+
+def parse_s_plus(raw):
+    return pd.to_numeric(raw.str.lower().str.extract(S_PLUS_RE)[0], errors='coerce').to_frame()
+
+
+def clean_frame(frame):
+    """
+    This function responsible for adding typed columns to the raw output of a scraper, without a python loop over
+    the rows: price_tnd (float, TND), price_currency, price_on_request, price_per_month, surface_m2,
+    land_surface_m2 (float, m²), rooms, bedrooms, bathrooms (nullable ints, with the S+N notation).
+    Every column is parsed on its distinct values only (by_value).
+    Returns the frame and the number of values rejected by every rule, each under the first rule that applies.
+    """
+    rejections = collections.Counter()
+    fields = field_columns(frame)
+    cleaned = frame.copy()
+    prices = clean_prices(first_filled(frame, fields['prix']), rejections)
+    for column in prices.columns:
+        cleaned[column] = prices[column]
+    cleaned['surface_m2'] = clean_surface(first_filled(frame, fields['surface']), 'surface', rejections)
+    cleaned['land_surface_m2'] = clean_surface(first_filled(frame, fields['land_surface']), 'land_surface', rejections)
+    rooms_text = first_filled(frame, fields['rooms'])
+    # "S+2" in the rooms field (or in the title when the field is missing) gives both counts
+    s_plus = by_value(rooms_text, parse_s_plus)[0]
+    title_s_plus = by_value(first_filled(frame, fields['title']), parse_s_plus)[0]
+    rooms = clean_count(rooms_text.where(s_plus.isna()), 'rooms', rejections)
+    bedrooms = clean_count(first_filled(frame, fields['bedrooms']), 'bedrooms', rejections)
+    from_title = rooms.isna() & s_plus.isna() & title_s_plus.notna()
+    s_plus = s_plus.fillna(title_s_plus.where(from_title))
+    # not a rejection, the rooms recovered from the title
+    rejections['rooms_from_title'] = int(from_title.sum())
+    cleaned['rooms'] = rooms.fillna((s_plus + 1).astype('Int16'))
+    cleaned['bedrooms'] = bedrooms.fillna(s_plus.astype('Int16'))
+    cleaned['bathrooms'] = clean_count(first_filled(frame, fields['bathrooms']), 'bathrooms', rejections)
+    return cleaned, rejections
+
+
+def read_output(path):
+    if path.endswith('.listings.parquet') or (path.endswith('.parquet') and os.path.isfile(path)):
+        return pd.read_parquet(path)
+    if path.endswith('.parquet'):
+        from sinks import read_parquet
+        return read_parquet(path)
+    # every value as text, a "0" price or a "1" amenity must not become a number here
+    return pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[''])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add typed price, surface and room columns to the outputs of the scrapers")
+    parser.add_argument("inputs", nargs='+', help="csv files or parquet outputs of the scrapers")
+    parser.add_argument("--output", default="listings_clean.parquet", help="parquet (.parquet) or csv file receiving every input, cleaned")
+    args = parser.parse_args()
+    frames = []
+    for path in args.inputs:
+        frame = read_output(path)
+        frame['source_file'] = os.path.basename(path)
+        frames.append(frame)
+    frame = pd.concat(frames, ignore_index=True, sort=False)
+    start = time.perf_counter()
+    cleaned, rejections = clean_frame(frame)
+    print(len(cleaned), " rows cleaned in ", round(time.perf_counter() - start, 2), " s")
+    for rule, count in sorted(rejections.items()):
+        print("    ", rule, ": ", count)
+    if args.output.endswith('.parquet'):
+        cleaned.astype({column: 'string' for column in frame.columns}).to_parquet(args.output, index=False)
+    else:
+        cleaned.to_csv(args.output, index=False)
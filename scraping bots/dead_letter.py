@@ -0,0 +1,117 @@
+import collections
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import traceback
+from browser import is_lazy
+
+# messages of a browser that crashed or lost its session, retrying on it is pointless
+DEAD_BROWSER_MESSAGES = ('invalid session id', 'session deleted', 'browsing context has been discarded',
+                         'failed to decode response from marionette', 'without establishing a connection',
+                         'connection refused', 'tab crashed')
+# http statuses telling the page will not answer better on a retry, 408 and 429 are worth retrying
+RETRYABLE_STATUSES = (408, 429)
+# errors of a page that is not the one expected (properstar_lxml.MissingNodes reaching here went through the fallback)
+PERMANENT_ERRORS = ('MissingNodes',)
+
+
+def is_dead_browser(error):
+    message = str(error).lower()
+    return type(error).__name__ in ('InvalidSessionIdException', 'NoSuchWindowException') or \
+        any(dead in message for dead in DEAD_BROWSER_MESSAGES)
+
+
+def is_permanent(error):
+    """A 4xx answer (requests.HTTPError: the listing is gone or forbidden) or a page without the expected nodes."""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None and 400 <= status < 500 and status not in RETRYABLE_STATUSES:
+        return True
+    return type(error).__name__ in PERMANENT_ERRORS
+
+
+class DeadLetter:
+    """
+    Json lines file of the states that still failed after every retry, with the error, the traceback
+    and a snapshot of the page the browser was showing. Also counts what happened for the end of run summary.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_dir = os.path.splitext(path)[0]
+        self.lock = threading.Lock()
+        self.errors = collections.Counter()
+        self.retried = 0
+        self.recovered = 0
+        self.dead = 0
+        self.permanent = 0
+
+    def snapshot(self, driver, link):
+        if is_lazy(driver) and driver.driver is None:
+            return None
+        try:
+            page_source = driver.page_source
+        except Exception:
+            return None
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        snapshot_path = os.path.join(self.snapshot_dir, hashlib.sha1(link.encode('utf-8')).hexdigest() + '.html')
+        with open(snapshot_path, 'w', encoding='utf-8') as output:
+            output.write(page_source)
+        return snapshot_path
+
+    def record(self, driver, section, property_details_dic, error, attempts):
+        snapshot_path = self.snapshot(driver, property_details_dic['link'])
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'section': section, 'link': property_details_dic['link'],
+                 'statut': property_details_dic.get('statut'), 'attempts': attempts,
+                 'error': repr(error), 'traceback': "".join(traceback.format_exception(type(error), error, error.__traceback__)),
+                 'snapshot': snapshot_path}
+        with self.lock:
+            self.dead = self.dead + 1
+            self.errors[type(error).__name__] = self.errors[type(error).__name__] + 1
+            with open(self.path, 'a', encoding='utf-8') as output:
+                output.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def with_retries(self, section, scrape_state, retries=3, backoff=2.0, max_backoff=60.0):
+        """
+        Wraps scrape_state(driver, property_details_dic) so each state is tried up to retries+1 times, waiting
+        backoff * 2**attempt seconds (with jitter) in between, on a fresh copy of its dictionary every time.
+        A browser that died is restarted before the next attempt. The last error is recorded and raised again,
+        right away for a permanent error (is_permanent) that no retry would fix.
+        """
+        def scrape_with_retries(driver, property_details_dic):
+            for attempt in range(retries + 1):
+                try:
+                    scraped_dic = scrape_state(driver, dict(property_details_dic))
+                except Exception as error:
+                    if is_lazy(driver) and is_dead_browser(error):
+                        print("browser lost (", type(error).__name__, "), starting a new one")
+                        driver.quit()
+                    if is_permanent(error):
+                        print("permanent failure for ", property_details_dic['link'], " (", repr(error), "), not retried")
+                        with self.lock:
+                            self.permanent = self.permanent + 1
+                        self.record(driver, section, property_details_dic, error, attempt + 1)
+                        raise
+                    if attempt == retries:
+                        self.record(driver, section, property_details_dic, error, attempt + 1)
+                        raise
+                    with self.lock:
+                        self.retried = self.retried + 1
+                    delay = min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    print("attempt ", attempt + 1, " failed for ", property_details_dic['link'], " (", repr(error),
+                          "), retrying in ", round(delay, 1), "s")
+                    time.sleep(delay)
+                    continue
+                if attempt:
+                    with self.lock:
+                        self.recovered = self.recovered + 1
+                return scraped_dic
+        return scrape_with_retries
+
+    def summary(self):
+        print("retries: ", self.retried, ", states recovered by a retry: ", self.recovered,
+              ", states given up: ", self.dead, (" (" + str(self.permanent) + " permanent errors not retried)") if self.permanent else "",
+              (" (see " + self.path + ")") if self.dead else "")
+        for error, count in self.errors.most_common():
+            print("    ", error, ": ", count)
@@ -0,0 +1,227 @@
+import argparse
+import collections
+import csv
+import math
+import os
+import zlib
+import numpy as np
+from listing import Listing, Vocabulary, normalize_label, FLOAT_FIELDS, INT_FIELDS, TEXT_FIELDS
+from sinks import open_sink, iter_rows
+
+# 2**32 + 15, the smallest prime above every crc32, with multipliers below 2**31 nothing overflows 64 bits
+PRIME = 4294967311
+# words that say nothing about which property it is
+STOPWORDS = {'a', 'au', 'aux', 'de', 'des', 'du', 'en', 'et', 'la', 'le', 'les', 'l', 'd', 'un', 'une', 'sur',
+             'pour', 'avec', 'vendre', 'louer', 'vente', 'location', 'tunisie'}
+# fields a duplicate may not contradict, with the relative difference tolerated
+TOLERANCES = {'prix': 0.1, 'surface': 0.1}
+
+
+def input_format(path):
+    if path.endswith('.listings.parquet'):
+        return 'listing'
+    if path.endswith('.parquet'):
+        return 'parquet'
+    return 'csv'
+
+
+def input_source(path, row):
+    name = os.path.basename(path).lower()
+    for source in ('properstar', 'remax'):
+        if name.startswith(source):
+            return source
+    return row.get('source')
+
+
+def words(text):
+    return [word for word in normalize_label(text).replace('-', ' ').replace(',', ' ').replace('.', ' ').split()
+            if word not in STOPWORDS and len(word) > 1]
+
+
+def tnd_prices(listings):
+    """
+    Price in TND of every listing, parsed by clean.py ("450.000 TND", "1 250 000 DT", "1,2 MD" are all read
+    whole), None when it has none, is on request or is not in TND.
+    """
+    import pandas as pd
+    from clean import clean_prices
+    prices = clean_prices(pd.Series([listing.prix for listing in listings], dtype='string'), collections.Counter())
+    return [None if math.isnan(price) else price for price in prices['price_tnd'].tolist()]
+
+
+def fingerprint(listing, vocabulary, price=None):
+    """
+    Tokens describing a listing: the words of its title and address, its price (in TND, see tnd_prices) and
+    surfaces rounded to buckets (5% and 5 m² wide), its room counts and its amenities.
+    """
+    tokens = set('w:' + word for word in words(listing.title or ''))
+    tokens.update('a:' + word for word in words(listing.address or ''))
+    if price:
+        tokens.add('p:%d' % round(math.log(price) / math.log(1.05)))
+    for field in ('surface', 'land_surface'):
+        if getattr(listing, field):
+            tokens.add('%s:%d' % (field, round(getattr(listing, field) / 5)))
+    for field in ('rooms', 'bedrooms', 'bathrooms'):
+        if getattr(listing, field) is not None:
+            tokens.add('%s:%d' % (field, getattr(listing, field)))
+    tokens.update('f:' + normalize_label(name) for name in vocabulary.decode(listing.amenities))
+    return tokens
+
+
+class MinHashIndex:
+    """
+    MinHash signatures of `permutations` hash functions split into `bands` bands for locality sensitive hashing:
+    two listings become candidates when all the values of one band are equal, which happens with a probability
+    close to 1 above a jaccard similarity of about (1 / bands) ** (1 / rows per band) and close to 0 below.
+    """
+    def __init__(self, permutations=64, bands=16, seed=1, max_bucket=500):
+        if permutations % bands:
+            raise ValueError("permutations must be a multiple of bands")
+        generator = np.random.RandomState(seed)
+        self.multipliers = generator.randint(1, 2 ** 31, size=(permutations, 1)).astype(np.uint64)
+        self.increments = generator.randint(0, 2 ** 31, size=(permutations, 1)).astype(np.uint64)
+        self.bands = bands
+        self.rows = permutations // bands
+        self.max_bucket = max_bucket
+        self.signatures = []
+
+    def signature_batch(self, token_sets):
+        """Signatures (one row per set) of a batch of token sets, computed in one numpy pass."""
+        lengths = np.array([max(1, len(tokens)) for tokens in token_sets])
+        hashes = np.array([zlib.crc32(token.encode('utf-8')) for tokens in token_sets for token in (tokens or ['-'])],
+                          dtype=np.uint64)
+        permuted = (self.multipliers * hashes + self.increments) % np.uint64(PRIME)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return np.minimum.reduceat(permuted, starts, axis=1).T
+
+    def add(self, token_sets, batch_size=5000):
+        for start in range(0, len(token_sets), batch_size):
+            self.signatures.append(self.signature_batch(token_sets[start:start + batch_size]))
+
+    def candidates(self):
+        """Pairs (i, j) sharing at least one band, buckets larger than max_bucket are skipped (too common to mean anything)."""
+        signatures = np.concatenate(self.signatures) if self.signatures else np.zeros((0, self.bands * self.rows), np.uint64)
+        self.matrix = signatures
+        pairs = set()
+        for band in range(self.bands):
+            buckets = collections.defaultdict(list)
+            columns = signatures[:, band * self.rows:(band + 1) * self.rows]
+            for index, key in enumerate(row.tobytes() for row in columns):
+                buckets[key].append(index)
+            for members in buckets.values():
+                if 1 < len(members) <= self.max_bucket:
+                    for position, first in enumerate(members):
+                        for second in members[position + 1:]:
+                            pairs.add((first, second))
+        return pairs
+
+    def similarity(self, first, second):
+        return float(np.mean(self.matrix[first] == self.matrix[second]))
+
+
+def compatible(first, second, prices=(None, None)):
+    """False when two listings contradict each other on a field both of them know, prices are their prices in TND."""
+    for field, tolerance in TOLERANCES.items():
+        if field == 'prix':
+            first_value, second_value = prices
+        else:
+            first_value = getattr(first, field)
+            second_value = getattr(second, field)
+        if first_value and second_value and abs(first_value - second_value) > tolerance * max(first_value, second_value):
+            return False
+    return True
+
+
+def find_clusters(listings, token_sets, threshold=0.5, permutations=64, bands=16, prices=None):
+    """
+    This function responsible for grouping the listings that describe the same property.
+    Candidates come from MinHash/LSH (near linear in the number of listings), pairs are kept when their estimated
+    jaccard similarity reaches threshold and they agree on price (prices, from tnd_prices) and surface.
+    Returns the clusters as lists of indexes.
+    """
+    if prices is None:
+        prices = [None] * len(listings)
+    index = MinHashIndex(permutations, bands)
+    index.add(token_sets)
+    parents = list(range(len(listings)))
+
+    def root(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    candidates = index.candidates()
+    matched = 0
+    for first, second in candidates:
+        if index.similarity(first, second) >= threshold and compatible(listings[first], listings[second], (prices[first], prices[second])):
+            matched = matched + 1
+            parents[root(first)] = root(second)
+    print("candidate pairs: ", len(candidates), ", duplicates: ", matched)
+    clusters = collections.defaultdict(list)
+    for node in range(len(listings)):
+        clusters[root(node)].append(node)
+    return list(clusters.values())
+
+
+def completeness(listing):
+    return sum(getattr(listing, field) is not None for field in TEXT_FIELDS + FLOAT_FIELDS + INT_FIELDS) + \
+        bin(listing.amenities).count('1') + len(listing.extras)
+
+
+def canonical_listing(members):
+    """The most complete listing of a cluster, its missing typed fields filled from the other ones."""
+    members = sorted(members, key=completeness, reverse=True)
+    canonical = Listing(**{field: getattr(members[0], field) for field in Listing.__slots__})
+    for other in members[1:]:
+        for field in FLOAT_FIELDS + INT_FIELDS + ('title', 'address', 'prix'):
+            if getattr(canonical, field) is None and getattr(other, field) is not None:
+                setattr(canonical, field, getattr(other, field))
+        canonical.amenities = canonical.amenities | other.amenities
+    return canonical
+
+
+def deduplicate(paths, clusters_path, canonical_path, output_format='csv', threshold=0.5):
+    """
+    This function responsible for reading the outputs of the scrapers, clustering their duplicates and writing
+    one row per listing to clusters_path (cluster, source, link, canonical) and one canonical listing per cluster
+    to canonical_path.
+    """
+    vocabulary = Vocabulary()
+    listings = []
+    for path in paths:
+        count = 0
+        for row in iter_rows(path, input_format(path)):
+            listings.append(Listing.from_dict(input_source(path, row), row, vocabulary))
+            count = count + 1
+        print(path, ": ", count, " listings")
+    prices = tnd_prices(listings)
+    token_sets = [fingerprint(listing, vocabulary, price) for listing, price in zip(listings, prices)]
+    clusters = find_clusters(listings, token_sets, threshold, prices=prices)
+    sink = open_sink(canonical_path, output_format, source='dedup')
+    with open(clusters_path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output)
+        writer.writerow(['cluster', 'source', 'link', 'canonical'])
+        for number, members in enumerate(sorted(clusters, key=min)):
+            canonical = canonical_listing([listings[member] for member in members])
+            for member in members:
+                writer.writerow([number, listings[member].source, listings[member].link,
+                                 int(listings[member].link == canonical.link)])
+            property_details_dic = canonical.to_dict(vocabulary)
+            property_details_dic['cluster'] = number
+            property_details_dic['cluster_size'] = len(members)
+            property_details_dic['sources'] = ",".join(sorted(set(str(listings[member].source) for member in members)))
+            sink.write(property_details_dic)
+    sink.close()
+    print(len(listings), " listings, ", len(clusters), " distinct properties")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the listings published more than once (across sites and sections) and keep one per property")
+    parser.add_argument("inputs", nargs='+', help="outputs of the scrapers: csv files, parquet datasets or .listings.parquet files")
+    parser.add_argument("--clusters", default="listing_clusters.csv", help="csv file mapping every listing to its cluster")
+    parser.add_argument("--canonical", default="listings_dedup.csv", help="output with one canonical listing per cluster")
+    parser.add_argument("--output-format", choices=['csv', 'parquet', 'listing'], default="csv")
+    parser.add_argument("--threshold", type=float, default=0.5, help="estimated jaccard similarity from which two listings are the same")
+    args = parser.parse_args()
+    deduplicate(args.inputs, args.clusters, args.canonical, args.output_format, args.threshold)
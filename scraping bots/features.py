@@ -0,0 +1,261 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from listing import Vocabulary, normalize_label
+from clean import clean_frame, clean_count, field_columns, first_filled, read_output
+from geocoder import Gazetteer, GAZETTEER_PATH
+
+# amenity features of the models and the (normalised) names the sites give them
+AMENITIES = {
+    'terrace': r'terrasse|terrace|roof top|rooftop',
+    'elevator': r'ascenseur|elevator|lift',
+    'furnished': r'meuble|furnished',
+    'air_conditioning': r'climatis|air conditionne|\bclim\b|air conditioning',
+    'heating': r'chauffage|heating',
+    'security': r'gardien|securi|alarme|concierge|video surveillance|interphone',
+    'garage': r'garage|parking|box',
+    'garden': r'jardin|garden',
+    'pool': r'piscine|pool',
+}
+# feature columns of every model, in the order the flask api takes them (see prediction-service.ts)
+COMMON = ['total_area', 'rooms', 'bedrooms', 'terrace', 'furnished', 'air_conditioning', 'heating', 'security',
+          'garage', 'garden', 'pool', 'latitude', 'longitude', 'city', 'governorate']
+MODELS = {
+    'apartment_buying': COMMON + ['bathrooms', 'floor', 'elevator'],
+    'house_buying': COMMON + ['bathrooms'],
+    'apartment_rent': COMMON + ['bathrooms_number', 'floor_number', 'elevator', 'payment_period_Mois', 'payment_period_Semaine'],
+    'house_rent': COMMON + ['bathrooms_number', 'payment_period_Mois', 'payment_period_Semaine'],
+}
+# the rent models name two of the features differently
+RENAMED = {'bathrooms_number': 'bathrooms', 'floor_number': 'floor'}
+CATEGORICAL = ('city', 'governorate')
+HOUSE_RE = r'\bmaison\b|\bvilla\b|bungalow|\bhouse\b|\bferme\b|\briad\b|\bdar\b'
+APARTMENT_RE = r'appartement|\bappart\b|\bstudio\b|penthouse|duplex|triplex|\bflat\b|\bapartment\b|\bs\s*\+\s*\d'
+RENT_RE = r'locat|louer|rent'
+SALE_RE = r'vente|vendre|achat|acheter|sale'
+WEEKLY_RE = r'semaine|/\s*sem\b|hebdo|week'
+
+
+def key_hashes(links):
+    """64 bits hash of every link, the identity of a listing in an export."""
+    return np.array([int.from_bytes(hashlib.blake2b(str(link).encode('utf-8'), digest_size=8).digest(), 'little')
+                     for link in links], dtype=np.uint64)
+
+
+def amenity_flags(frame):
+    """One 0/1 column per amenity feature, from the amenity columns (or the amenities bitset of a listing file) and the title."""
+    flags = pd.DataFrame(0, index=frame.index, columns=list(AMENITIES), dtype='float32')
+    names = {column: normalize_label(column) for column in frame.columns}
+    if 'amenities' in frame.columns and frame['amenities'].map(lambda value: isinstance(value, (list, np.ndarray))).any():
+        vocabulary = Vocabulary()
+        for feature, pattern in AMENITIES.items():
+            bits = set(bit for bit, name in enumerate(vocabulary.names) if re.search(pattern, normalize_label(name)))
+            flags[feature] = frame['amenities'].map(
+                lambda value: float(value is not None and any(bit in bits for bit in value)))
+    for feature, pattern in AMENITIES.items():
+        columns = [column for column, name in names.items()
+                   if re.search(pattern, name) and column not in ('title', 'address', 'link', 'description')]
+        for column in columns:
+            values = frame[column].astype('string')
+            # remax writes 1, properstar repeats the name of the amenity as its value
+            present = values.eq('1') | values.eq(column) | values.str.lower().isin(['oui', 'yes', 'true'])
+            flags[feature] = np.maximum(flags[feature], present.fillna(False).astype('float32'))
+    if 'title' in frame.columns:
+        title = frame['title'].astype('string').map(normalize_label, na_action='ignore')
+        flags['furnished'] = np.maximum(flags['furnished'],
+                                        title.str.contains(r'\bmeuble', regex=True).fillna(False).astype('float32'))
+    return flags
+
+
+def model_names(frame, source_file):
+    """The model of every listing: property type from the title, rent or sale from the statut (or the file name)."""
+    fields = field_columns(frame)
+    kind_text = first_filled(frame, fields['title']).fillna('')
+    for column in frame.columns:
+        if 'type' in normalize_label(column):
+            kind_text = kind_text + ' ' + frame[column].astype('string').fillna('')
+    kind_text = kind_text.map(normalize_label)
+    house = kind_text.str.contains(HOUSE_RE, regex=True).to_numpy(bool)
+    apartment = ~house & kind_text.str.contains(APARTMENT_RE, regex=True).to_numpy(bool)
+    statut = (frame['statut'].astype('string').fillna('') if 'statut' in frame.columns
+              else pd.Series('', index=frame.index, dtype='string')).map(normalize_label)
+    # without a statut the section is in the file name (properstar_location.csv)
+    name = normalize_label(source_file)
+    unknown = statut.eq('').to_numpy(bool)
+    rent = statut.str.contains(RENT_RE, regex=True).to_numpy(bool) | (unknown & bool(re.search(RENT_RE, name)))
+    sale = ~rent & (statut.str.contains(SALE_RE, regex=True).to_numpy(bool) | (unknown & bool(re.search(SALE_RE, name))))
+    kind = pd.Series(np.select([apartment, house], ['apartment', 'house'], default=''), index=frame.index)
+    deal = pd.Series(np.select([rent, sale], ['rent', 'buying'], default=''), index=frame.index)
+    return (kind + '_' + deal).where(kind.ne('') & deal.ne(''), '')
+
+
+def feature_frame(frame, gazetteer=None, source_file=''):
+    """
+    This function responsible for mapping raw scraper rows onto the features of the price models.
+    Returns the features (float32, NaN when unknown, city and governorate still as text), the price in TND
+    and the model of every row ('' when the listing fits none of them).
+    """
+    cleaned, rejections = clean_frame(frame)
+    fields = field_columns(frame)
+    features = amenity_flags(frame)
+    features['total_area'] = cleaned['surface_m2'].astype('float32')
+    features['rooms'] = cleaned['rooms'].astype('float32')
+    features['bedrooms'] = cleaned['bedrooms'].astype('float32')
+    features['bathrooms'] = cleaned['bathrooms'].astype('float32')
+    floor_text = first_filled(frame, fields['floor'])
+    ground = floor_text.str.lower().str.contains(r'rez|rdc|ground', regex=True).fillna(False).astype(bool)
+    features['floor'] = clean_count(floor_text.where(~ground), 'floor', rejections).astype('float32').where(~ground, 0)
+    if 'latitude' in frame.columns and 'governorate' in frame.columns:
+        # outputs written with a gazetteer already have their location columns
+        location = frame[['city', 'governorate', 'latitude', 'longitude']].copy()
+    elif gazetteer is not None:
+        addresses = frame['address'].astype('string').fillna('') if 'address' in frame.columns else pd.Series('', index=frame.index)
+        location = pd.DataFrame(list(map(gazetteer.location_columns, addresses)), index=frame.index)
+    else:
+        location = pd.DataFrame({'city': '', 'governorate': '', 'latitude': np.nan, 'longitude': np.nan}, index=frame.index)
+    for column in ('latitude', 'longitude'):
+        features[column] = pd.to_numeric(location[column], errors='coerce').astype('float32')
+    for column in CATEGORICAL:
+        features[column] = location[column].astype('string').fillna('')
+    prices = first_filled(frame, fields['prix']).str.lower()
+    weekly = prices.str.contains(WEEKLY_RE, regex=True).fillna(False).astype(bool)
+    features['payment_period_Semaine'] = weekly.astype('float32')
+    features['payment_period_Mois'] = (~weekly).astype('float32')
+    models = model_names(frame, source_file)
+    # a rent or a sale price of 0 says nothing, and a model cannot use a listing without its area
+    usable = models.ne('') & cleaned['price_tnd'].notna() & features['total_area'].notna()
+    return features, cleaned['price_tnd'].astype('float32'), models.where(usable, '')
+
+
+class FeatureStore:
+    """
+    Feature matrix of one model as raw float32 files that np.memmap opens without copying, next to a json manifest:
+    features.f32 (rows x columns, row major), target.f32 (price in TND) and keys.u64 (hash of the link of every row).
+    Rows are only ever appended: the manifest is replaced after the files are written, so a reader never sees more
+    rows than the manifest says, and the bytes of an interrupted append are cut off by the next one.
+    City and governorate are stored as codes into the manifest categories, which are append-only too.
+    """
+    def __init__(self, path, model):
+        self.path = path
+        self.model = model
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as source:
+                self.manifest = json.load(source)
+            if self.manifest['columns'] != MODELS[model]:
+                raise ValueError("%s holds the columns of another schema, export to a new folder" % path)
+        else:
+            self.manifest = {'model': model, 'columns': MODELS[model], 'dtype': 'float32', 'rows': 0,
+                             'target': 'price_tnd', 'missing': 'NaN',
+                             'categories': {column: [] for column in CATEGORICAL},
+                             'files': {'features': 'features.f32', 'target': 'target.f32', 'keys': 'keys.u64'}}
+        self.codes = {column: {name: code for code, name in enumerate(names)}
+                      for column, names in self.manifest['categories'].items()}
+        if not os.path.exists(manifest_path):
+            self.save()
+
+    def file(self, name):
+        return os.path.join(self.path, self.manifest['files'][name])
+
+    def keys(self):
+        if not os.path.exists(self.file('keys')) or not self.manifest['rows']:
+            return np.zeros(0, np.uint64)
+        return np.memmap(self.file('keys'), dtype=np.uint64, mode='r', shape=(self.manifest['rows'],))
+
+    def encode(self, column, values):
+        codes = self.codes[column]
+        for name in pd.unique(values):
+            if name and name not in codes:
+                codes[name] = len(self.manifest['categories'][column])
+                self.manifest['categories'][column].append(name)
+        return values.map(lambda name: codes.get(name, np.nan)).astype('float32')
+
+    def append(self, features, target, links):
+        """Appends the rows whose link is not in the store yet, returns how many were added."""
+        keys = key_hashes(links)
+        new = ~np.isin(keys, self.keys())
+        # the same listing twice in one batch (two sections, two files) is kept once
+        new &= ~pd.Series(keys).duplicated().to_numpy()
+        if not new.any():
+            return 0
+        rows = features[new]
+        matrix = np.empty((len(rows), len(self.manifest['columns'])), dtype=np.float32)
+        for position, column in enumerate(self.manifest['columns']):
+            values = rows[RENAMED.get(column, column)]
+            matrix[:, position] = (self.encode(column, values) if column in CATEGORICAL else values).to_numpy(np.float32, na_value=np.nan)
+        count = self.manifest['rows']
+        for name, array, width in (('features', matrix, 4 * matrix.shape[1]), ('target', target[new].to_numpy(np.float32, na_value=np.nan), 4),
+                                   ('keys', keys[new], 8)):
+            with open(self.file(name), 'ab') as output:
+                # cut what an interrupted append left after the last complete row
+                output.truncate(count * width)
+                output.write(np.ascontiguousarray(array).tobytes())
+                output.flush()
+                os.fsync(output.fileno())
+        self.manifest['rows'] = count + len(rows)
+        self.save()
+        return len(rows)
+
+    def save(self):
+        self.manifest['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with open(os.path.join(self.path, 'manifest.json.tmp'), 'w', encoding='utf-8') as output:
+            json.dump(self.manifest, output, ensure_ascii=False, indent=1)
+        os.replace(os.path.join(self.path, 'manifest.json.tmp'), os.path.join(self.path, 'manifest.json'))
+
+
+def load_features(path):
+    """
+    This function responsible for opening an exported model without reading it: returns the features and the target
+    as read-only np.memmap arrays (rows x columns and rows) and the manifest (columns, categories of the codes).
+    """
+    with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as source:
+        manifest = json.load(source)
+    rows = manifest['rows']
+    if not rows:
+        return np.zeros((0, len(manifest['columns'])), np.float32), np.zeros(0, np.float32), manifest
+    features = np.memmap(os.path.join(path, manifest['files']['features']), dtype=np.float32, mode='r',
+                         shape=(rows, len(manifest['columns'])))
+    target = np.memmap(os.path.join(path, manifest['files']['target']), dtype=np.float32, mode='r', shape=(rows,))
+    return features, target, manifest
+
+
+def export_features(paths, output_dir, gazetteer=None):
+    """
+    This function responsible for appending the listings of the scraper outputs at paths to the feature store of
+    their model under output_dir/<model>, one input at a time. Listings already exported (same link) are skipped,
+    so the export can run after every scrape.
+    """
+    stores = {model: FeatureStore(os.path.join(output_dir, model), model) for model in MODELS}
+    for path in paths:
+        frame = read_output(path)
+        if frame.empty:
+            print(path, ": empty")
+            continue
+        features, target, models = feature_frame(frame, gazetteer, os.path.basename(path.rstrip('/')))
+        links = frame['link'].astype('string').fillna('') if 'link' in frame.columns else pd.Series(frame.index.astype(str))
+        counts = []
+        for model, store in stores.items():
+            selected = (models == model).to_numpy()
+            if selected.any():
+                added = store.append(features[selected].reset_index(drop=True), target[selected].reset_index(drop=True),
+                                     links[selected].tolist())
+                counts.append("%s: %d" % (model, added))
+        print(path, ": ", len(frame), " rows, ", int(models.eq('').sum()), " fit no model, added ", ", ".join(counts) or "none")
+    for model, store in stores.items():
+        print(model, ": ", store.manifest['rows'], " rows")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the scraped listings as memory-mapped feature matrices of the price prediction models")
+    parser.add_argument("inputs", nargs='+', help="csv files or parquet outputs of the scrapers")
+    parser.add_argument("--output-dir", default="features", help="folder of the feature stores, one sub folder per model")
+    parser.add_argument("--gazetteer", default=GAZETTEER_PATH,
+                        help="csv of places locating the outputs written without location columns, empty to leave them unknown")
+    args = parser.parse_args()
+    export_features(args.inputs, args.output_dir, Gazetteer(args.gazetteer) if args.gazetteer else None)
@@ -0,0 +1,220 @@
+import json
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Frontier:
+    """
+    On disk record of every discovered link of a crawl, with its state (pending/done/failed)
+    and the extracted fields, so an interrupted run can be resumed where it stopped.
+    A failed link is leased again while it has less than max_attempts failures. The scrape_state of the
+    scrapers already retries (dead_letter.with_retries) and a failed link is in the dead letter file, so by
+    default it is not leased again. A link whose lease expired (its worker died) is always handed out again.
+    """
+    def __init__(self, path, max_attempts=1):
+        self.lock = threading.Lock()
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # several worker processes may share the file
+        self.db.execute("PRAGMA busy_timeout=30000")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS links (
+            section TEXT NOT NULL,
+            link TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            statut TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            data TEXT,
+            updated_at REAL,
+            PRIMARY KEY (section, link))""")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(links)")]
+        if 'lease_owner' not in columns:
+            self.db.execute("ALTER TABLE links ADD COLUMN lease_owner TEXT")
+            self.db.execute("ALTER TABLE links ADD COLUMN lease_until REAL")
+        self.db.execute("CREATE INDEX IF NOT EXISTS links_state ON links (section, state, position)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sections (
+            section TEXT PRIMARY KEY,
+            discovered INTEGER NOT NULL DEFAULT 0)""")
+        # survives reset(): what earlier runs saw on the listing cards, for incremental crawls
+        self.db.execute("""CREATE TABLE IF NOT EXISTS seen_listings (
+            section TEXT NOT NULL,
+            link TEXT NOT NULL,
+            card_price TEXT,
+            scraped_price TEXT,
+            first_seen REAL,
+            last_seen REAL,
+            PRIMARY KEY (section, link))""")
+
+    def reset(self, section):
+        """Forgets everything about a section, for a fresh run."""
+        with self.lock:
+            self.db.execute("DELETE FROM links WHERE section=?", (section,))
+            self.db.execute("DELETE FROM sections WHERE section=?", (section,))
+
+    def is_discovered(self, section):
+        with self.lock:
+            row = self.db.execute("SELECT discovered FROM sections WHERE section=?", (section,)).fetchone()
+        return bool(row and row[0])
+
+    def mark_discovered(self, section):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sections (section, discovered) VALUES (?, 1)", (section,))
+
+    def add_link(self, section, property_details_dic):
+        """
+        Stores a discovered link, returns False when the link was already scraped by an earlier run.
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO links (section, link, position, statut, updated_at) "
+                "VALUES (?, ?, (SELECT COUNT(*) FROM links WHERE section=?), ?, ?)",
+                (section, property_details_dic['link'], section, property_details_dic.get('statut'), time.time()))
+            row = self.db.execute("SELECT state FROM links WHERE section=? AND link=?",
+                                  (section, property_details_dic['link'])).fetchone()
+        return row[0] != DONE
+
+    def record_links(self, section, property_details_lst):
+        """
+        This function responsible for storing the links of a discovery stage as they come,
+        it yields only the ones still to scrape and marks the section discovered at the end.
+        """
+        for property_details_dic in property_details_lst:
+            if self.add_link(section, property_details_dic):
+                yield property_details_dic
+        self.mark_discovered(section)
+
+    def pending(self, section):
+        """The links of a section that are not scraped yet (pending or failed), in discovery order."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT statut, link FROM links WHERE section=? AND state!=? ORDER BY position",
+                (section, DONE)).fetchall()
+        return [{'statut': statut, 'link': link} for statut, link in rows]
+
+    def observe(self, section, link, card_price):
+        """
+        Remembers a state seen on a listing page with the price shown on its card.
+        Returns 'new' for a link no earlier run has seen, 'changed' when the card price differs from
+        the one of the last detail scrape (or the details were never scraped) and 'known' otherwise.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT scraped_price FROM seen_listings WHERE section=? AND link=?",
+                                  (section, link)).fetchone()
+            if row is None:
+                self.db.execute(
+                    "INSERT INTO seen_listings (section, link, card_price, first_seen, last_seen) VALUES (?, ?, ?, ?, ?)",
+                    (section, link, card_price, now, now))
+                return 'new'
+            self.db.execute("UPDATE seen_listings SET card_price=?, last_seen=? WHERE section=? AND link=?",
+                            (card_price, now, section, link))
+        return 'known' if row[0] == card_price else 'changed'
+
+    def lease(self, worker, sections, ttl=300):
+        """
+        Hands the next link to scrape of the given sections to a worker, for ttl seconds.
+        Pending links come first, then the ones whose lease expired (their worker died) and the failed ones
+        with attempts left. Returns {'section', 'statut', 'link'} or None when nothing is available.
+        """
+        now = time.time()
+        marks = ",".join("?" * len(sections))
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT section, statut, link FROM links WHERE section IN (%s) AND "
+                    "(state=? OR (state=? AND lease_until<?) OR (state=? AND attempts<?)) "
+                    "ORDER BY state!=?, position LIMIT 1" % marks,
+                    tuple(sections) + (PENDING, LEASED, now, FAILED, self.max_attempts, PENDING)).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "UPDATE links SET state=?, lease_owner=?, lease_until=?, updated_at=? WHERE section=? AND link=?",
+                        (LEASED, worker, now + ttl, now, row[0], row[2]))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return {'section': row[0], 'statut': row[1], 'link': row[2]}
+
+    def remaining(self, sections):
+        """Number of links of the sections still to scrape, leased ones and failed ones with attempts left included."""
+        marks = ",".join("?" * len(sections))
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*) FROM links WHERE section IN (%s) AND (state IN (?, ?) OR (state=? AND attempts<?))" % marks,
+                tuple(sections) + (PENDING, LEASED, FAILED, self.max_attempts)).fetchone()
+        return row[0]
+
+    def mark_done(self, section, property_details_dic):
+        with self.lock:
+            self.db.execute(
+                "UPDATE links SET state=?, attempts=attempts+1, error=NULL, data=?, updated_at=?, lease_owner=NULL "
+                "WHERE section=? AND link=?",
+                (DONE, json.dumps(property_details_dic, ensure_ascii=False), time.time(),
+                 section, property_details_dic['link']))
+            # the details now match the card price seen during discovery
+            self.db.execute("UPDATE seen_listings SET scraped_price=card_price WHERE section=? AND link=?",
+                            (section, property_details_dic['link']))
+
+    def mark_failed(self, section, link, error):
+        with self.lock:
+            self.db.execute(
+                "UPDATE links SET state=?, attempts=attempts+1, error=?, updated_at=?, lease_owner=NULL "
+                "WHERE section=? AND link=?",
+                (FAILED, error, time.time(), section, link))
+
+    def rows(self, section, chunk_size=1000):
+        """The extracted fields of the scraped links of a section, in discovery order, read chunk by chunk."""
+        position = -1
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT position, data FROM links WHERE section=? AND state=? AND position>? "
+                    "ORDER BY position LIMIT ?",
+                    (section, DONE, position, chunk_size)).fetchall()
+            if not rows:
+                return
+            for position, data in rows:
+                yield json.loads(data)
+
+    def unscraped_links(self, section):
+        """The links of a section that were discovered but not scraped (failed, dead lettered or left pending)."""
+        with self.lock:
+            rows = self.db.execute("SELECT link FROM links WHERE section=? AND state!=?", (section, DONE)).fetchall()
+        return [link for link, in rows]
+
+    def counts(self, section):
+        with self.lock:
+            rows = self.db.execute("SELECT state, COUNT(*) FROM links WHERE section=? GROUP BY state",
+                                   (section,)).fetchall()
+        return dict(rows)
+
+    def track(self, section, scrape_state):
+        """
+        Wraps scrape_state(driver, property_details_dic) so every result is written to disk as soon as
+        it is extracted. A state that raises is marked failed and returns None instead of stopping the run.
+        """
+        def scrape_and_record(driver, property_details_dic):
+            try:
+                property_details_dic = scrape_state(driver, property_details_dic)
+            except Exception as error:
+                print("failed to scrape ", property_details_dic['link'], ": ", repr(error))
+                self.mark_failed(section, property_details_dic['link'], repr(error))
+                return None
+            self.mark_done(section, property_details_dic)
+            return property_details_dic
+        return scrape_and_record
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,229 @@
+import argparse
+import collections
+import csv
+import difflib
+import functools
+import os
+import re
+from listing import normalize_label
+from sinks import open_sink, iter_rows
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer_tn.csv')
+# the most specific place wins, a neighbourhood says more than its city and a city more than its governorate
+KIND_RANK = {'governorate': 1, 'delegation': 2, 'city': 3, 'locality': 4}
+# a place name right after one of these words is a street ("Route de Tunis" in Sfax), not where the property is
+STREET_WORDS = {'rue', 'avenue', 'av', 'route', 'rte', 'boulevard', 'bd', 'impasse', 'autoroute'}
+# words never worth a fuzzy match
+STOPWORDS = {'tunisie', 'tunisia', 'gouvernorat', 'governorate', 'delegation', 'residence', 'immeuble', 'cite',
+             'quartier', 'zone', 'pres', 'proche', 'centre', 'nord', 'sud', 'est', 'ouest', 'ville', 'rue', 'avenue',
+             'route', 'boulevard', 'de', 'du', 'des', 'la', 'le', 'les', 'el', 'et'}
+
+Place = collections.namedtuple('Place', 'name kind city governorate latitude longitude')
+Location = collections.namedtuple('Location', 'city governorate latitude longitude precision matched')
+
+
+def words(text):
+    """Normalised words of a name or an address: ascii, lower case, punctuation dropped ("Lac 2" keeps its number)."""
+    return re.sub(r'[^a-z0-9]+', ' ', normalize_label(text)).split()
+
+
+class Gazetteer:
+    """
+    Offline geocoder of the free text addresses of the scrapers ("Tunis, La Marsa", "Hammamet, Nabeul") built from
+    a csv of tunisian governorates, delegations, cities and neighbourhoods with their coordinates (gazetteer_tn.csv).
+    The shipped table has the 24 governorates, the main cities and the neighbourhoods of the big ones, but only
+    2 of the 264 delegations (Kerkennah, Djerba): an address naming nothing but another delegation resolves to its
+    governorate (precision 'governorate') or to nothing. Delegation rows (kind 'delegation') can be added to the
+    csv as they are, they rank between the governorates and the cities.
+    Names and aliases are indexed word by word in a trie, so an address is matched in one pass over its words,
+    and misspelled words fall back to a fuzzy match (difflib) against the names starting with the same letter.
+    resolve() keeps the last cache_size results, addresses repeat a lot across listings.
+    """
+    def __init__(self, path=GAZETTEER_PATH, cache_size=65536, cutoff=0.85):
+        self.cutoff = cutoff
+        self.trie = {}
+        self.names = collections.defaultdict(list)
+        self.places = []
+        with open(path, newline='', encoding='utf-8') as source:
+            for row in csv.DictReader(source):
+                place = Place(row['name'], row['kind'], row['city'], row['governorate'],
+                              float(row['latitude']), float(row['longitude']))
+                self.places.append(place)
+                for name in [place.name] + [alias for alias in row['aliases'].split('|') if alias]:
+                    self.add_name(words(name), place)
+        # names by first letter for the fuzzy fallback
+        self.initials = collections.defaultdict(list)
+        for name in self.names:
+            self.initials[name[0]].append(name)
+        self.resolve = functools.lru_cache(maxsize=cache_size)(self.locate)
+
+    def add_name(self, name_words, place):
+        if not name_words:
+            return
+        node = self.trie
+        for word in name_words:
+            node = node.setdefault(word, {})
+        places = node.setdefault(None, [])
+        if place not in places:
+            places.append(place)
+            self.names[" ".join(name_words)].append(place)
+
+    def exact_matches(self, address_words):
+        """(position, number of words, place) of the longest name starting at every word of the address."""
+        matches = []
+        position = 0
+        while position < len(address_words):
+            node = self.trie
+            longest = None
+            for end in range(position, len(address_words)):
+                node = node.get(address_words[end])
+                if node is None:
+                    break
+                if None in node:
+                    longest = (end + 1 - position, node[None])
+            if longest is None:
+                position = position + 1
+                continue
+            matches.extend((position, longest[0], place) for place in longest[1])
+            position = position + longest[0]
+        return matches
+
+    def fuzzy_matches(self, address_words, covered):
+        """Like exact_matches for the words left uncovered, with names close enough to one, two or three words."""
+        matches = []
+        for position in range(len(address_words)):
+            for length in (3, 2, 1):
+                span = address_words[position:position + length]
+                if len(span) < length or covered.intersection(range(position, position + length)):
+                    continue
+                if length == 1 and (span[0] in STOPWORDS or len(span[0]) < 4 or span[0].isdigit()):
+                    continue
+                text = " ".join(span)
+                close = difflib.get_close_matches(text, self.initials.get(text[0], []), n=1, cutoff=self.cutoff)
+                if close:
+                    matches.extend((position, length, place) for place in self.names[close[0]])
+                    covered.update(range(position, position + length))
+                    break
+        return matches
+
+    def locate(self, address):
+        """
+        This function responsible for finding where an address is, returns a Location (city, governorate,
+        latitude, longitude, precision, matched name) or None when no place of the gazetteer is recognised.
+        """
+        address_words = words(address or '')
+        if not address_words:
+            return None
+        matches = [match + (False,) for match in self.exact_matches(address_words)]
+        if not any(KIND_RANK[place.kind] > 1 for _, _, place, _ in matches):
+            covered = set(position + offset for position, length, _, _ in matches for offset in range(length))
+            matches.extend(match + (True,) for match in self.fuzzy_matches(address_words, covered))
+        if not matches:
+            return None
+        governorates = collections.Counter(place.governorate for _, _, place, _ in matches)
+
+        def score(match):
+            position, length, place, fuzzy = match
+            street = position > 0 and (address_words[position - 1] in STREET_WORDS or
+                                       (position > 1 and address_words[position - 1] in ('de', 'd', 'du')
+                                        and address_words[position - 2] in STREET_WORDS))
+            # the other places of the address agreeing on the governorate
+            agreeing = governorates[place.governorate] - 1
+            return (not street, agreeing, KIND_RANK[place.kind], not fuzzy, length, -position)
+
+        position, length, place, fuzzy = max(matches, key=score)
+        return Location(place.city, place.governorate, place.latitude, place.longitude, place.kind, place.name)
+
+    def resolve_many(self, addresses):
+        """Locations of a batch of addresses, every distinct address is resolved once."""
+        locations = {address: self.resolve(address) for address in set(addresses)}
+        return [locations[address] for address in addresses]
+
+    def location_columns(self, address):
+        """The location columns added to an output row, empty when the address is not recognised."""
+        return location_columns(self.resolve(address or ''))
+
+    def track_sink(self, sink):
+        """Wraps a sink of sinks.py so every state written gets the location columns of its address."""
+        return GeocodedSink(sink, self)
+
+
+def location_columns(location):
+    if location is None:
+        return {'city': "", 'governorate': "", 'latitude': None, 'longitude': None, 'location_precision': ""}
+    return {'city': location.city, 'governorate': location.governorate, 'latitude': location.latitude,
+            'longitude': location.longitude, 'location_precision': location.precision}
+
+
+class GeocodedSink:
+    def __init__(self, sink, gazetteer):
+        self.sink = sink
+        self.gazetteer = gazetteer
+
+    def write(self, property_details_dic):
+        property_details_dic.update(self.gazetteer.location_columns(property_details_dic.get('address')))
+        self.sink.write(property_details_dic)
+
+    def close(self):
+        self.sink.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+
+def input_format(path):
+    if path.endswith('.listings.parquet'):
+        return 'listing'
+    if path.endswith('.parquet'):
+        return 'parquet'
+    return 'csv'
+
+
+def geocode_outputs(paths, output_dir, gazetteer, output_format='csv', batch_size=1000):
+    """
+    This function responsible for adding the location columns to outputs already written by the scrapers,
+    reading them batch_size rows at a time, into output_dir under the same names.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for path in paths:
+        name = os.path.basename(path.rstrip('/'))
+        for suffix in ('.listings.parquet', '.parquet', '.csv'):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+        sink = open_sink(os.path.join(output_dir, name + '.csv'), output_format, batch_size, 'geocoder')
+        located = 0
+        batch = []
+        for row in iter_rows(path, input_format(path)):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                located = located + write_batch(batch, sink, gazetteer)
+                batch = []
+        located = located + write_batch(batch, sink, gazetteer)
+        sink.close()
+        print(path, ": ", sink.rows, " rows, ", located, " located")
+    print("cache: ", gazetteer.resolve.cache_info())
+
+
+def write_batch(batch, sink, gazetteer):
+    locations = gazetteer.resolve_many([row.get('address') or '' for row in batch])
+    for row, location in zip(batch, locations):
+        row.update(location_columns(location))
+        sink.write(row)
+    return sum(location is not None for location in locations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add city, governorate, latitude and longitude columns to the outputs of the scrapers, from their address and an offline gazetteer")
+    parser.add_argument("inputs", nargs='*', help="outputs of the scrapers: csv files, parquet datasets or .listings.parquet files")
+    parser.add_argument("--output-dir", default="geocoded", help="folder receiving the outputs with their location columns")
+    parser.add_argument("--output-format", choices=['csv', 'parquet', 'listing'], default="csv")
+    parser.add_argument("--gazetteer", default=GAZETTEER_PATH, help="csv of places: name, kind, city, governorate, latitude, longitude, aliases")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--address", help="resolve one address and print where it is, nothing is read or written")
+    args = parser.parse_args()
+    gazetteer = Gazetteer(args.gazetteer)
+    if args.address is not None:
+        print(gazetteer.resolve(args.address))
+    else:
+        geocode_outputs(args.inputs, args.output_dir, gazetteer, args.output_format, args.batch_size)
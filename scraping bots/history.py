@@ -0,0 +1,322 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from listing import label_field
+
+# the columns of the scraped states kept in the history, the other ones stay in the outputs
+TEXT_COLUMNS = ('link', 'statut', 'title', 'address', 'prix')
+LABEL_FIELDS = ('surface', 'rooms', 'bedrooms')
+# prices closer than this are the same price written differently
+PRICE_TOLERANCE = 0.5
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def link_hash(link):
+    """Signed 64 bits hash of a link (an sqlite and parquet int64), the rows of a partition file are sorted by it."""
+    return int.from_bytes(hashlib.blake2b(str(link).encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def history_row(property_details_dic):
+    """The part of a scraped state worth keeping across crawls: its text fields and the labels of its surface and rooms."""
+    row = {}
+    for key, value in property_details_dic.items():
+        key = str(key)
+        if key in TEXT_COLUMNS or label_field(key) in LABEL_FIELDS:
+            row[key] = None if value is None else str(value)
+    return row
+
+
+class PriceHistory:
+    """
+    Append-only history of the listings across crawls, so price cuts, time on market and delistings can be followed.
+    Every crawl of a section adds one parquet file to the partition of its day
+    (history/crawl_date=2026-10-18/remax_vente-143000-1234.parquet), rows sorted by link hash so a reader
+    looking for a few listings skips the row groups that cannot hold them. Nothing is ever rewritten.
+    An sqlite index (history/latest.db) keeps the latest state of every listing (first and last crawl seen,
+    delisting) and its events: listed, price, delisted and relisted. The queries read the index only, the
+    partitions are read for the full rows of a listing and only for the days it was seen.
+    """
+    def __init__(self, path='history'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(path, 'latest.db'), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # the scrapers of both sites may add their crawls at the same time
+        self.connection.execute("PRAGMA busy_timeout=30000")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS listings (
+            link TEXT PRIMARY KEY, link_hash INTEGER NOT NULL, source TEXT, section TEXT NOT NULL, statut TEXT,
+            title TEXT, address TEXT, prix TEXT, price_tnd REAL, surface_m2 REAL,
+            first_seen TEXT NOT NULL, last_seen TEXT NOT NULL, delisted_at TEXT)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS listings_section ON listings (section, last_seen)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS events (
+            link TEXT NOT NULL, at TEXT NOT NULL, kind TEXT NOT NULL, old_price REAL, new_price REAL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS events_link ON events (link, at)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS events_kind ON events (kind, at)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS crawls (
+            section TEXT NOT NULL, source TEXT, crawled_at TEXT NOT NULL, file TEXT, rows INTEGER NOT NULL,
+            complete INTEGER NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS crawls_section ON crawls (section, crawled_at)")
+        self.connection.commit()
+
+    def add_crawl(self, source, section, rows, crawled_at=None, complete=True, seen_links=()):
+        """
+        This function responsible for appending one crawl of a section (history_row dictionaries) to the history
+        and updating the index. seen_links are the links the crawl found but could not scrape (failed, dead
+        lettered): they are still on the site, so they are not delisted, their last state is kept.
+        A complete crawl delists the listings of the section it did not see. Crawls of a section are added in time order.
+        """
+        import pandas as pd
+        import pyarrow
+        import pyarrow.parquet
+        from clean import clean_frame
+        crawled_at = crawled_at or time.strftime(TIME_FORMAT)
+        frame = pd.DataFrame([row for row in rows if row.get('link')])
+        if frame.empty:
+            frame = pd.DataFrame(columns=list(TEXT_COLUMNS))
+        for column in TEXT_COLUMNS:
+            if column not in frame.columns:
+                frame[column] = None
+        # a state written twice (a resumed run) counts once, as last written
+        frame = frame.drop_duplicates('link', keep='last').reset_index(drop=True)
+        cleaned, _ = clean_frame(frame)
+        crawl = pd.DataFrame({
+            'link_hash': pd.Series([link_hash(link) for link in frame['link']], dtype='int64'),
+            'link': frame['link'].astype('string'),
+            'crawled_at': pd.Series(pd.Timestamp(crawled_at), index=frame.index),
+            'source': pd.Series(source, index=frame.index, dtype='string'),
+            'section': pd.Series(section, index=frame.index, dtype='string'),
+        })
+        for column in TEXT_COLUMNS[1:]:
+            crawl[column] = frame[column].astype('string')
+        for column in ('price_tnd', 'surface_m2', 'rooms', 'bedrooms'):
+            crawl[column] = cleaned[column]
+        crawl = crawl.sort_values('link_hash', kind='stable').reset_index(drop=True)
+        with self.lock:
+            last = self.connection.execute("SELECT MAX(crawled_at) FROM crawls WHERE section=?", (section,)).fetchone()[0]
+            if last is not None and crawled_at < last:
+                raise ValueError("crawl of %s at %s is older than the last one added (%s)" % (section, crawled_at, last))
+            file_name = None
+            if len(crawl):
+                partition = os.path.join(self.path, 'crawl_date=' + crawled_at[:10])
+                os.makedirs(partition, exist_ok=True)
+                file_name = '%s-%s-%d.parquet' % (os.path.splitext(section)[0], crawled_at[11:].replace(':', ''), os.getpid())
+                tmp_path = os.path.join(partition, '.' + file_name)
+                pyarrow.parquet.write_table(pyarrow.Table.from_pandas(crawl, preserve_index=False), tmp_path,
+                                            compression='zstd', row_group_size=4096)
+                os.replace(tmp_path, os.path.join(partition, file_name))
+            # plain python values, None for the missing ones
+            records = crawl.astype(object).where(crawl.notna(), None)
+            events = self.update_index(source, section, records, crawled_at, complete, seen_links)
+            self.connection.execute("INSERT INTO crawls VALUES (?, ?, ?, ?, ?, ?)",
+                                    (section, source, crawled_at, file_name, len(crawl), int(complete)))
+            self.connection.commit()
+        return events
+
+    def update_index(self, source, section, crawl, crawled_at, complete, seen_links=()):
+        """Latest state and events of the listings of one crawl, returns the number of events of every kind."""
+        events = {'listed': 0, 'price': 0, 'delisted': 0, 'relisted': 0}
+        links = crawl['link'].tolist()
+        known = {}
+        for start in range(0, len(links), 500):
+            chunk = links[start:start + 500]
+            known.update((link, (price, delisted_at)) for link, price, delisted_at in self.connection.execute(
+                "SELECT link, price_tnd, delisted_at FROM listings WHERE link IN (%s)" % ",".join("?" * len(chunk)), chunk))
+        new_events = []
+        for row in crawl.itertuples(index=False):
+            price = None if row.price_tnd is None else float(row.price_tnd)
+            surface = None if row.surface_m2 is None else float(row.surface_m2)
+            values = (row.statut, row.title, row.address, row.prix)
+            if row.link not in known:
+                new_events.append((row.link, crawled_at, 'listed', None, price))
+                self.connection.execute(
+                    "INSERT INTO listings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                    (row.link, int(row.link_hash), source, section) + values + (price, surface, crawled_at, crawled_at))
+                continue
+            old_price, delisted_at = known[row.link]
+            if delisted_at is not None:
+                new_events.append((row.link, crawled_at, 'relisted', old_price, price))
+            elif price is not None and old_price is not None and abs(price - old_price) > PRICE_TOLERANCE:
+                new_events.append((row.link, crawled_at, 'price', old_price, price))
+            # a price missing from this crawl (on request, unparsed) keeps the last one known
+            self.connection.execute(
+                "UPDATE listings SET source=?, section=?, statut=?, title=?, address=?, prix=?, "
+                "price_tnd=COALESCE(?, price_tnd), surface_m2=COALESCE(?, surface_m2), last_seen=?, delisted_at=NULL "
+                "WHERE link=?", (source, section) + values + (price, surface, crawled_at, row.link))
+        scraped = set(links)
+        self.connection.executemany("UPDATE listings SET last_seen=? WHERE link=? AND delisted_at IS NULL",
+                                    [(crawled_at, link) for link in seen_links if link not in scraped])
+        if complete:
+            for link, price in self.connection.execute(
+                    "SELECT link, price_tnd FROM listings WHERE section=? AND last_seen<? AND delisted_at IS NULL",
+                    (section, crawled_at)).fetchall():
+                new_events.append((link, crawled_at, 'delisted', price, None))
+            self.connection.execute("UPDATE listings SET delisted_at=? WHERE section=? AND last_seen<? AND delisted_at IS NULL",
+                                    (crawled_at, section, crawled_at))
+        self.connection.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?)", new_events)
+        for event in new_events:
+            events[event[2]] = events[event[2]] + 1
+        return events
+
+    def listing(self, link):
+        """Latest state of a listing (dictionary with its days on market), None when it was never crawled."""
+        cursor = self.connection.execute(
+            "SELECT *, julianday(COALESCE(delisted_at, last_seen)) - julianday(first_seen) AS days_on_market "
+            "FROM listings WHERE link=?", (link,))
+        row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def price_history(self, link):
+        """Events of a listing in time order: (at, kind, old_price, new_price)."""
+        return self.connection.execute("SELECT at, kind, old_price, new_price FROM events WHERE link=? ORDER BY at",
+                                       (link,)).fetchall()
+
+    def price_cuts(self, since, min_cut=0.05):
+        """
+        This function responsible for the price cuts of at least min_cut (a fraction) since a time:
+        (link, at, old_price, new_price, cut), largest first. old_price is the price a listing had when the
+        window opened (the old price of its first change in the window), new_price its latest one, so several
+        small cuts in a row add up. Prices changed while a listing was delisted count too.
+        """
+        return self.connection.execute(
+            "SELECT link, at, old_price, new_price, 1 - new_price / old_price AS cut FROM ("
+            "SELECT link, at, FIRST_VALUE(old_price) OVER changes AS old_price, new_price, "
+            "ROW_NUMBER() OVER (PARTITION BY link ORDER BY at DESC) AS latest FROM events "
+            "WHERE kind IN ('price', 'relisted') AND at>=? AND old_price IS NOT NULL AND new_price IS NOT NULL "
+            "WINDOW changes AS (PARTITION BY link ORDER BY at)) "
+            "WHERE latest=1 AND old_price>0 AND new_price<=old_price * (1 - ?) ORDER BY cut DESC",
+            (since, min_cut)).fetchall()
+
+    def delisted(self, since):
+        """Listings delisted since a time and not back: (link, section, first_seen, delisted_at, last price)."""
+        return self.connection.execute(
+            "SELECT link, section, first_seen, delisted_at, price_tnd FROM listings WHERE delisted_at>=? ORDER BY delisted_at",
+            (since,)).fetchall()
+
+    def observations(self, link):
+        """
+        This function responsible for reading every crawl row of a listing (DataFrame), from the partitions
+        of the days between its first and last crawl only.
+        """
+        import pyarrow.dataset
+        state = self.listing(link)
+        if state is None:
+            return None
+        first_day = state['first_seen'][:10]
+        last_day = (state['delisted_at'] or state['last_seen'])[:10]
+        files = [path for path in glob.glob(os.path.join(self.path, 'crawl_date=*', '*.parquet'))
+                 if first_day <= os.path.basename(os.path.dirname(path))[len('crawl_date='):] <= last_day]
+        if not files:
+            return None
+        dataset = pyarrow.dataset.dataset(files, format='parquet')
+        hashed = pyarrow.dataset.field('link_hash') == link_hash(link)
+        table = dataset.to_table(filter=hashed & (pyarrow.dataset.field('link') == link))
+        return table.to_pandas().sort_values('crawled_at', kind='stable').reset_index(drop=True)
+
+    def track_sink(self, sink, source, section):
+        """Wraps a sink of sinks.py so the states written make one crawl of section, added when the sink is closed."""
+        return HistorySink(sink, self, source, section)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class HistorySink:
+    def __init__(self, sink, history, source, section):
+        self.sink = sink
+        self.history = history
+        self.source = source
+        self.section = section
+        self.rows = []
+        self.seen = True
+        self.complete = True
+        self.seen_links = []
+        self.crawled_at = time.strftime(TIME_FORMAT)
+
+    def write(self, property_details_dic):
+        if self.seen:
+            self.rows.append(history_row(property_details_dic))
+        self.sink.write(property_details_dic)
+
+    def keep_unseen(self):
+        """
+        The states written from now on were not seen by this crawl (kept from the last output in incremental mode),
+        they only go to the output and the crawl does not delist anything.
+        """
+        self.seen = False
+        self.complete = False
+
+    def mark_seen(self, links):
+        """Links found by this crawl but not scraped (failed, dead lettered), the history does not delist them."""
+        self.seen_links.extend(links)
+
+    def mark_incomplete(self):
+        """This crawl missed part of the section (listing pages given up), the history does not delist anything."""
+        self.complete = False
+
+    def close(self):
+        self.sink.close()
+        events = self.history.add_crawl(self.source, self.section, self.rows, self.crawled_at, self.complete,
+                                        self.seen_links)
+        print("history of ", self.section, ": ", len(self.rows), " states, ", events)
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+
+def output_time(path):
+    """Time of the crawl of an output, from its last modification."""
+    return time.strftime(TIME_FORMAT, time.localtime(os.path.getmtime(path)))
+
+
+def output_section(path):
+    """Section of an output, the csv name the scrapers give it."""
+    name = os.path.basename(path.rstrip('/'))
+    for suffix in ('.listings.parquet', '.parquet', '.csv'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)] + '.csv'
+    return name
+
+
+if __name__ == '__main__':
+    from sinks import iter_rows
+    from geocoder import input_format
+    parser = argparse.ArgumentParser(description="Add outputs of the scrapers to the price history and query it")
+    parser.add_argument("inputs", nargs='*', help="outputs to add as crawls (csv, parquet or .listings.parquet), oldest first by modification time")
+    parser.add_argument("--history", default=os.getenv("SCRAPER_HISTORY") or "history", help="folder of the history")
+    parser.add_argument("--crawled-at", help="time of the crawl of the inputs (YYYY-MM-DDTHH:MM:SS), their modification time by default")
+    parser.add_argument("--listing", help="print the latest state and the events of one listing (its link)")
+    parser.add_argument("--observations", action="store_true", help="with --listing, also print every crawl row of the listing")
+    parser.add_argument("--cuts", action="store_true", help="print the price cuts of the last --days days")
+    parser.add_argument("--min-cut", type=float, default=0.05, help="smallest cut printed by --cuts, as a fraction of the price")
+    parser.add_argument("--delisted", action="store_true", help="print the listings delisted in the last --days days")
+    parser.add_argument("--days", type=float, default=7)
+    args = parser.parse_args()
+    history = PriceHistory(args.history)
+    for path in sorted(args.inputs, key=output_time):
+        source = os.path.basename(path).split('_')[0]
+        rows = (history_row(row) for row in iter_rows(path, input_format(path)))
+        print(path, ": ", history.add_crawl(source, output_section(path), rows, args.crawled_at or output_time(path)))
+    since = (datetime.datetime.now() - datetime.timedelta(days=args.days)).strftime(TIME_FORMAT)
+    start = time.perf_counter()
+    if args.listing:
+        print(history.listing(args.listing))
+        for event in history.price_history(args.listing):
+            print("    ", event)
+        if args.observations:
+            print(history.observations(args.listing))
+    if args.cuts:
+        for cut in history.price_cuts(since, args.min_cut):
+            print(cut)
+    if args.delisted:
+        for delisting in history.delisted(since):
+            print(delisting)
+    if args.listing or args.cuts or args.delisted:
+        print("queried in ", round((time.perf_counter() - start) * 1000, 1), " ms")
+    history.close()
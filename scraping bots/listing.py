@@ -0,0 +1,293 @@
+import contextlib
+import json
+import os
+import re
+import threading
+import unicodedata
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+# labels used by the sites for the attributes that have a typed field, compared without accents and case
+LABEL_FIELDS = [
+    ('surface habitable', 'surface'),
+    ('surface totale', 'surface'),
+    ('superficie', 'surface'),
+    ('surface du terrain', 'land_surface'),
+    ('surface terrain', 'land_surface'),
+    ('terrain', 'land_surface'),
+    ('surface', 'surface'),
+    ('nombre de pieces', 'rooms'),
+    ('pieces', 'rooms'),
+    ('chambres', 'bedrooms'),
+    ('nombre de chambres', 'bedrooms'),
+    ('salles de bains', 'bathrooms'),
+    ('salles de bain', 'bathrooms'),
+    ('salle de bain', 'bathrooms'),
+    ('salles d\'eau', 'bathrooms'),
+    ('etage', 'floor'),
+    ('annee de construction', 'year_built'),
+]
+NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+FLOAT_FIELDS = ('surface', 'land_surface')
+INT_FIELDS = ('rooms', 'bedrooms', 'bathrooms', 'floor', 'year_built')
+TEXT_FIELDS = ('source', 'statut', 'link', 'title', 'address', 'prix', 'statut_marche')
+
+
+def normalize_label(label):
+    label = unicodedata.normalize('NFKD', str(label)).encode('ascii', 'ignore').decode()
+    return " ".join(label.lower().replace(':', ' ').split())
+
+
+def label_field(label):
+    label = normalize_label(label)
+    for prefix, field in LABEL_FIELDS:
+        if label == prefix or label.startswith(prefix + ' '):
+            return field
+    return None
+
+
+def to_number(text):
+    """First number of a text like '1 200,5 m²', None when there is none."""
+    match = NUMBER_RE.search(re.sub(r'(?<=\d)\s(?=\d)', '', str(text)))
+    return float(match.group().replace(',', '.')) if match else None
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock on path + '.lock' between the processes of this host, held while the block runs."""
+    with open(path + '.lock', 'a+b') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 s
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class Vocabulary:
+    """
+    Amenity names shared by every source, each one gets a small integer (its bit in Listing.amenities).
+    Names are only ever appended, so the integers stay valid across runs. The scrapers of several sites run
+    at the same time on one file: a new name is given its integer under a file lock, after reading the names
+    the other processes added, and written at once.
+    """
+    def __init__(self, path='amenities_vocabulary.json'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.names = []
+        self.index = {}
+        if path:
+            self.load()
+
+    def load(self):
+        """Names added to the file since it was read, by this process or another one."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as source:
+            names = json.load(source)
+        if names[:len(self.names)] != self.names:
+            raise ValueError("%s does not start with the names already read, it was not only appended to" % self.path)
+        for name in names[len(self.names):]:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+
+    def write(self):
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as output:
+            json.dump(self.names, output, ensure_ascii=False, indent=0)
+        os.replace(self.path + '.tmp', self.path)
+
+    def bit(self, name):
+        name = " ".join(str(name).split())
+        bit = self.index.get(name)
+        if bit is not None:
+            return bit
+        with self.lock:
+            if name in self.index:
+                return self.index[name]
+            if not self.path:
+                self.index[name] = len(self.names)
+                self.names.append(name)
+                return self.index[name]
+            with file_lock(self.path):
+                self.load()
+                if name not in self.index:
+                    self.index[name] = len(self.names)
+                    self.names.append(name)
+                    self.write()
+            return self.index[name]
+
+    def refresh(self):
+        """Reads the names the other processes added since the file was read."""
+        if not self.path:
+            return
+        with self.lock, file_lock(self.path):
+            self.load()
+
+    def decode(self, amenities):
+        if amenities.bit_length() > len(self.names):
+            # bits given by another process after this one read the file
+            self.refresh()
+        return [name for bit, name in enumerate(self.names) if amenities >> bit & 1]
+
+    def save(self):
+        # every name is written when it is added, nothing is left to save
+        self.refresh()
+
+
+class Listing:
+    """
+    Canonical scraped listing: typed core fields, the amenities as a bitset over a Vocabulary
+    and the few remaining attributes as (label, value) pairs.
+    """
+    __slots__ = TEXT_FIELDS + FLOAT_FIELDS + INT_FIELDS + ('amenities', 'extras')
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+        if self.amenities is None:
+            self.amenities = 0
+        if self.extras is None:
+            self.extras = ()
+
+    @classmethod
+    def from_dict(cls, source, property_details_dic, vocabulary):
+        """
+        This function responsible for turning the dictionary of a scraper (or Listing.to_dict) into a Listing.
+        Amenities are the entries whose value is the integer 1 (remax caracteristiques) or the key itself (properstar
+        features without property-key), or "1" / "True" for keys that are not a label of LABEL_FIELDS (the same
+        dictionary read back from a csv), the labels of LABEL_FIELDS fill the typed fields and the rest goes to extras.
+        """
+        listing = cls(source=source)
+        extras = []
+        for key, value in property_details_dic.items():
+            if key in ('1', 1) and str(value) == '1':
+                # properstar stores a stray 1:1 entry next to every amenity
+                continue
+            if key in cls.__slots__ and key not in ('amenities', 'extras'):
+                field = key
+            elif value == key or (isinstance(value, int) and value == 1):
+                listing.amenities |= 1 << vocabulary.bit(key)
+                continue
+            else:
+                field = label_field(key)
+                if field is None and value in ('1', 'True'):
+                    listing.amenities |= 1 << vocabulary.bit(key)
+                    continue
+            if field is None:
+                extras.append((str(key), str(value)))
+            elif field in FLOAT_FIELDS:
+                setattr(listing, field, to_number(value))
+            elif field in INT_FIELDS:
+                number = to_number(value)
+                setattr(listing, field, int(number) if number is not None and abs(number) < 32768 else None)
+            elif value in (None, "") or (field == 'prix' and value == 0):
+                # the scrapers put 0 in prix when the price is missing
+                setattr(listing, field, None)
+            else:
+                setattr(listing, field, str(value))
+        listing.extras = tuple(extras)
+        return listing
+
+    def to_dict(self, vocabulary):
+        property_details_dic = {field: getattr(self, field) for field in TEXT_FIELDS + FLOAT_FIELDS + INT_FIELDS
+                                if getattr(self, field) is not None}
+        for name in vocabulary.decode(self.amenities):
+            property_details_dic[name] = 1
+        property_details_dic.update(self.extras)
+        return property_details_dic
+
+
+class ListingParquetSink:
+    """
+    Same interface as the sinks of sinks.py, writes canonical listings to a parquet file with a fixed schema.
+    Repetitive text is dictionary encoded and the amenities are a list of small integers into the vocabulary,
+    which is saved next to the file (amenities_vocabulary.json).
+    """
+    def __init__(self, path, source, batch_size=100, vocabulary=None):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.source = source
+        self.batch_size = batch_size
+        self.vocabulary = vocabulary or Vocabulary()
+        self.batch = []
+        self.rows = 0
+        text = pyarrow.string()
+        category = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        self.schema = pyarrow.schema(
+            [(field, category if field in ('source', 'statut', 'statut_marche', 'address') else text) for field in TEXT_FIELDS]
+            + [(field, pyarrow.float32()) for field in FLOAT_FIELDS]
+            + [(field, pyarrow.int16()) for field in INT_FIELDS]
+            + [('amenities', pyarrow.list_(pyarrow.uint16())), ('extras', text)])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd', use_dictionary=True)
+
+    def write(self, property_details_dic):
+        if not isinstance(property_details_dic, Listing):
+            property_details_dic = Listing.from_dict(self.source, property_details_dic, self.vocabulary)
+        self.batch.append(property_details_dic)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        columns = {}
+        for field in TEXT_FIELDS + FLOAT_FIELDS + INT_FIELDS:
+            columns[field] = [getattr(listing, field) for listing in self.batch]
+        columns['amenities'] = [[bit for bit in range(listing.amenities.bit_length()) if listing.amenities >> bit & 1]
+                                for listing in self.batch]
+        columns['extras'] = [json.dumps(dict(listing.extras), ensure_ascii=False) if listing.extras else None
+                             for listing in self.batch]
+        arrays = []
+        for field in self.schema:
+            if self.pa.types.is_dictionary(field.type):
+                arrays.append(self.pa.array(columns[field.name], self.pa.string()).dictionary_encode())
+            else:
+                arrays.append(self.pa.array(columns[field.name], field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = self.rows + len(self.batch)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.vocabulary.save()
+
+
+def iter_listings(path, vocabulary=None):
+    """
+    This function responsible for reading back the rows of a ListingParquetSink file as dictionaries.
+    """
+    import pyarrow.parquet
+    vocabulary = vocabulary or Vocabulary()
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+        for row in batch.to_pylist():
+            amenities = row.pop('amenities') or []
+            extras = row.pop('extras')
+            property_details_dic = {key: value for key, value in row.items() if value is not None}
+            if amenities and max(amenities) >= len(vocabulary.names):
+                vocabulary.refresh()
+            for bit in amenities:
+                property_details_dic[vocabulary.names[bit]] = 1
+            if extras:
+                property_details_dic.update(json.loads(extras))
+            yield property_details_dic
@@ -0,0 +1,309 @@
+import collections
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histograms, same idea as the prometheus client defaults
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# completions kept to compute the current pages per minute
+RATE_WINDOW = 300.0
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[index] = self.counts[index] + 1
+                break
+        self.count = self.count + 1
+        self.sum = self.sum + seconds
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total = total + count
+            yield bound, total
+
+
+class Section:
+    def __init__(self):
+        self.started = time.time()
+        self.discovered = 0
+        self.discovering = True
+        self.done = 0
+        self.failed = 0
+        self.completions = collections.deque()
+
+
+class TimedSink:
+    def __init__(self, sink, metrics):
+        self.sink = sink
+        self.metrics = metrics
+
+    def write(self, property_details_dic):
+        with self.metrics.stage('output'):
+            self.sink.write(property_details_dic)
+
+    def close(self):
+        with self.metrics.stage('output'):
+            self.sink.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+
+def read_rss(pid):
+    """Resident memory of a process in bytes, None when /proc is not available (not linux) or the process is gone."""
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return 0
+
+
+def children_pids(pid):
+    """Every descendant of pid, from the parent pid of each /proc/<pid>/stat."""
+    parents = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as stat:
+                # the process name may hold spaces, the fields after it are fixed
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        parents[int(fields[1])].append(int(entry))
+    pids = []
+    todo = list(parents[pid])
+    while todo:
+        child = todo.pop()
+        pids.append(child)
+        todo.extend(parents[child])
+    return pids
+
+
+def browser_rss():
+    """RSS of the drivers and browsers started by this process (they are all its descendants)."""
+    if not os.path.isdir('/proc'):
+        return None
+    return sum(read_rss(pid) or 0 for pid in children_pids(os.getpid()))
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**values):
+    return '{' + ','.join('%s="%s"' % (key, escape(value)) for key, value in values.items()) + '}'
+
+
+class Metrics:
+    """
+    Timing of every stage of a scraper (listing discovery, navigation, waits, extraction, output), errors,
+    pages per minute, browser memory and the remaining time of each section.
+    Each state is logged as a json line to log_path, and every flush_every seconds (checked as states complete,
+    stages end and links are discovered) the whole set is written to prom_path in the prometheus text format
+    (point the node_exporter textfile collector at its folder).
+    """
+    def __init__(self, scraper, log_path=None, prom_path=None, flush_every=15.0):
+        self.scraper = scraper
+        self.log_path = log_path
+        self.prom_path = prom_path
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.histograms = collections.defaultdict(Histogram)
+        self.errors = collections.Counter()
+        self.sections = collections.defaultdict(Section)
+        self.last_flush = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].observe(seconds)
+
+    def flush_due(self):
+        """True, once, when the last flush is flush_every seconds old."""
+        now = time.time()
+        with self.lock:
+            due = now - self.last_flush >= self.flush_every
+            if due:
+                self.last_flush = now
+        return due
+
+    @contextmanager
+    def stage(self, stage, expected=()):
+        """
+        Times the block as one observation of stage, exceptions are counted and raised again,
+        except the ones of the expected types (a wait for a page past the last one).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except expected:
+            raise
+        except Exception as error:
+            with self.lock:
+                self.errors[(stage, type(error).__name__)] = self.errors[(stage, type(error).__name__)] + 1
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+            if self.flush_due():
+                self.flush()
+
+    def count_links(self, section, property_details_lst, stage=None):
+        """
+        Yields the discovered states while counting them, the total of the section is known once the iterable
+        is exhausted. With stage, the time until then is observed as that stage (streamed discovery).
+        """
+        start = time.perf_counter()
+        self.sections[section].discovering = True
+        for property_details_dic in property_details_lst:
+            with self.lock:
+                self.sections[section].discovered = self.sections[section].discovered + 1
+            if self.flush_due():
+                self.flush()
+            yield property_details_dic
+        self.sections[section].discovering = False
+        if stage is not None:
+            self.observe(stage, time.perf_counter() - start)
+        self.log('discovered', section=section, states=self.sections[section].discovered)
+
+    def track(self, section, scrape_state):
+        """
+        Wraps scrape_state(driver, property_details_dic) to time each state of section as the 'state' stage,
+        log it and keep the progress of the section up to date.
+        """
+        def scrape_and_count(driver, property_details_dic):
+            start = time.perf_counter()
+            error = None
+            try:
+                with self.stage('state'):
+                    return scrape_state(driver, property_details_dic)
+            except Exception as state_error:
+                error = state_error
+                raise
+            finally:
+                self.state_done(section, property_details_dic['link'], time.perf_counter() - start, error)
+        return scrape_and_count
+
+    def state_done(self, section, link, seconds, error=None):
+        now = time.time()
+        with self.lock:
+            progress = self.sections[section]
+            if error is None:
+                progress.done = progress.done + 1
+            else:
+                progress.failed = progress.failed + 1
+            progress.completions.append(now)
+            while progress.completions[0] < now - RATE_WINDOW:
+                progress.completions.popleft()
+        self.log('state', section=section, link=link, seconds=round(seconds, 3),
+                 error=repr(error) if error is not None else None)
+        if self.flush_due():
+            self.flush()
+
+    def track_sink(self, sink):
+        """Wraps a sink of sinks.py so the time of its writes (and of the batches they flush) is the 'output' stage."""
+        return TimedSink(sink, self)
+
+    def progress(self, section):
+        """Done/failed/discovered states, pages per minute over the last minutes and the estimated seconds left."""
+        with self.lock:
+            progress = self.sections[section]
+            now = time.time()
+            window = min(RATE_WINDOW, now - progress.started)
+            recent = sum(1 for completed in progress.completions if completed >= now - RATE_WINDOW)
+            per_minute = recent * 60.0 / window if window > 0 else 0.0
+            left = max(0, progress.discovered - progress.done - progress.failed)
+            return {'section': section, 'done': progress.done, 'failed': progress.failed,
+                    'discovered': progress.discovered, 'discovering': progress.discovering,
+                    'pages_per_minute': round(per_minute, 2),
+                    # a lower bound while the links are still being discovered
+                    'eta_seconds': round(left * 60.0 / per_minute) if per_minute else None}
+
+    def log(self, event, **fields):
+        if self.log_path is None:
+            return
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scraper': self.scraper, 'event': event}
+        entry.update(fields)
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            with open(self.log_path, 'a', encoding='utf-8') as output:
+                output.write(line)
+
+    def flush(self):
+        """Logs the progress of every section and rewrites the prometheus file."""
+        self.last_flush = time.time()
+        rss = browser_rss()
+        own_rss = read_rss(os.getpid())
+        sections = [self.progress(section) for section in list(self.sections)]
+        for progress in sections:
+            eta = progress['eta_seconds']
+            print(progress['section'], ": ", progress['done'], "/", progress['discovered'],
+                  "+" if progress['discovering'] else "", " states, ", progress['pages_per_minute'], " pages/min, eta ",
+                  "?" if eta is None else time.strftime('%H:%M:%S', time.gmtime(eta)))
+            self.log('progress', browser_rss_bytes=rss, **progress)
+        if self.prom_path is not None:
+            with self.flush_lock:
+                self.write_prometheus(sections, rss, own_rss)
+
+    def write_prometheus(self, sections, rss, own_rss):
+        scraper = self.scraper
+        lines = ['# HELP scraper_stage_seconds Time spent in each stage of the scraper.',
+                 '# TYPE scraper_stage_seconds histogram']
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                for bound, count in histogram.cumulative():
+                    lines.append('scraper_stage_seconds_bucket%s %d' % (labels(scraper=scraper, stage=stage, le=bound), count))
+                lines.append('scraper_stage_seconds_bucket%s %d' % (labels(scraper=scraper, stage=stage, le='+Inf'), histogram.count))
+                lines.append('scraper_stage_seconds_sum%s %f' % (labels(scraper=scraper, stage=stage), histogram.sum))
+                lines.append('scraper_stage_seconds_count%s %d' % (labels(scraper=scraper, stage=stage), histogram.count))
+            lines.append('# HELP scraper_errors_total Exceptions raised in each stage, by type.')
+            lines.append('# TYPE scraper_errors_total counter')
+            for (stage, error), count in sorted(self.errors.items()):
+                lines.append('scraper_errors_total%s %d' % (labels(scraper=scraper, stage=stage, error=error), count))
+        gauges = [('scraper_states_discovered', 'States discovered in the section.', 'discovered'),
+                  ('scraper_states_done', 'States scraped in the section.', 'done'),
+                  ('scraper_states_failed', 'States given up in the section.', 'failed'),
+                  ('scraper_pages_per_minute', 'Detail pages scraped per minute over the last minutes.', 'pages_per_minute'),
+                  ('scraper_eta_seconds', 'Estimated seconds until the section is scraped.', 'eta_seconds')]
+        for name, help_text, key in gauges:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for progress in sections:
+                if progress[key] is not None:
+                    lines.append('%s%s %s' % (name, labels(scraper=scraper, section=progress['section']), progress[key]))
+        for name, help_text, value in [('scraper_browser_rss_bytes', 'Resident memory of the drivers and browsers.', rss),
+                                       ('scraper_process_rss_bytes', 'Resident memory of the scraper itself.', own_rss),
+                                       ('scraper_last_flush_timestamp_seconds', 'Time of this snapshot.', self.last_flush)]:
+            if value is not None:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s%s %s' % (name, labels(scraper=scraper), value))
+        # written aside then renamed, node_exporter never reads half a file
+        tmp_path = self.prom_path + '.tmp'
+        with open(tmp_path, 'w') as output:
+            output.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prom_path)
+
+    def report(self):
+        """Final flush, then the mean time of every stage."""
+        self.flush()
+        with self.lock:
+            stages = sorted(self.histograms.items(), key=lambda item: -item[1].sum)
+            for stage, histogram in stages:
+                print("stage ", stage, ": ", histogram.count, " times, ", round(histogram.sum, 1), " s, ",
+                      round(histogram.sum / histogram.count, 3) if histogram.count else 0, " s on average")
+            for (stage, error), count in self.errors.most_common():
+                print("    errors in ", stage, ": ", error, " x", count)
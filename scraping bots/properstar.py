@@ -1,30 +1,76 @@
-from selenium import webdriver
-from selenium.webdriver.firefox.service import Service
-from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.firefox import GeckoDriverManager
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 import time
-import pandas as pd
 from dotenv import load_dotenv
 import os
-def get_states_links_statut(website_link,statut_ch):
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from browser import new_driver_factory, BrowserStats, ThreadDrivers
+import browser
+from worker_pool import scrape_in_pool
+import properstar_lxml
+from properstar_async import stream_states_links, parse_listing_page
+from properstar_sitemap import SitemapDiscovery, SITE_URL
+from frontier import Frontier
+from sinks import open_sink
+from work_queue import serve_queue, open_queue, start_workers, wait_for_sections, LOOPBACK_HOSTS
+import rate_limiter
+from dead_letter import DeadLetter
+from metrics import Metrics
+from archive import PageArchive
+from scheduler import load_sections, SECTIONS_PATH
+from geocoder import Gazetteer, GAZETTEER_PATH
+from history import PriceHistory
+from snapshot import snapshot_output, snapshot_row, snapshot_time
+def get_states_links_statut(website_link,statut_ch,cards=False,section=None):
     """
     This function responsible for filling  the 'link' and 'statut' fields in the dictionaries within property_details_lst.
+    With cards the fields shown by the cards (title, price, surface, address) are read from the page too.
+    The pages end with the first one showing no state. When that happens before the last page told by the first one
+    (a slow or throttled page), section goes to lost_sections: its crawl does not delist anything.
     """
     page_number=0
+    last_page=None
     property_details_lst=[]
     while True:
         try:
             page_number=page_number+1
             website = website_link+str(page_number)
-            driver.get(website)
+            # listing pages share the throttle of the detail pages of the host
+            throttle=rate_limiter.for_url(website)
+            start=throttle.acquire()
+            try:
+                with metrics.stage('listing_navigation'):
+                    driver.get(website)
+            except TimeoutException:
+                throttle.release(start,timeout=True)
+                raise
+            throttle.release(start)
             print("Getting state links from page number ",page_number)
             # Open the website
-            states = WebDriverWait(driver, 10).until(
-                    EC.presence_of_all_elements_located((By.XPATH, '//article[@class="item-adaptive card-basic vendor-hidden"]'))
-                )
+            # past the last page told by the first one, no state showing up is the expected end of the section
+            past_last_page=last_page is not None and page_number>last_page
+            with metrics.stage('listing_wait',expected=TimeoutException if past_last_page else ()):
+                states = WebDriverWait(driver, 10).until(
+                        EC.presence_of_all_elements_located((By.XPATH, '//article[@class="item-adaptive card-basic vendor-hidden"]'))
+                    )
+            if archive is not None:
+                archive.add_page(website,driver.page_source,'listing',statut=statut_ch)
+            if page_number==1 and not cards:
+                # the pager or the result count tells where the section ends
+                last_page=parse_listing_page(driver.page_source,website)[1]
+            if cards:
+                # one page_source per page, the cards are read by lxml
+                with metrics.stage('listing_extraction'):
+                    cards_lst,page_last_page=parse_listing_page(driver.page_source,website,cards=True)
+                last_page=max(last_page or 0,page_last_page or 0) or None
+                print("Getting ",len(cards_lst)," cards from page number ",page_number)
+                property_details_lst.extend(dict({'statut':statut_ch},**card) for card in cards_lst)
+                continue
             state_index=0
             for state in states:
                 state_index=state_index+1
@@ -38,75 +84,451 @@ def get_states_links_statut(website_link,statut_ch):
                 property_details_dic['link'] = link_element.get_attribute('href')
                 print(property_details_dic['link'])
                 property_details_lst.append(property_details_dic)
-        except:
-            print("no page found")
+        except TimeoutException:
+            if last_page is None or page_number<=last_page:
+                print("page ",page_number," timed out before the last page (",last_page or "unknown","), the section is not complete")
+                if section is not None:
+                    lost_sections.add(section)
+            else:
+                print("no page found")
             break
     return property_details_lst    
-def get_states_details(property_details_lst):
+def get_state_details(driver,property_details_dic):
     """
-    This function responsible for filling other fields in the dictionaries within property_details_lst.
+    This function responsible for filling other fields in one dictionary of property_details_lst.
     """
-    for c in range(len(property_details_lst)):
-        driver.get(property_details_lst[c]['link'])
-        print("Sraping state number ",c+1)
-        print(property_details_lst[c]['link'])
+    with metrics.stage('navigation'):
+        driver.get(property_details_dic['link'])
+    print(property_details_dic['link'])
+    with metrics.stage('extraction'):
         try:
-            property_details_lst[c]['title']= driver.find_element(By.XPATH,'//div[@class="main-info"]/h1').text
-        except:
-            property_details_lst[c]['title']=""
+            property_details_dic['title']= driver.find_element(By.XPATH,'//div[@class="main-info"]/h1').text
+        except NoSuchElementException:
+            property_details_dic['title']=""
         try:
-            property_details_lst[c]['address']=driver.find_element(By.XPATH,'//span[@class="item-info-address-inner-address"]').text
-        except:
-            property_details_lst[c]['address']=""
-        
+            property_details_dic['address']=driver.find_element(By.XPATH,'//span[@class="item-info-address-inner-address"]').text
+        except NoSuchElementException:
+            property_details_dic['address']=""
+
         try:
-            property_details_lst[c]['prix']= driver.find_element(By.XPATH,'//div[@class="listing-price-main"]/span').text
-        except:
-            property_details_lst[c]['prix']=0    
-    
+            property_details_dic['prix']= driver.find_element(By.XPATH,'//div[@class="listing-price-main"]/span').text
+        except NoSuchElementException:
+            property_details_dic['prix']=0
+
         details=driver.find_elements(By.XPATH,'//div[@class="feature-content"]')
         for detail in details:
             try:
-                key=detail.find_element(By.XPATH,'.//span[@class="property-key"]').text
                 value=detail.find_element(By.XPATH,'.//span[@class="property-value"]').text
-                property_details_lst[c][key]=value
-            except:
-                key=detail.find_element(By.XPATH,'.//span[@class="property-value"]').text
+            except NoSuchElementException:
+                # nothing to read in this feature
+                continue
+            try:
+                key=detail.find_element(By.XPATH,'.//span[@class="property-key"]').text
+                property_details_dic[key]=value
+            except NoSuchElementException:
+                key=value
                 value=1
-                property_details_lst[c][key]=key
-                property_details_lst[c][value]=value
-    return property_details_lst
+                property_details_dic[key]=key
+                property_details_dic[value]=value
+    return property_details_dic
+def get_state_details_http(driver,property_details_dic):
+    """
+    This function responsible for filling one dictionary over http + lxml, the browser is only used as a fallback.
+    """
+    return properstar_lxml.get_state_details(driver,property_details_dic,get_state_details,
+                                             on_page=archive.add_detail_page if archive is not None else None)
+# one round trip to geckodriver per page instead of one per element
+DETAILS_JS='''
+function first(xpath, context) {
+    var node = document.evaluate(xpath, context || document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    return node ? node.innerText.trim() : null;
+}
+var features = [];
+var details = document.evaluate('//div[@class="feature-content"]', document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+for (var i = 0; i < details.snapshotLength; i++) {
+    var detail = details.snapshotItem(i);
+    features.push([first('.//span[@class="property-key"]', detail), first('.//span[@class="property-value"]', detail)]);
+}
+return {
+    title: first('//div[@class="main-info"]/h1'),
+    address: first('//span[@class="item-info-address-inner-address"]'),
+    prix: first('//div[@class="listing-price-main"]/span'),
+    features: features
+};
+'''
+def get_state_details_js(driver,property_details_dic):
+    """
+    This function responsible for filling one dictionary with a single execute_script call, same layout as get_state_details.
+    """
+    with metrics.stage('navigation'):
+        driver.get(property_details_dic['link'])
+    print(property_details_dic['link'])
+    with metrics.stage('extraction'):
+        details=driver.execute_script(DETAILS_JS)
+        property_details_dic['title']=details['title'] if details['title'] is not None else ""
+        property_details_dic['address']=details['address'] if details['address'] is not None else ""
+        property_details_dic['prix']=details['prix'] if details['prix'] is not None else 0
+        for key,value in details['features']:
+            if key is not None and value is not None:
+                property_details_dic[key]=value
+            elif value is not None:
+                property_details_dic[value]=value
+                property_details_dic[1]=1
+    return property_details_dic
+# detail page engines, selectable per section
+engines={'selenium':get_state_details,'http':get_state_details_http,'js':get_state_details_js}
+def get_states_details(property_details_lst,workers=1,engine='selenium',frontier=None,section=None):
+    """
+    This function responsible for filling other fields in the dictionaries within property_details_lst.
+    With more than one worker the links are shared between that many browsers.
+    property_details_lst may also be a generator, the states are scraped as they come.
+    With a frontier every state is saved as soon as it is scraped and states that fail are left out.
+    The scraped dictionaries are yielded in the original order as soon as they are ready.
+    """
+    scrape_state=wrap_engine(engine,section)
+    if frontier is not None:
+        scrape_state=frontier.track(section,scrape_state)
+    if workers>1:
+        scraped_lst=scrape_in_pool(property_details_lst,scrape_state,new_driver,workers)
+    else:
+        scraped_lst=scrape_one_by_one(property_details_lst,scrape_state)
+    for property_details_dic in scraped_lst:
+        if property_details_dic is not None:
+            yield property_details_dic
+def open_output(csv_name):
+    """
+    This function responsible for opening the output of a section, timed by the metrics and with the location
+    columns of every state when a gazetteer is set.
+    With a price history the states written are added to it as one crawl of the section csv_name: a snapshot
+    (its own output) is a section of its own, so it never delists what the full crawls of its section hold.
+    """
+    sink=open_sink(csv_name,args.output_format,args.batch_size,'properstar')
+    if gazetteer is not None:
+        sink=gazetteer.track_sink(sink)
+    if history is not None:
+        sink=history.track_sink(sink,'properstar',csv_name)
+    return metrics.track_sink(sink)
+def close_output(sink,section,frontier=None):
+    """
+    This function responsible for closing an output. The links of section the run found but could not scrape
+    (failed, dead lettered) are still listed, the price history is told so it does not delist them, and nothing
+    is delisted when the discovery of section did not reach its last listing page.
+    """
+    if history is not None:
+        if frontier is not None:
+            sink.mark_seen(frontier.unscraped_links(section))
+        if section in lost_sections:
+            # listing pages were missed, what they held is not known to be gone
+            sink.mark_incomplete()
+    sink.close()
+def wrap_engine(engine,section):
+    """
+    This function responsible for returning the scrape_state of an engine with the browser stats, the rate limiter,
+    the retries (states that keep failing go to the dead letter file) and the metrics, archiving its pages when asked.
+    """
+    scrape_state=engines[engine]
+    if archive is not None:
+        scrape_state=archive.track(section,scrape_state)
+    scrape_state=browser_stats.track(scrape_state)
+    if engine!='http':
+        # the http engine paces its own requests and its browser fallback
+        scrape_state=rate_limiter.throttled(scrape_state)
+    return metrics.track(section,dead_letter.with_retries(section,scrape_state,args.retries))
+def listing_archiver(section,statut_ch):
+    """
+    This function responsible for returning the on_page callback keeping the listing pages of a section in the archive.
+    """
+    if archive is None:
+        return None
+    return lambda url,page_source: archive.add_page(url,page_source,'listing',section,statut_ch)
+def scrape_one_by_one(property_details_lst,scrape_state):
+    for c,property_details_dic in enumerate(property_details_lst):
+        print("Sraping state number ",c+1)
+        yield scrape_state(driver,property_details_dic)
+def discover_section(p):
+    """
+    This function responsible for the links of section p: the unfinished ones of the interrupted run with --resume,
+    else the ones of a new discovery. They are stored in the frontier as they come and yielded when still to scrape.
+    """
+    print("start scraping ",website_link_lst[p])
+    section=csv_name_lst[p]
+    if args.resume and frontier.is_discovered(section):
+        # links already discovered by the interrupted run, only the unfinished ones are scraped
+        property_details_lst=frontier.pending(section)
+        print("Resuming, number of states left to scrape: ",len(property_details_lst))
+        return metrics.count_links(section,property_details_lst)
+    if not args.resume:
+        frontier.reset(section)
+    if args.discovery=='async':
+        # the links are streamed to the detail scraping while the listing pages are still downloading
+        property_details_lst=metrics.count_links(section,stream_states_links(website_link_lst[p],statut_lst[p],args.max_in_flight,listing_archiver(section,statut_lst[p]),retries=args.retries,on_lost=lambda page_number:lost_sections.add(section)),'discovery')
+    elif args.discovery=='sitemap':
+        # no result page is opened, the sitemap is read once for all the sections
+        with metrics.stage('discovery'):
+            property_details_lst=sitemap.states_links(website_link_lst[p],statut_lst[p])
+        if sitemap.failed:
+            # child sitemaps could not be read, their listings may belong to this section
+            lost_sections.add(section)
+        print("Number of states to scrape: ",len(property_details_lst))
+        property_details_lst=metrics.count_links(section,property_details_lst)
+    else:
+        with metrics.stage('discovery'):
+            property_details_lst=get_states_links_statut(website_link_lst[p],statut_lst[p],section=section)
+        print("Number of states to scrape: ",len(property_details_lst))
+        property_details_lst=metrics.count_links(section,property_details_lst)
+    return frontier.record_links(section,property_details_lst)
+def queue_section(p):
+    """
+    This function responsible for discovering section p in a thread of its own, the links only go to the frontier.
+    """
+    for property_details_dic in discover_section(p):
+        pass
+    # the listing browser of this thread is not needed any more
+    driver.quit()
+    print("end of discovery ",website_link_lst[p])
+def write_from_frontier(p):
+    sink=open_output(csv_name_lst[p])
+    for property_details_dic in frontier.rows(csv_name_lst[p]):
+        sink.write(property_details_dic)
+    close_output(sink,csv_name_lst[p],frontier)
+    print("Number of states written to ",csv_name_lst[p],": ",sink.rows,frontier.counts(csv_name_lst[p]))
+
+def snapshot_section(p,own_browser=False):
+    """
+    This function responsible for writing the snapshot of section p: the fields shown by the cards of its listing
+    pages, one page load per page of cards, no state is opened. own_browser when the section has a thread of its own.
+    """
+    print("start snapshot ",website_link_lst[p])
+    if args.discovery=='async':
+        cards_lst=stream_states_links(website_link_lst[p],statut_lst[p],args.max_in_flight,listing_archiver(csv_name_lst[p],statut_lst[p]),cards=True,retries=args.retries,on_lost=lambda page_number:lost_sections.add(csv_name_lst[p]))
+    else:
+        cards_lst=get_states_links_statut(website_link_lst[p],statut_lst[p],cards=True,section=csv_name_lst[p])
+    sink=open_output(snapshot_output(csv_name_lst[p]))
+    seen=set()
+    for card in cards_lst:
+        # a state moved to another page while the section is read shows up twice
+        if card['link'] not in seen:
+            seen.add(card['link'])
+            sink.write(snapshot_row(snapshot_at,card))
+    close_output(sink,csv_name_lst[p])
+    if own_browser:
+        driver.quit()
+    print("Number of states in the snapshot ",snapshot_output(csv_name_lst[p]),": ",sink.rows)
 
 #Main programme
 # Load environment variables from .env file
 load_dotenv()
+parser = argparse.ArgumentParser(description="Scrape the properstar.fr tunisian listings")
+parser.add_argument("--workers", type=int, default=int(os.getenv("SCRAPER_WORKERS", "1")),
+                    help="number of browsers scraping the detail pages in parallel")
+parser.add_argument("--engine", default=os.getenv("SCRAPER_ENGINE", "selenium"),
+                    help="detail page engine (selenium, js or http), one value for all sections or one per section separated by commas")
+parser.add_argument("--discovery", choices=['selenium','async','sitemap'], default=os.getenv("SCRAPER_DISCOVERY", "selenium"),
+                    help="how the links are found: listing pages one by one in the browser, listing pages concurrently over http, or the sitemap of the site")
+parser.add_argument("--sitemap", default=os.getenv("SCRAPER_SITEMAP"),
+                    help="sitemap (or sitemap index, .xml or .xml.gz, url or local file) read by --discovery sitemap, /sitemap.xml of the site by default")
+parser.add_argument("--max-in-flight", type=int, default=int(os.getenv("SCRAPER_MAX_IN_FLIGHT", "8")),
+                    help="listing pages downloaded at the same time by the async discovery")
+parser.add_argument("--frontier", default=os.getenv("SCRAPER_FRONTIER", "properstar_frontier.db"),
+                    help="sqlite file keeping the discovered links and the scraped states of the run")
+parser.add_argument("--resume", action="store_true",
+                    help="continue the last run from the frontier instead of starting over")
+parser.add_argument("--output-format", choices=['csv','parquet','listing'], default=os.getenv("SCRAPER_OUTPUT_FORMAT", "csv"),
+                    help="csv file, parquet dataset or canonical listings parquet file, written while the states are scraped")
+parser.add_argument("--batch-size", type=int, default=int(os.getenv("SCRAPER_BATCH_SIZE", "100")),
+                    help="number of scraped states written to the output at once")
+parser.add_argument("--browser", choices=['firefox','chrome'], default=os.getenv("SCRAPER_BROWSER", "firefox"),
+                    help="browser driven by selenium (drivers from GECKODRIVER_PATH / CHROMEDRIVER_PATH, the path cached by the last run or the PATH)")
+parser.add_argument("--lean", action="store_true", default=os.getenv("SCRAPER_LEAN")=="1",
+                    help="eager page loads without images, media, fonts, disk cache or third-party hosts")
+parser.add_argument("--role", choices=['standalone','coordinator','worker'], default=os.getenv("SCRAPER_ROLE", "standalone"),
+                    help="coordinator: discover the links and serve them to workers, worker: scrape links pulled from --queue")
+parser.add_argument("--queue", default=os.getenv("SCRAPER_QUEUE"),
+                    help="queue of a worker: http://coordinator:port, or the frontier file when it is on the same host")
+parser.add_argument("--queue-port", type=int, default=int(os.getenv("SCRAPER_QUEUE_PORT", "8765")),
+                    help="port the coordinator serves its queue on")
+parser.add_argument("--queue-host", default=os.getenv("SCRAPER_QUEUE_HOST", "127.0.0.1"),
+                    help="interface the coordinator serves its queue on, 0.0.0.0 for workers on other hosts (needs --queue-token)")
+parser.add_argument("--queue-token", default=os.getenv("SCRAPER_QUEUE_TOKEN"),
+                    help="secret shared by the coordinator and its workers, sent with every request to the queue")
+parser.add_argument("--lease", type=int, default=int(os.getenv("SCRAPER_LEASE", "300")),
+                    help="seconds a worker keeps a link before it is handed to another worker")
+parser.add_argument("--rate", type=float, default=float(os.getenv("SCRAPER_RATE", "2")),
+                    help="starting number of requests per second to a host, adjusted on the fly")
+parser.add_argument("--max-rate", type=float, default=float(os.getenv("SCRAPER_MAX_RATE", "20")),
+                    help="highest number of requests per second to a host")
+parser.add_argument("--retries", type=int, default=int(os.getenv("SCRAPER_RETRIES", "3")),
+                    help="times a failing state is tried again, with exponential backoff, before going to the dead letter file (and a failing listing page of the async discovery before it stops)")
+parser.add_argument("--dead-letter", default=os.getenv("SCRAPER_DEAD_LETTER", "properstar_dead_letter.jsonl"),
+                    help="json lines file of the states given up, their page snapshots go to the folder of the same name")
+parser.add_argument("--metrics-dir", default=os.getenv("SCRAPER_METRICS_DIR", "."),
+                    help="folder of the json log (properstar_metrics.jsonl) and of the prometheus file (properstar.prom), e.g. the node_exporter textfile folder")
+parser.add_argument("--metrics-every", type=float, default=float(os.getenv("SCRAPER_METRICS_EVERY", "15")),
+                    help="seconds between two progress lines / prometheus file updates")
+parser.add_argument("--base-url", default=os.getenv("SCRAPER_BASE_URL"),
+                    help="scrape a copy of the site served elsewhere instead of https://www.properstar.fr (e.g. the benchmark server)")
+parser.add_argument("--archive", default=os.getenv("SCRAPER_ARCHIVE"),
+                    help="folder of a compressed archive keeping every fetched page, to extract them again later with reextract.py")
+parser.add_argument("--recycle-pages", type=int, default=int(os.getenv("SCRAPER_RECYCLE_PAGES", "1000")),
+                    help="pages a browser opens before it is replaced by a fresh one, 0 keeps it for the whole run")
+parser.add_argument("--recycle-rss", type=int, default=int(os.getenv("SCRAPER_RECYCLE_RSS", "1500")),
+                    help="memory (MB) of a browser and its driver above which it is replaced by a fresh one, 0 for no limit")
+parser.add_argument("--warm-browser", action="store_true", default=os.getenv("SCRAPER_WARM_BROWSER")=="1",
+                    help="always keep a browser started in the background, so new and recycled browsers are ready at once")
+parser.add_argument("--sections", default=os.getenv("SCRAPER_SECTIONS", SECTIONS_PATH),
+                    help="csv table of the sections (site, statut, url with {page}, output), the properstar rows are scraped")
+parser.add_argument("--only", default=os.getenv("SCRAPER_ONLY"),
+                    help="outputs of the sections to scrape, separated by commas (all the properstar sections by default)")
+parser.add_argument("--concurrent-sections", type=int, default=int(os.getenv("SCRAPER_CONCURRENT_SECTIONS", "1")),
+                    help="sections discovered at the same time, each in its own browser, while the --workers browsers scrape the detail pages of all of them")
+parser.add_argument("--snapshot", action="store_true", default=os.getenv("SCRAPER_SNAPSHOT")=="1",
+                    help="only read the cards of the listing pages (title, price, surface, address) into <output>_snapshot, no detail page is opened")
+parser.add_argument("--history", default=os.getenv("SCRAPER_HISTORY"),
+                    help="folder of the price history every crawl is appended to (date partitioned parquet + latest state index), see history.py")
+parser.add_argument("--gazetteer", default=os.getenv("SCRAPER_GAZETTEER", GAZETTEER_PATH),
+                    help="csv of tunisian places giving the city, governorate, latitude and longitude columns of every state from its address, empty to leave them out")
+args = parser.parse_args()
+rate_limiter.configure(rate=args.rate,max_rate=args.max_rate)
+browser.configure(max_pages=args.recycle_pages,max_rss_mb=args.recycle_rss)
 # Correct ChromeDriver path
 path = os.getenv("CHROMEDRIVER_PATH")
 
-# Set up Chrome options
-options = Options()
-options.headless = True  # Run in headless mode (no browser UI)
-options.add_argument("--disable-gpu")  # Disable GPU (fixes some headless issues)
-options.add_argument("--no-sandbox")  # Avoid sandboxing issues
-options.add_argument("--disable-dev-shm-usage")  # Improve performance in Docker/Linux
-
 # 🚀 Setup WebDriver
-service = Service(GeckoDriverManager().install())
-driver = webdriver.Firefox(service=service, options=options)
-#setting up variables that contain page links , file names
-statut_lst=['Commercial','Commercial','Location','vente']
-website_link_lst=['https://www.properstar.fr/tunisie/louer/commercial?p=','https://www.properstar.fr/tunisie/acheter/commercial?p=','https://www.properstar.fr/tunisie/louer/appartement-maison?p=','https://www.properstar.fr/tunisie/acheter/appartement-maison?p=']
-csv_name_lst=['properstar_commercial_location.csv','properstar_commercial_vente.csv','properstar_location.csv','properstar_vente.csv']
+# with the lean profile only the site itself is reachable (plus the hosts of SCRAPER_ALLOWED_HOSTS, e.g. a script cdn)
+allowed_hosts=['properstar.fr','properstar.com']+([urlparse(args.base_url).hostname] if args.base_url else [])+[host for host in os.getenv("SCRAPER_ALLOWED_HOSTS","").split(",") if host]
+new_driver=new_driver_factory(args.browser,args.lean,allowed_hosts,args.warm_browser)
+browser_stats=BrowserStats('lean' if args.lean else 'full','properstar_browser_stats.json')
+dead_letter=DeadLetter(args.dead_letter)
+metrics=Metrics('properstar',os.path.join(args.metrics_dir,'properstar_metrics.jsonl'),os.path.join(args.metrics_dir,'properstar.prom'),args.metrics_every)
+archive=PageArchive(args.archive) if args.archive else None
+gazetteer=Gazetteer(args.gazetteer) if args.gazetteer else None
+history=PriceHistory(args.history) if args.history else None
+# sections whose listing pages were not all read, their crawl does not delist anything
+lost_sections=set()
+sitemap=SitemapDiscovery(args.sitemap or (args.base_url.rstrip('/') if args.base_url else SITE_URL)+'/sitemap.xml',base_url=args.base_url) if args.discovery=='sitemap' else None
+#setting up variables that contain page links , file names (from the section table)
+try:
+    sections=load_sections(args.sections,'properstar',args.only)
+except ValueError as error:
+    parser.error(str(error))
+if any(not section['url'].endswith('{page}') for section in sections):
+    parser.error("the properstar urls of "+args.sections+" must end with {page}, the page number is appended to them")
+statut_lst=[section['statut'] for section in sections]
+website_link_lst=[section['url'][:-len('{page}')] for section in sections]
+if args.base_url:
+    website_link_lst=[link.replace('https://www.properstar.fr',args.base_url.rstrip('/')) for link in website_link_lst]
+csv_name_lst=[section['output'] for section in sections]
+engine_lst=args.engine.split(',')
+if len(engine_lst)==1:
+    engine_lst=engine_lst*len(website_link_lst)
+if len(engine_lst)!=len(website_link_lst) or any(engine not in engines for engine in engine_lst):
+    parser.error("--engine takes one of "+", ".join(engines)+" for all sections or one per section")
+if args.snapshot and args.role!='standalone':
+    parser.error("--snapshot does not use the detail workers, it runs standalone")
+if args.role=='coordinator' and args.queue_host not in LOOPBACK_HOSTS and not args.queue_token:
+    parser.error("--queue-host "+args.queue_host+" lets other hosts reach the queue, it needs --queue-token")
+if args.role=='worker':
+    # links come from the coordinator, the outputs are written by the coordinator
+    queue=open_queue(args.queue or args.frontier,token=args.queue_token)
+    scrape_states={csv_name_lst[p]:wrap_engine(engine_lst[p],csv_name_lst[p]) for p in range(len(csv_name_lst))}
+    for worker_thread in start_workers(queue,scrape_states,new_driver,args.workers,args.lease):
+        worker_thread.join()
+    browser_stats.report()
+    dead_letter.summary()
+    metrics.report()
+    if archive is not None:
+        archive.close()
+    raise SystemExit(0)
+# one browser per thread for the listing pages, the sections may be discovered in parallel
+driver = ThreadDrivers(new_driver)
+if args.snapshot:
+    snapshot_at=snapshot_time()
+    if args.concurrent_sections>1:
+        with ThreadPoolExecutor(max_workers=args.concurrent_sections,thread_name_prefix="section") as executor:
+            for future in [executor.submit(snapshot_section,p,True) for p in range(len(csv_name_lst))]:
+                future.result()
+    else:
+        for p in range(len(csv_name_lst)):
+            snapshot_section(p)
+    print("end of snapshot")
+    browser_stats.report()
+    metrics.report()
+    rate_limiter.report()
+    if archive is not None:
+        archive.close()
+    if history is not None:
+        history.close()
+    driver.quit()
+    raise SystemExit(0)
+frontier=Frontier(args.frontier)
+if args.role=='coordinator':
+    serve_queue(frontier,args.queue_host,args.queue_port,args.queue_token)
+    # the workers of this host pull from the frontier directly, until every section is scraped: a long discovery
+    # must not leave them idle past an idle timeout before its first links are queued
+    scraped=threading.Event()
+    scrape_states={csv_name_lst[p]:wrap_engine(engine_lst[p],csv_name_lst[p]) for p in range(len(csv_name_lst))}
+    local_workers=start_workers(frontier,scrape_states,new_driver,args.workers,args.lease,stop=scraped)
 # scraping websites
-for p in range(4):
-    print("start scraping ",website_link_lst[p])
-    property_details_lst=get_states_links_statut(website_link_lst[p],statut_lst[p])
-    print("Number of states to scrape: ",len(property_details_lst))
-    property_details_lst=get_states_details(property_details_lst)
-    print("end scraping ",website_link_lst[p])
-    #creating the dataframe and transform it into a csv file
-    df=pd.DataFrame(property_details_lst)
-    df.to_csv(csv_name_lst[p],index=False)
+if args.role=='standalone' and args.concurrent_sections>1:
+    # every section is discovered at the same time and one pool of browsers scrapes the links of all of them,
+    # so a browser never idles while a section waits on its listing pages
+    scrape_states={csv_name_lst[p]:wrap_engine(engine_lst[p],csv_name_lst[p]) for p in range(len(csv_name_lst))}
+    discovered=threading.Event()
+    local_workers=start_workers(frontier,scrape_states,new_driver,args.workers,args.lease,poll=1,stop=discovered)
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrent_sections,thread_name_prefix="section") as executor:
+            for future in [executor.submit(queue_section,p) for p in range(len(csv_name_lst))]:
+                future.result()
+    finally:
+        # the workers leave once the frontier has nothing left for them
+        discovered.set()
+        for worker_thread in local_workers:
+            worker_thread.join()
+    for p in range(len(csv_name_lst)):
+        write_from_frontier(p)
+else:
+    try:
+        for p in range(len(csv_name_lst)):
+            section=csv_name_lst[p]
+            property_details_lst=discover_section(p)
+            if args.role=='coordinator':
+                # queueing the links is enough, the workers scrape them while the next section is discovered
+                for property_details_dic in property_details_lst:
+                    pass
+                continue
+            #the states scraped by the interrupted run go first, then every state as soon as it is scraped
+            sink=open_output(csv_name_lst[p])
+            if args.resume:
+                for property_details_dic in frontier.rows(section):
+                    sink.write(property_details_dic)
+            for property_details_dic in get_states_details(property_details_lst,args.workers,engine_lst[p],frontier,section):
+                sink.write(property_details_dic)
+            close_output(sink,section,frontier)
+            print("Number of states written: ",sink.rows,frontier.counts(section))
+            print("end scraping ",website_link_lst[p])
+    except BaseException:
+        # the workers of this host would wait for links that will not come
+        if args.role=='coordinator':
+            scraped.set()
+        raise
+if args.role=='coordinator':
+    try:
+        wait_for_sections(frontier,csv_name_lst)
+    finally:
+        scraped.set()
+    for p in range(len(csv_name_lst)):
+        write_from_frontier(p)
+    for worker_thread in local_workers:
+        worker_thread.join()
 print("end of scraping")
+browser_stats.report()
+dead_letter.summary()
+metrics.report()
+rate_limiter.report()
+frontier.close()
+if archive is not None:
+    archive.close()
+if history is not None:
+    history.close()
 # Close the driver
 driver.quit()
\ No newline at end of file
@@ -0,0 +1,207 @@
+import asyncio
+import math
+import queue
+import re
+import threading
+from urllib.parse import urljoin, urlparse, parse_qs, parse_qsl, urlencode
+import aiohttp
+from lxml import html
+from properstar_lxml import HEADERS
+import rate_limiter
+from snapshot import card_surface
+
+STATE_XPATH = '//article[@class="item-adaptive card-basic vendor-hidden"]'
+LINK_XPATH = './/a[@class="link"]/@href'
+# fields of a card read by the snapshot mode, the title falls back on the text of the link
+CARD_XPATHS = {
+    'title': './/*[contains(@class, "title")]',
+    'prix': './/*[contains(@class, "price")]',
+    'address': './/*[contains(@class, "address") or contains(@class, "location")]',
+}
+# "1 234 annonces" / "56 résultats" in the result header
+RESULT_COUNT_RE = re.compile(r'(\d[\d\s.]*)\s*(?:annonces|résultats|biens)', re.IGNORECASE)
+
+
+def node_text(node):
+    return " ".join(node.text_content().split())
+
+
+def parse_card(state, link):
+    """
+    This function responsible for reading what the card of a state shows on a listing page: title, price,
+    surface and address as the page writes them, "" for the ones it does not show.
+    """
+    card = {'link': link}
+    for field, xpath in CARD_XPATHS.items():
+        nodes = state.xpath(xpath)
+        card[field] = node_text(nodes[0]) if nodes else ""
+    if not card['title']:
+        card['title'] = node_text(state.xpath('.//a[@class="link"]')[0])
+    # every text node apart, "S+3" and "145 m²" in two tags must not read "S+3145 m²"
+    card['surface'] = card_surface(" ".join(state.itertext()))
+    return card
+
+
+def parse_listing_page(page_source, page_url, cards=False):
+    """
+    This function responsible for reading the state links of one listing page (the card dictionaries of
+    parse_card with cards) and, when the page tells it, the number of the last page (from the pager or the result count).
+    """
+    tree = html.fromstring(page_source)
+    links = []
+    for state in tree.xpath(STATE_XPATH):
+        hrefs = state.xpath(LINK_XPATH)
+        if hrefs:
+            link = urljoin(page_url, hrefs[0])
+            links.append(parse_card(state, link) if cards else link)
+    last_page = None
+    for href in tree.xpath('//a[contains(@href, "p=")]/@href'):
+        for page in parse_qs(urlparse(href).query).get('p', []):
+            if page.isdigit():
+                last_page = max(last_page or 0, int(page))
+    match = RESULT_COUNT_RE.search(" ".join(tree.text_content().split()))
+    if match and links:
+        count = int(re.sub(r'\D', '', match.group(1)))
+        last_page = max(last_page or 0, math.ceil(count / len(links)))
+    return links, last_page
+
+
+def section_page(url):
+    """(path and query of a listing page url without its page parameter, page number or None)."""
+    parts = urlparse(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    pages = [value for key, value in query if key == 'p' and value.isdigit()]
+    section = parts._replace(scheme='', netloc='', query=urlencode([(key, value) for key, value in query if key != 'p']))
+    return section.geturl(), int(pages[0]) if pages else None
+
+
+async def fetch_page(session, url, retries=3):
+    """
+    This function responsible for downloading one listing page, None means there is no such page.
+    A timeout, a 429 or a 5xx is tried again after the backoff of the rate limiter, up to retries attempts.
+    """
+    throttle = rate_limiter.for_url(url)
+    for attempt in range(1, retries + 1):
+        start = await throttle.acquire_async()
+        try:
+            async with session.get(url) as response:
+                page_source = await response.read()
+        except (asyncio.TimeoutError, aiohttp.ClientError) as error:
+            throttle.release(start, timeout=isinstance(error, asyncio.TimeoutError))
+            if attempt == retries:
+                raise
+            print("page ", url, " failed (", repr(error), "), attempt ", attempt, " of ", retries)
+            continue
+        throttle.release(start, response.status, retry_after=rate_limiter.retry_after(response.headers))
+        if attempt < retries and (response.status == 429 or response.status >= 500):
+            print("page ", url, " answered ", response.status, ", attempt ", attempt, " of ", retries)
+            continue
+        break
+    if response.status == 404:
+        return None
+    response.raise_for_status()
+    if str(response.url) != url:
+        # pages past the end are redirected back to the first one, any other redirect is followed
+        section, page = section_page(url)
+        redirected_section, redirected_page = section_page(str(response.url))
+        if page != 1 and redirected_section == section and redirected_page in (None, 1):
+            return None
+    return page_source
+
+
+async def iter_states_links(website_link, statut_ch, max_in_flight=8, on_page=None, cards=False, retries=3,
+                            on_lost=None):
+    """
+    This function responsible for yielding the {'statut', 'link'} dictionaries of a section,
+    page after page, while up to max_in_flight listing pages are downloaded at the same time.
+    on_page(url, page_source) receives every listing page downloaded (the page archive).
+    With cards the dictionaries also have the fields shown by the cards (parse_card).
+    A page still failing after retries attempts (fetch_page) ends the discovery with its error.
+    on_lost(page_number) is called when a page shows no state before the last page told by the first one,
+    the section ends there but was not read to its end.
+    """
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout) as session:
+        first_url = website_link + "1"
+        first_page = await fetch_page(session, first_url, retries)
+        if first_page is None:
+            return
+        if on_page is not None:
+            on_page(first_url, first_page)
+        links, last_page = parse_listing_page(first_page, first_url, cards)
+        announced_last_page = last_page
+        print("Getting state links from page number 1, last page ", last_page or "unknown")
+        seen = set()
+        pages = {1: links}
+        tasks = {}
+        next_page = 2
+        next_to_yield = 1
+        try:
+            while True:
+                # without a known last page keep probing, the first empty page ends the section
+                while len(tasks) < max_in_flight and (last_page is None or next_page <= last_page):
+                    url = website_link + str(next_page)
+                    tasks[asyncio.ensure_future(fetch_page(session, url, retries))] = (next_page, url)
+                    next_page += 1
+                while next_to_yield in pages:
+                    for item in pages.pop(next_to_yield):
+                        link = item['link'] if cards else item
+                        if link not in seen:
+                            seen.add(link)
+                            yield dict({'statut': statut_ch}, **item) if cards else {'statut': statut_ch, 'link': link}
+                    next_to_yield += 1
+                if not tasks:
+                    break
+                finished, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    page_number, url = tasks.pop(task)
+                    page_source = task.result()
+                    if on_page is not None and page_source is not None:
+                        on_page(url, page_source)
+                    links = parse_listing_page(page_source, url, cards)[0] if page_source is not None else []
+                    print("Getting state links from page number ", page_number, ": ", len(links))
+                    if not links and announced_last_page is not None and page_number <= announced_last_page \
+                            and (last_page is None or page_number <= last_page) and on_lost is not None:
+                        on_lost(page_number)
+                    if not links:
+                        last_page = page_number - 1 if last_page is None else min(last_page, page_number - 1)
+                    pages[page_number] = links
+                if last_page is not None:
+                    for task, (page_number, url) in list(tasks.items()):
+                        if page_number > last_page:
+                            task.cancel()
+                            del tasks[task]
+                    for page_number in [page for page in pages if page > last_page]:
+                        del pages[page_number]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def stream_states_links(website_link, statut_ch, max_in_flight=8, on_page=None, cards=False, retries=3, on_lost=None):
+    """
+    This function responsible for running iter_states_links in a background thread and yielding
+    its dictionaries to synchronous code, so detail scraping starts before discovery finishes.
+    """
+    records = queue.Queue()
+    end = object()
+
+    def run():
+        async def pump():
+            async for record in iter_states_links(website_link, statut_ch, max_in_flight, on_page, cards, retries, on_lost):
+                records.put(record)
+        try:
+            asyncio.run(pump())
+        except Exception as error:
+            records.put(error)
+        records.put(end)
+
+    threading.Thread(target=run, name="discovery", daemon=True).start()
+    while True:
+        record = records.get()
+        if record is end:
+            return
+        if isinstance(record, Exception):
+            raise record
+        yield record
@@ -0,0 +1,98 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from lxml import html
+import rate_limiter
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "fr-FR,fr;q=0.9,en;q=0.5",
+}
+
+session = None
+session_lock = threading.Lock()
+
+
+class MissingNodes(Exception):
+    """The page does not contain the nodes the lxml path knows how to read."""
+
+
+def get_session(pool_size=10):
+    """
+    This function responsible for returning the keep-alive session shared by every worker.
+    """
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+    return session
+
+
+def node_text(node):
+    # same whitespace handling as selenium's WebElement.text on a single line element
+    return " ".join(node.text_content().split())
+
+
+def parse_state_details(page_source, property_details_dic):
+    """
+    This function responsible for filling the detail fields of property_details_dic from the html of a detail page,
+    with the same xpaths and the same dictionary layout as properstar.get_state_details.
+    Raises MissingNodes when the page is not the server rendered layout we expect.
+    """
+    tree = html.fromstring(page_source)
+    titles = tree.xpath('//div[@class="main-info"]/h1')
+    if not titles:
+        raise MissingNodes("no main-info title")
+    property_details_dic['title'] = node_text(titles[0])
+    addresses = tree.xpath('//span[@class="item-info-address-inner-address"]')
+    property_details_dic['address'] = node_text(addresses[0]) if addresses else ""
+    prices = tree.xpath('//div[@class="listing-price-main"]/span')
+    property_details_dic['prix'] = node_text(prices[0]) if prices else 0
+    for detail in tree.xpath('//div[@class="feature-content"]'):
+        keys = detail.xpath('.//span[@class="property-key"]')
+        values = detail.xpath('.//span[@class="property-value"]')
+        if not values:
+            # nothing to read in this feature, same as the WebDriver path
+            continue
+        if keys:
+            property_details_dic[node_text(keys[0])] = node_text(values[0])
+        else:
+            key = node_text(values[0])
+            value = 1
+            property_details_dic[key] = key
+            property_details_dic[value] = value
+    return property_details_dic
+
+
+def get_state_details(driver, property_details_dic, fallback, timeout=30, on_page=None):
+    """
+    This function responsible for filling one dictionary of property_details_lst over plain http.
+    When the page is missing the expected nodes, fallback(driver, property_details_dic) is used instead
+    (the WebDriver path), paced by the same throttle of the host as the http requests.
+    Http errors are raised, a throttling site would not answer the browser better.
+    on_page(url, page_source) receives every page parsed successfully (the page archive).
+    """
+    print(property_details_dic['link'])
+    throttle = rate_limiter.for_url(property_details_dic['link'])
+    start = throttle.acquire()
+    try:
+        response = get_session().get(property_details_dic['link'], timeout=timeout)
+    except requests.RequestException as error:
+        throttle.release(start, timeout=isinstance(error, requests.Timeout))
+        raise
+    throttle.release(start, response.status_code, retry_after=rate_limiter.retry_after(response.headers))
+    response.raise_for_status()
+    try:
+        # parse into a copy so a half filled dictionary never reaches the fallback
+        scraped_dic = parse_state_details(response.content, dict(property_details_dic))
+    except MissingNodes as error:
+        print("http engine failed (", error, "), falling back to the browser")
+        return throttle.track(fallback)(driver, property_details_dic)
+    if on_page is not None:
+        on_page(property_details_dic['link'], response.content)
+    return scraped_dic
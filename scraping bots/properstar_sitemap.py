@@ -0,0 +1,208 @@
+import argparse
+import collections
+import gzip
+import io
+import re
+import threading
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urljoin, urlparse, unquote
+from urllib.request import url2pathname
+from listing import normalize_label
+import rate_limiter
+
+SITE_URL = 'https://www.properstar.fr'
+SITEMAP_URL = SITE_URL + '/sitemap.xml'
+# words of a url telling its transaction and its kind of property, the sections of the table use the same ones
+TRANSACTION_WORDS = {'louer': {'louer', 'location', 'rent', 'rental'},
+                     'acheter': {'acheter', 'vendre', 'vente', 'buy', 'sale'}}
+KIND_WORDS = {'commercial': {'commercial', 'commerce', 'bureau', 'bureaux', 'local', 'locaux', 'boutique', 'magasin',
+                             'entrepot', 'hangar', 'usine', 'office'},
+              'appartement-maison': {'appartement', 'maison', 'villa', 'duplex', 'triplex', 'studio', 'penthouse',
+                                     'loft', 'chalet', 'house', 'apartment'}}
+COUNTRY_WORDS = {'tunisie', 'tunisia'}
+# the page of one listing, not a result page: an /annonce/ (or /listing/) path, or one ending with its numeric id
+LISTING_RE = re.compile(r'/(?:annonce|listing)/|/\d{4,}/?$|-\d{5,}/?$')
+# child sitemaps that cannot hold listings are not downloaded
+SKIPPED_SITEMAP_RE = re.compile(r'blog|agenc|article|news|guide', re.IGNORECASE)
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class HeadStream(io.RawIOBase):
+    """A stream whose first bytes were already read (to look for the gzip magic), they are given back first."""
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.head:
+            size = min(len(buffer), len(self.head))
+            buffer[:size] = self.head[:size]
+            self.head = self.head[size:]
+            return size
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+def open_location(location, session=None, timeout=60):
+    """
+    This function responsible for opening a sitemap as a binary stream: an http(s) url (streamed, never held in
+    memory whole), a file:// url or a local path. Gzipped sitemaps (.xml.gz served as is) are decompressed on the fly.
+    """
+    scheme = urlparse(location).scheme
+    if scheme in ('http', 'https'):
+        if session is None:
+            from properstar_lxml import get_session
+            session = get_session()
+        throttle = rate_limiter.for_url(location)
+        start = throttle.acquire()
+        try:
+            response = session.get(location, stream=True, timeout=timeout)
+        except Exception:
+            throttle.release(start, timeout=True)
+            raise
+        throttle.release(start, response.status_code, retry_after=rate_limiter.retry_after(response.headers))
+        response.raise_for_status()
+        # a Content-Encoding: gzip is undone by urllib3, a gzip file is undone below
+        response.raw.decode_content = True
+        stream = response.raw
+    elif scheme == 'file':
+        stream = open(url2pathname(urlparse(location).path), 'rb')
+    else:
+        stream = open(location, 'rb')
+    head = stream.read(2)
+    stream = HeadStream(head, stream)
+    if head == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=stream), stream
+    return stream, stream
+
+
+def iter_sitemap(location, session=None, skip=SKIPPED_SITEMAP_RE, on_error=None):
+    """
+    This function responsible for yielding the (url, lastmod) of every page of a sitemap, following the sitemap
+    indexes down to their url sets. The xml is parsed while it streams in and every entry is dropped once read,
+    so the memory does not grow with the size of the sitemap. A child sitemap that fails is given to
+    on_error(location, error) and skipped when on_error is set, else its error is raised.
+    """
+    children = []
+    source, stream = open_location(location, session)
+    try:
+        root = None
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if root is None:
+                root = element
+            if event != 'end':
+                continue
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag not in ('url', 'sitemap'):
+                continue
+            fields = {child.tag.rsplit('}', 1)[-1]: (child.text or '').strip() for child in element}
+            if fields.get('loc'):
+                if tag == 'url':
+                    yield fields['loc'], fields.get('lastmod')
+                else:
+                    children.append(urljoin(location, fields['loc']))
+            root.clear()
+    finally:
+        source.close()
+        stream.close()
+    for child in children:
+        if skip is not None and skip.search(child):
+            continue
+        try:
+            yield from iter_sitemap(child, session, skip, on_error)
+        except Exception as error:
+            if on_error is None:
+                raise
+            on_error(child, error)
+
+
+def url_words(url):
+    return set(re.split(r'[^a-z0-9]+', normalize_label(unquote(urlparse(url).path))))
+
+
+def section_key(url):
+    """(transaction, kind) told by a url, a listing or a result page of the section table, None for what it does not tell."""
+    words = url_words(url)
+    transaction = next((name for name, names in TRANSACTION_WORDS.items() if words & names), None)
+    kind = next((name for name, names in KIND_WORDS.items() if words & names), None)
+    return transaction, kind
+
+
+class SitemapDiscovery:
+    """
+    Links of the properstar sections taken from the sitemap instead of the result pages, so a listing moving
+    between pages while they are read is neither missed nor seen twice. The sitemap is read once for every
+    section: the first one asking for its links walks it and every tunisian listing url goes to the section
+    of its transaction and kind. skipped counts the urls that fit no section, by reason, failed lists the
+    child sitemaps that could not be read (the sections are then not complete).
+    """
+    def __init__(self, location=SITEMAP_URL, session=None, base_url=None):
+        self.location = location
+        self.session = session
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.sections = None
+        self.skipped = collections.Counter()
+        self.failed = []
+
+    def load(self):
+        sections = collections.defaultdict(dict)
+        for url, lastmod in iter_sitemap(self.location, self.session, on_error=self.child_failed):
+            if not LISTING_RE.search(urlparse(url).path):
+                self.skipped['not a listing'] += 1
+                continue
+            if not url_words(url) & COUNTRY_WORDS:
+                self.skipped['not in tunisia'] += 1
+                continue
+            key = section_key(url)
+            if None in key:
+                self.skipped['no section'] += 1
+                continue
+            if self.base_url:
+                url = url.replace(SITE_URL, self.base_url.rstrip('/'))
+            # the urls of a section in sitemap order, once each
+            sections[key][url] = lastmod
+        self.sections = sections
+        print("sitemap ", self.location, ": ", {"/".join(key): len(urls) for key, urls in sections.items()},
+              ", skipped ", dict(self.skipped))
+
+    def child_failed(self, location, error):
+        print("sitemap ", location, " skipped: ", repr(error))
+        self.failed.append(location)
+
+    def states_links(self, website_link, statut_ch):
+        """
+        This function responsible for the {'statut', 'link'} dictionaries of the section of website_link
+        (the url of its result pages in the section table).
+        """
+        with self.lock:
+            if self.sections is None:
+                self.load()
+        key = section_key(website_link)
+        if None in key:
+            raise ValueError("the url %s tells no transaction and kind of property" % website_link)
+        return [{'statut': statut_ch, 'link': link} for link in self.sections.get(key, {})]
+
+
+if __name__ == '__main__':
+    from scheduler import load_sections, SECTIONS_PATH
+    parser = argparse.ArgumentParser(description="Count the listings of every properstar section found in a sitemap (an url or a local file)")
+    parser.add_argument("sitemap", nargs='?', default=SITEMAP_URL, help="sitemap or sitemap index, .xml or .xml.gz")
+    parser.add_argument("--sections", default=SECTIONS_PATH, help="csv table of the sections")
+    parser.add_argument("--links", action="store_true", help="print the links of every section too")
+    args = parser.parse_args()
+    discovery = SitemapDiscovery(args.sitemap)
+    for section in load_sections(args.sections, 'properstar'):
+        links = discovery.states_links(section['url'], section['statut'])
+        print(section['output'], ": ", len(links), " listings")
+        if args.links:
+            for property_details_dic in links:
+                print("    ", property_details_dic['link'])
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+# starting point and bounds of every host, changed with configure()
+settings = {'rate': 2.0, 'concurrency': 4, 'min_rate': 0.1, 'max_rate': 20.0, 'max_concurrency': 32,
+            'target_latency': 3.0, 'log_every': 30.0}
+throttles = {}
+throttles_lock = threading.Lock()
+
+
+class HostThrottle:
+    """
+    Request rate and concurrency of one host, adjusted on the fly with additive increase / multiplicative decrease:
+    every fast answer raises the rate a little, a 429, a 5xx or a timeout halves the rate and the concurrency and
+    pauses the host for a while (Retry-After when the site sends one), slow answers lower the rate gently.
+    """
+    def __init__(self, host):
+        self.host = host
+        self.condition = threading.Condition()
+        self.rate = settings['rate']
+        self.concurrency = settings['concurrency']
+        self.in_flight = 0
+        self.next_send = 0.0
+        self.backoff_until = 0.0
+        self.strikes = 0
+        self.successes = 0
+        self.requests = 0
+        self.throttled = 0
+        self.last_log = time.monotonic()
+
+    def try_acquire(self):
+        """Takes a slot and returns 0, or returns the number of seconds to wait before trying again."""
+        with self.condition:
+            now = time.monotonic()
+            delay = max(self.backoff_until, self.next_send) - now
+            if self.in_flight >= self.concurrency:
+                return max(delay, 0.05)
+            if delay > 0:
+                return delay
+            self.in_flight = self.in_flight + 1
+            self.next_send = now + 1.0 / self.rate
+            return 0
+
+    def acquire(self):
+        """Blocks until the host accepts one more request, returns the start time to give back to release()."""
+        while True:
+            delay = self.try_acquire()
+            if delay == 0:
+                return time.monotonic()
+            with self.condition:
+                self.condition.wait(delay)
+
+    async def acquire_async(self):
+        while True:
+            delay = self.try_acquire()
+            if delay == 0:
+                return time.monotonic()
+            await asyncio.sleep(delay)
+
+    def release(self, start, status=None, timeout=False, retry_after=None):
+        """
+        Gives the slot back and adapts the rate to how the request went:
+        status is the http status when known, timeout tells the request timed out.
+        """
+        now = time.monotonic()
+        latency = now - start
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            self.requests = self.requests + 1
+            if timeout or status == 429 or (status is not None and status >= 500):
+                self.throttled = self.throttled + 1
+                self.strikes = self.strikes + 1
+                self.successes = 0
+                self.rate = max(settings['min_rate'], self.rate / 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                pause = retry_after if retry_after is not None else min(120.0, 2.0 ** self.strikes)
+                self.backoff_until = max(self.backoff_until, now + pause)
+                self.log("backing off " + str(round(pause, 1)) + "s after " + ("timeout" if timeout else str(status)))
+            elif latency > settings['target_latency']:
+                self.successes = 0
+                self.rate = max(settings['min_rate'], self.rate * 0.9)
+            else:
+                self.strikes = 0
+                self.successes = self.successes + 1
+                self.rate = min(settings['max_rate'], self.rate + 0.1)
+                if self.successes >= 4 * self.concurrency and self.concurrency < settings['max_concurrency']:
+                    self.concurrency = self.concurrency + 1
+                    self.successes = 0
+            if now - self.last_log > settings['log_every']:
+                self.log("")
+            self.condition.notify_all()
+
+    def log(self, event):
+        # called with the condition held
+        self.last_log = time.monotonic()
+        print("rate limiter ", self.host, ": ", event + (", " if event else ""), "rate ", round(self.rate, 2),
+              "/s, concurrency ", self.concurrency, ", in flight ", self.in_flight,
+              ", backoff ", round(max(0.0, self.backoff_until - self.last_log), 1), "s, ",
+              self.throttled, "/", self.requests, " throttled")
+
+    def state(self):
+        with self.condition:
+            return {'host': self.host, 'rate': self.rate, 'concurrency': self.concurrency, 'in_flight': self.in_flight,
+                    'backoff': max(0.0, self.backoff_until - time.monotonic()),
+                    'requests': self.requests, 'throttled': self.throttled}
+
+    def track(self, scrape_state):
+        """
+        Wraps scrape_state(driver, property_details_dic) so every detail page visit goes through the throttle.
+        The browser does not tell the http status, only timeouts and latency drive the rate.
+        """
+        def scrape_throttled(driver, property_details_dic):
+            start = self.acquire()
+            try:
+                property_details_dic = scrape_state(driver, property_details_dic)
+            except Exception as error:
+                self.release(start, timeout='timeout' in type(error).__name__.lower() or 'timed out' in str(error).lower())
+                raise
+            self.release(start)
+            return property_details_dic
+        return scrape_throttled
+
+
+def configure(**values):
+    """Sets the starting rate/concurrency and the bounds of the throttles created afterwards."""
+    settings.update({key: value for key, value in values.items() if value is not None})
+
+
+def for_url(url):
+    """
+    This function responsible for returning the throttle shared by every request to the host of url.
+    """
+    host = urlparse(url).hostname or url
+    with throttles_lock:
+        if host not in throttles:
+            throttles[host] = HostThrottle(host)
+        return throttles[host]
+
+
+def retry_after(headers):
+    """Seconds of a Retry-After header, None when missing or given as a date."""
+    value = headers.get('Retry-After')
+    if value is not None and value.strip().isdigit():
+        return float(value)
+    return None
+
+
+def throttled(scrape_state):
+    """Same as HostThrottle.track, with the throttle of each state's own link."""
+    def scrape_throttled(driver, property_details_dic):
+        return for_url(property_details_dic['link']).track(scrape_state)(driver, property_details_dic)
+    return scrape_throttled
+
+
+def report():
+    for throttle in list(throttles.values()):
+        with throttle.condition:
+            throttle.log("end of run")
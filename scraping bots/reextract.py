@@ -0,0 +1,72 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+from archive import archived_pages, read_page
+from sinks import open_sink
+from geocoder import Gazetteer, GAZETTEER_PATH
+import properstar_lxml
+import remax_lxml
+
+# same xpaths and dictionary layout as the get_state_details of each scraper
+PARSERS = {'properstar': properstar_lxml.parse_state_details, 'remax': remax_lxml.parse_state_details}
+
+
+def extract_page(task):
+    """
+    This function responsible for extracting one archived detail page, in a worker process.
+    Returns the section, the scraped dictionary (None when the page could not be read) and the error.
+    """
+    site, path, page = task
+    property_details_dic = {'statut': page['statut'], 'link': page['url']}
+    try:
+        headers, page_source = read_page(path, page['segment'], page['offset'], page['length'])
+        return page['section'], PARSERS[site](page_source, property_details_dic), None
+    except Exception as error:
+        return page['section'], None, repr(error)
+
+
+def reextract(site, path, output_dir, output_format='csv', batch_size=100, processes=None, gazetteer=None):
+    """
+    This function responsible for writing the outputs of every section again from the last archived version of
+    each detail page, the pages being parsed in parallel by `processes` processes (one per core by default).
+    With a gazetteer the outputs get the location columns of the scrapers.
+    """
+    pages = [page for page in archived_pages(path) if page['section'] is not None]
+    print("detail pages in the archive: ", len(pages))
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    sinks = {}
+    failed = 0
+    with Pool(processes) as pool:
+        # imap keeps the archive order, so the rows come out section by section like in a crawl
+        for section, property_details_dic, error in pool.imap(extract_page, ((site, path, page) for page in pages), chunksize=32):
+            if property_details_dic is None:
+                failed = failed + 1
+                print("could not extract a page of ", section, ": ", error)
+                continue
+            if section not in sinks:
+                sinks[section] = open_sink(os.path.join(output_dir, section), output_format, batch_size, site)
+                if gazetteer is not None:
+                    sinks[section] = gazetteer.track_sink(sinks[section])
+            sinks[section].write(property_details_dic)
+    for section, sink in sinks.items():
+        sink.close()
+        print("Number of states written to ", section, ": ", sink.rows)
+    seconds = time.perf_counter() - start
+    print(len(pages) - failed, " pages extracted in ", round(seconds, 1), " s (",
+          round((len(pages) - failed) / seconds, 1) if seconds else "-", " pages/s), ", failed, " failed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract the outputs of a scraper again from its page archive, without the network")
+    parser.add_argument("site", choices=sorted(PARSERS), help="scraper that filled the archive")
+    parser.add_argument("archive", help="archive folder given to the scraper with --archive")
+    parser.add_argument("--output-dir", default="reextracted", help="folder receiving the outputs, named like the scraper's")
+    parser.add_argument("--output-format", choices=['csv', 'parquet', 'listing'], default="csv")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="parsing processes, one per core by default")
+    parser.add_argument("--gazetteer", default=GAZETTEER_PATH, help="csv of places giving the location columns, empty to leave them out")
+    args = parser.parse_args()
+    reextract(args.site, args.archive, args.output_dir, args.output_format, args.batch_size, args.processes,
+              Gazetteer(args.gazetteer) if args.gazetteer else None)
@@ -1,23 +1,44 @@
-from selenium import webdriver
-from selenium.webdriver.firefox.service import Service
-from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.firefox import GeckoDriverManager
+from selenium.common.exceptions import TimeoutException, NoSuchElementException
 import time
-import pandas as pd
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 import os
+import argparse
+from urllib.parse import urlparse
+from browser import new_driver_factory, BrowserStats, LazyDriver, ThreadDrivers
+import browser
+from worker_pool import scrape_in_pool
+from frontier import Frontier
+from sinks import open_sink, keep_previous, drop_previous, iter_rows
+from work_queue import serve_queue, open_queue, start_workers, wait_for_sections, LOOPBACK_HOSTS
+import rate_limiter
+from dead_letter import DeadLetter
+from metrics import Metrics
+from archive import PageArchive
+from geocoder import Gazetteer, GAZETTEER_PATH
+from scheduler import load_sections, SECTIONS_PATH
+from history import PriceHistory
+from snapshot import card_surface, snapshot_output, snapshot_row, snapshot_time
+import itertools
 # Function to extract spans from divs
 def extract_spans(divs,property_details):
     for div in divs:
         spans = div.find_elements(By.TAG_NAME, "span")
-        property_details[spans[0].text]=spans[1].text
+        # a label without its value is skipped instead of failing the whole state
+        if len(spans)>=2:
+            property_details[spans[0].text]=spans[1].text
     return property_details
-def get_states_links_statut(statut_ch):
+def get_states_links_statut(statut_ch,frontier=None,section=None,incremental=False):
     """
     This function responsible for filling  the 'link' and 'statut' fields in the dictionaries within property_details_lst.
+    With a frontier the card price of every state is remembered between runs. In incremental mode only the new
+    states and the ones whose card price changed are returned, and paging stops at the first page without new states
+    (the listing is sorted by most recent).
     """
     property_details_lst=[]
     page_number=1
@@ -29,7 +50,10 @@ def get_states_links_statut(statut_ch):
         states = WebDriverWait(driver, 10).until(
                 EC.presence_of_all_elements_located((By.XPATH, '//div[@class="gallery-item"]'))
             )
+        if archive is not None:
+            archive.add_page(driver.current_url,driver.page_source,'listing',section,statut_ch)
         state_index=0
+        new_states=0
         for state in states:
             state_index=state_index+1
             print("getting state ",state_index," link.")
@@ -37,91 +61,608 @@ def get_states_links_statut(statut_ch):
             #getting the status (vente/location)
             try:
                 property_details_dic['statut'] = state.find_element(By.XPATH,'.//div[@class="card-trans-type collection-card drop-shadow"]').text
-            except:
+            except NoSuchElementException:
                 property_details_dic['statut']=statut_ch
             #getting the link of the state
             link_element = WebDriverWait(state, 20).until(
                     EC.presence_of_element_located((By.XPATH, './/div[@class="gallery-photo"]/a'))
                 )
             property_details_dic['link'] = link_element.get_attribute('href')
+            if frontier is not None:
+                try:
+                    card_price=state.find_element(By.XPATH,'.//*[contains(@class,"gallery-price")]').text
+                except NoSuchElementException:
+                    card_price=""
+                seen=frontier.observe(section,property_details_dic['link'],card_price)
+                if seen=='new':
+                    new_states=new_states+1
+                if incremental and seen=='known':
+                    continue
             property_details_lst.append(property_details_dic)
+        if incremental and new_states==0:
+            print("no new state on this page, the rest is already known")
+            break
         try:
             wait = WebDriverWait(driver, 10)
             xpath = f"//a[@data-page='{page_number}' and contains(@class, 'ajax-page-link')]"
             button_next = wait.until(EC.element_to_be_clickable((By.XPATH, xpath)))
             driver.execute_script("arguments[0].click();", button_next)
             #time.sleep(5)
-        except:
+        except TimeoutException:
             print("no page found")
             break
     return property_details_lst
-def get_states_details(property_details_lst):
+# the cards of a result page and the highest page number of its pager, in one round trip
+CARDS_JS='''
+function first(xpath, context) {
+    return document.evaluate(xpath, context, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+}
+var cards = [];
+var states = document.evaluate('//div[@class="gallery-item"]', document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+for (var i = 0; i < states.snapshotLength; i++) {
+    var state = states.snapshotItem(i);
+    var statut = first('.//div[@class="card-trans-type collection-card drop-shadow"]', state);
+    var link = first('.//div[@class="gallery-photo"]/a', state);
+    var price = first('.//*[contains(@class,"gallery-price")]', state);
+    var title = first('.//*[contains(@class,"gallery-title")]', state);
+    var address = first('.//*[contains(@class,"gallery-address") or contains(@class,"gallery-location")]', state);
+    cards.push({statut: statut ? statut.innerText.trim() : null, link: link ? link.href : null,
+                price: price ? price.innerText.trim() : "", title: title ? title.innerText.trim() : "",
+                address: address ? address.innerText.trim() : "", text: state.innerText});
+}
+var last_page = 0;
+document.querySelectorAll('a.ajax-page-link[data-page]').forEach(function (a) {
+    last_page = Math.max(last_page, parseInt(a.getAttribute('data-page'), 10) || 0);
+});
+return {cards: cards, last_page: last_page};
+'''
+def remax_page_url(website_link,page_number):
+    return re.sub(r'([#&])page=\d+',r'\g<1>page='+str(page_number),website_link)
+def get_page_states(driver,website_link,page_number,section=None,statut_ch=None):
     """
-    This function responsible for filling other fields in the dictionaries within property_details_lst.
+    This function responsible for opening result page number page_number directly and reading its cards,
+    archived under section and statut_ch when the pages are archived.
+    Returns the cards and the highest page number shown by the pager. Only pages up to the last one known are
+    asked for, so a gallery that does not show up is a failed page (TimeoutException), retried by the caller.
     """
-    for c in range(len(property_details_lst)):
-        driver.get(property_details_lst[c]['link'])
-        print("Sraping state number ",c+1)
-        print(property_details_lst[c]['link'])
+    # the page is chosen by the url fragment, leaving the document first makes the gallery load from scratch
+    driver.get("about:blank")
+    throttle=rate_limiter.for_url(website_link)
+    start=throttle.acquire()
+    try:
+        with metrics.stage('listing_navigation'):
+            driver.get(remax_page_url(website_link,page_number))
+    except TimeoutException:
+        throttle.release(start,timeout=True)
+        raise
+    throttle.release(start)
+    print("Getting state links from page number ",page_number)
+    with metrics.stage('listing_wait'):
+        WebDriverWait(driver, 10).until(
+                EC.presence_of_all_elements_located((By.XPATH, '//div[@class="gallery-item"]'))
+            )
+    with metrics.stage('listing_extraction'):
+        page=driver.execute_script(CARDS_JS)
+    if archive is not None:
+        archive.add_page(remax_page_url(website_link,page_number),driver.page_source,'listing',section,statut_ch)
+    return [card for card in page['cards'] if card['link']],page['last_page']
+def get_states_links_pages(website_link,statut_ch,workers=1,frontier=None,section=None,incremental=False,retries=3,cards=False):
+    """
+    This function responsible for filling the 'link' and 'statut' fields like get_states_links_statut, addressing
+    every result page by its number instead of clicking through the pager. With more than one worker the pages
+    are fetched in parallel, the pages learned from the pager being added as they show up. A page that fails is
+    fetched again alone, up to `retries` times. Incremental mode reads the pages in order and stops like
+    get_states_links_statut. With cards the fields shown by the cards (title, price, surface, address) are kept too.
+    """
+    pages={}
+    failures={}
+    def keep_cards(page_cards):
+        property_details_lst=[]
+        new_states=0
+        for card in page_cards:
+            property_details_dic={'statut':card['statut'] or statut_ch,'link':card['link']}
+            if cards:
+                property_details_dic.update(title=card['title'],prix=card['price'],surface=card_surface(card['text']),address=card['address'])
+            if frontier is not None:
+                seen=frontier.observe(section,card['link'],card['price'])
+                if seen=='new':
+                    new_states=new_states+1
+                if incremental and seen=='known':
+                    continue
+            property_details_lst.append(property_details_dic)
+        return property_details_lst,new_states
+    if workers>1 and not incremental:
+        local=threading.local()
+        drivers=[]
+        def fetch(page_number):
+            if getattr(local,'driver',None) is None:
+                local.driver=LazyDriver(new_driver)
+                drivers.append(local.driver)
+            return get_page_states(local.driver,website_link,page_number,section,statut_ch)
         try:
-            property_details_lst[c]['title']=driver.find_element(By.XPATH,'//div[@class="col-xs-12 key-title"]/h1').text
-        except:
-            property_details_lst[c]['title']=""
+            with ThreadPoolExecutor(max_workers=workers,thread_name_prefix="pages") as executor:
+                futures={executor.submit(fetch,1):1}
+                last_page=1
+                submitted=1
+                while futures:
+                    done,_=wait(futures,return_when=FIRST_COMPLETED)
+                    for future in done:
+                        page_number=futures.pop(future)
+                        try:
+                            pages[page_number],pager_last_page=future.result()
+                        except Exception as error:
+                            failures[page_number]=failures.get(page_number,0)+1
+                            print("page ",page_number," failed (",repr(error),")")
+                            if failures[page_number]<retries:
+                                futures[executor.submit(fetch,page_number)]=page_number
+                            continue
+                        last_page=max(last_page,pager_last_page)
+                    while submitted<last_page:
+                        submitted=submitted+1
+                        futures[executor.submit(fetch,submitted)]=submitted
+        finally:
+            for page_driver in drivers:
+                page_driver.quit()
+        property_details_lst=[]
+        for page_number in sorted(pages):
+            property_details_lst.extend(keep_cards(pages[page_number])[0])
+    else:
+        property_details_lst=[]
+        page_number=1
+        last_page=1
+        while page_number<=last_page:
+            try:
+                page_cards,pager_last_page=get_page_states(driver,website_link,page_number,section,statut_ch)
+            except Exception as error:
+                failures[page_number]=failures.get(page_number,0)+1
+                print("page ",page_number," failed (",repr(error),")")
+                if failures[page_number]>=retries:
+                    page_number=page_number+1
+                continue
+            if not page_cards:
+                break
+            last_page=max(last_page,pager_last_page)
+            kept_lst,new_states=keep_cards(page_cards)
+            property_details_lst.extend(kept_lst)
+            if incremental and new_states==0:
+                print("no new state on this page, the rest is already known")
+                break
+            page_number=page_number+1
+    lost_pages=[page_number for page_number,count in failures.items() if count>=retries]
+    if lost_pages:
+        print("pages given up after ",retries," attempts: ",sorted(lost_pages))
+        if section is not None:
+            lost_sections.add(section)
+    return property_details_lst
+def get_state_details(driver,property_details_dic):
+    """
+    This function responsible for filling other fields in one dictionary of property_details_lst.
+    """
+    with metrics.stage('navigation'):
+        driver.get(property_details_dic['link'])
+    print(property_details_dic['link'])
+    with metrics.stage('extraction'):
+        try:
+            property_details_dic['title']=driver.find_element(By.XPATH,'//div[@class="col-xs-12 key-title"]/h1').text
+        except NoSuchElementException:
+            property_details_dic['title']=""
         try:
-            property_details_lst[c]['prix']= driver.find_element(By.XPATH,'//div[@class="key-price-div"]/a').text
-        except:
-            property_details_lst[c]['prix']=0
+            property_details_dic['prix']= driver.find_element(By.XPATH,'//div[@class="key-price-div"]/a').text
+        except NoSuchElementException:
+            property_details_dic['prix']=0
         try:
-            property_details_lst[c]['address']= driver.find_element(By.XPATH,'//div[@class="col-xs-12 key-address fts-mark"]').text
-        except:
-            property_details_lst[c]['address']=""
+            property_details_dic['address']= driver.find_element(By.XPATH,'//div[@class="col-xs-12 key-address fts-mark"]').text
+        except NoSuchElementException:
+            property_details_dic['address']=""
         try:
-            property_details_lst[c]['statut_marche']= driver.find_element(By.XPATH,'//div[@class="col-xs-12 key-status fts-mark"]').text
-        except:
-            property_details_lst[c]['statut_marche']=""
+            property_details_dic['statut_marche']= driver.find_element(By.XPATH,'//div[@class="col-xs-12 key-status fts-mark"]').text
+        except NoSuchElementException:
+            property_details_dic['statut_marche']=""
         details=driver.find_elements(By.XPATH,'//div[@class="attributes-data-row"]')
+        # some listings have only one of the two rows (or none)
         # First detail: divs with class "attributes-icons attributes-data-col"
-        first_detail_divs = details[0].find_elements(By.CLASS_NAME, "attributes-icons.attributes-data-col")
+        first_detail_divs = details[0].find_elements(By.CLASS_NAME, "attributes-icons.attributes-data-col") if len(details)>0 else []
         # Second detail: divs with class "attributes-no-icons attributes-data-col"
-        second_detail_divs = details[1].find_elements(By.CLASS_NAME, "attributes-no-icons.attributes-data-col")
+        second_detail_divs = details[1].find_elements(By.CLASS_NAME, "attributes-no-icons.attributes-data-col") if len(details)>1 else []
         # Extract spans from both details
-        property_details_lst[c]=extract_spans(first_detail_divs,property_details_lst[c])
-        property_details_lst[c]=extract_spans(second_detail_divs,property_details_lst[c])
+        with metrics.stage('extract_spans'):
+            property_details_dic=extract_spans(first_detail_divs,property_details_dic)
+            property_details_dic=extract_spans(second_detail_divs,property_details_dic)
         caracteristiques=driver.find_elements(By.XPATH,'//div[@class="col-xs-6 col-sm-4 col-md-3 fts-mark"]/span')
         for caract in caracteristiques:
-            property_details_lst[c][caract.text]=1
-    return property_details_lst
+            property_details_dic[caract.text]=1
+    return property_details_dic
+# one round trip to geckodriver per page instead of one per element
+DETAILS_JS='''
+function first(xpath) {
+    var node = document.evaluate(xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    return node ? node.innerText.trim() : null;
+}
+function spans(row, selector) {
+    var pairs = [];
+    row.querySelectorAll(selector).forEach(function (div) {
+        var texts = [];
+        div.querySelectorAll('span').forEach(function (span) { texts.push(span.innerText.trim()); });
+        pairs.push(texts);
+    });
+    return pairs;
+}
+var rows = document.evaluate('//div[@class="attributes-data-row"]', document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+var caracteristiques = document.evaluate('//div[@class="col-xs-6 col-sm-4 col-md-3 fts-mark"]/span', document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+var names = [];
+for (var i = 0; i < caracteristiques.snapshotLength; i++) {
+    names.push(caracteristiques.snapshotItem(i).innerText.trim());
+}
+return {
+    title: first('//div[@class="col-xs-12 key-title"]/h1'),
+    prix: first('//div[@class="key-price-div"]/a'),
+    address: first('//div[@class="col-xs-12 key-address fts-mark"]'),
+    statut_marche: first('//div[@class="col-xs-12 key-status fts-mark"]'),
+    rows: rows.snapshotLength,
+    first_detail: rows.snapshotLength > 0 ? spans(rows.snapshotItem(0), '.attributes-icons.attributes-data-col') : [],
+    second_detail: rows.snapshotLength > 1 ? spans(rows.snapshotItem(1), '.attributes-no-icons.attributes-data-col') : [],
+    caracteristiques: names
+};
+'''
+def get_state_details_js(driver,property_details_dic):
+    """
+    This function responsible for filling one dictionary with a single execute_script call, same layout as get_state_details.
+    """
+    with metrics.stage('navigation'):
+        driver.get(property_details_dic['link'])
+    print(property_details_dic['link'])
+    with metrics.stage('extraction'):
+        details=driver.execute_script(DETAILS_JS)
+        property_details_dic['title']=details['title'] if details['title'] is not None else ""
+        property_details_dic['prix']=details['prix'] if details['prix'] is not None else 0
+        property_details_dic['address']=details['address'] if details['address'] is not None else ""
+        property_details_dic['statut_marche']=details['statut_marche'] if details['statut_marche'] is not None else ""
+        for spans in details['first_detail']+details['second_detail']:
+            if len(spans)>=2:
+                property_details_dic[spans[0]]=spans[1]
+        for caract in details['caracteristiques']:
+            property_details_dic[caract]=1
+    return property_details_dic
+# detail page engines
+engines={'selenium':get_state_details,'js':get_state_details_js}
+def get_states_details(property_details_lst,workers=1,engine='selenium',frontier=None,section=None):
+    """
+    This function responsible for filling other fields in the dictionaries within property_details_lst.
+    With more than one worker the links are shared between that many browsers.
+    property_details_lst may also be a generator, the states are scraped as they come.
+    With a frontier every state is saved as soon as it is scraped and states that fail are left out.
+    The scraped dictionaries are yielded in the original order as soon as they are ready.
+    """
+    scrape_state=wrap_engine(engine,section)
+    if frontier is not None:
+        scrape_state=frontier.track(section,scrape_state)
+    if workers>1:
+        scraped_lst=scrape_in_pool(property_details_lst,scrape_state,new_driver,workers)
+    else:
+        scraped_lst=scrape_one_by_one(property_details_lst,scrape_state)
+    for property_details_dic in scraped_lst:
+        if property_details_dic is not None:
+            yield property_details_dic
+def open_output(csv_name):
+    """
+    This function responsible for opening an output, timed by the metrics and with the location
+    columns of every state when a gazetteer is set.
+    With a price history the states written are added to it as one crawl of the section csv_name: a snapshot
+    (its own output) is a section of its own, so it never delists what the full crawls of its section hold.
+    """
+    sink=open_sink(csv_name,args.output_format,args.batch_size,'remax')
+    if gazetteer is not None:
+        sink=gazetteer.track_sink(sink)
+    if history is not None:
+        sink=history.track_sink(sink,'remax',csv_name)
+    return metrics.track_sink(sink)
+def close_output(sink,section,frontier=None):
+    """
+    This function responsible for closing an output. The price history is told about what the run missed:
+    the links of section found but not scraped (failed, dead lettered) are not delisted, and nothing is
+    delisted when result pages of the section were given up.
+    """
+    if history is not None:
+        if frontier is not None:
+            sink.mark_seen(frontier.unscraped_links(section))
+        if section in lost_sections:
+            sink.mark_incomplete()
+    sink.close()
+def write_section(p,scraped_lst,previous_output=None):
+    """
+    This function responsible for writing the scraped states of section p to its output while they come,
+    then the states of the previous output that were not scraped again (incremental mode).
+    """
+    sink=open_output(csv_name[p])
+    for property_details_dic in scraped_lst:
+        sink.write(property_details_dic)
+    if previous_output is not None:
+        if history is not None:
+            # the kept states were not seen by this run, the history must not take them for a full crawl
+            sink.keep_unseen()
+        # the new and updated states replace their old rows, the untouched states are kept
+        scraped_links=set(property_details_dic['link'] for property_details_dic in frontier.rows(csv_name[p]))
+        for property_details_dic in iter_rows(previous_output,args.output_format):
+            if property_details_dic.get('link') not in scraped_links:
+                sink.write(property_details_dic)
+    close_output(sink,csv_name[p],frontier)
+    if previous_output is not None:
+        # the output is complete again, the next run starts from it
+        drop_previous(csv_name[p],args.output_format)
+    print("Number of states written to ",csv_name[p],": ",sink.rows,frontier.counts(csv_name[p]))
+def wrap_engine(engine,section):
+    """
+    This function responsible for returning the scrape_state of an engine with the browser stats, the rate limiter,
+    the retries (states that keep failing go to the dead letter file) and the metrics, archiving its pages when asked.
+    """
+    scrape_state=engines[engine]
+    if archive is not None:
+        scrape_state=archive.track(section,scrape_state)
+    scrape_state=browser_stats.track(scrape_state)
+    if engine!='http':
+        # the http engine paces its own requests
+        scrape_state=rate_limiter.throttled(scrape_state)
+    return metrics.track(section,dead_letter.with_retries(section,scrape_state,args.retries))
+def discover_section(p):
+    """
+    This function responsible for the links of section p: the unfinished ones of the interrupted run with --resume,
+    else the ones of a new discovery. They are stored in the frontier as they come and yielded when still to scrape.
+    """
+    print("start scraping ",website_link_lst[p])
+    section=csv_name[p]
+    # a resumed section keeps the output moved aside by the run it resumes, its own output is partial
+    resumed=args.resume and frontier.is_discovered(section)
+    previous_outputs[p]=keep_previous(csv_name[p],args.output_format,rotate=not resumed) if args.incremental else None
+    if resumed:
+        # links already discovered by the interrupted run, only the unfinished ones are scraped
+        property_details_lst=frontier.pending(section)
+        print("Resuming, number of states left to scrape: ",len(property_details_lst))
+        return metrics.count_links(section,property_details_lst)
+    if not args.resume:
+        frontier.reset(section)
+    #collecting the data
+    with metrics.stage('discovery'):
+        if args.pagination=='direct':
+            property_details_lst=get_states_links_pages(website_link_lst[p],statut_lst[p],page_workers,frontier,section,args.incremental,args.retries)
+        else:
+            driver.get(website_link_lst[p])
+            property_details_lst=get_states_links_statut(statut_lst[p],frontier,section,args.incremental)
+    print("Number of states to scrape: ",len(property_details_lst))
+    return frontier.record_links(section,metrics.count_links(section,property_details_lst))
+def queue_section(p):
+    """
+    This function responsible for discovering section p in a thread of its own, the links only go to the frontier.
+    """
+    for property_details_dic in discover_section(p):
+        pass
+    # the listing browser of this thread is not needed any more
+    driver.quit()
+    print("end of discovery ",website_link_lst[p])
+def snapshot_section(p,own_browser=False):
+    """
+    This function responsible for writing the snapshot of section p: the fields shown by the cards of its result
+    pages (addressed by number whatever --pagination says), one page load per page of cards, no state is opened.
+    own_browser when the section has a thread of its own.
+    """
+    print("start snapshot ",website_link_lst[p])
+    with metrics.stage('discovery'):
+        cards_lst=get_states_links_pages(website_link_lst[p],statut_lst[p],page_workers,section=csv_name[p],retries=args.retries,cards=True)
+    sink=open_output(snapshot_output(csv_name[p]))
+    seen=set()
+    for card in cards_lst:
+        # a state moved to another page while the section is read shows up twice
+        if card['link'] not in seen:
+            seen.add(card['link'])
+            sink.write(snapshot_row(snapshot_at,card))
+    close_output(sink,csv_name[p])
+    if own_browser:
+        driver.quit()
+    print("Number of states in the snapshot ",snapshot_output(csv_name[p]),": ",sink.rows)
+def scrape_one_by_one(property_details_lst,scrape_state):
+    for c,property_details_dic in enumerate(property_details_lst):
+        print("Sraping state number ",c+1)
+        yield scrape_state(driver,property_details_dic)
 #Main programme
 # Load environment variables from .env file
 load_dotenv()
 # Define website url
 # Correct chromedriver path
 path = os.getenv("CHROMEDRIVER_PATH")
-#desactivate gui
-options = Options()
-options.headless = True  # Run in headless mode (no browser UI)
-options.add_argument("--disable-gpu")  # Disable GPU (fixes some headless issues)
-options.add_argument("--no-sandbox")  # Avoid sandboxing issues
-options.add_argument("--disable-dev-shm-usage")  # Improve performance in Docker/Linux
+parser = argparse.ArgumentParser(description="Scrape the remax.com.tn listings")
+parser.add_argument("--workers", type=int, default=int(os.getenv("SCRAPER_WORKERS", "1")),
+                    help="number of browsers scraping the detail pages in parallel")
+parser.add_argument("--frontier", default=os.getenv("SCRAPER_FRONTIER", "remax_frontier.db"),
+                    help="sqlite file keeping the discovered links and the scraped states of the run")
+parser.add_argument("--resume", action="store_true",
+                    help="continue the last run from the frontier instead of starting over")
+parser.add_argument("--incremental", action="store_true",
+                    help="only scrape the states that are new or whose price changed since the earlier runs, and merge them into the csv")
+parser.add_argument("--output-format", choices=['csv','parquet','listing'], default=os.getenv("SCRAPER_OUTPUT_FORMAT", "csv"),
+                    help="csv file, parquet dataset or canonical listings parquet file, written while the states are scraped")
+parser.add_argument("--batch-size", type=int, default=int(os.getenv("SCRAPER_BATCH_SIZE", "100")),
+                    help="number of scraped states written to the output at once")
+parser.add_argument("--engine", choices=['selenium','js'], default=os.getenv("SCRAPER_ENGINE", "selenium"),
+                    help="detail page engine: one webdriver call per element, or one execute_script per page")
+parser.add_argument("--browser", choices=['firefox','chrome'], default=os.getenv("SCRAPER_BROWSER", "firefox"),
+                    help="browser driven by selenium (drivers from GECKODRIVER_PATH / CHROMEDRIVER_PATH, the path cached by the last run or the PATH)")
+parser.add_argument("--lean", action="store_true", default=os.getenv("SCRAPER_LEAN")=="1",
+                    help="eager page loads without images, media, fonts, disk cache or third-party hosts")
+parser.add_argument("--role", choices=['standalone','coordinator','worker'], default=os.getenv("SCRAPER_ROLE", "standalone"),
+                    help="coordinator: discover the links and serve them to workers, worker: scrape links pulled from --queue")
+parser.add_argument("--queue", default=os.getenv("SCRAPER_QUEUE"),
+                    help="queue of a worker: http://coordinator:port, or the frontier file when it is on the same host")
+parser.add_argument("--queue-port", type=int, default=int(os.getenv("SCRAPER_QUEUE_PORT", "8765")),
+                    help="port the coordinator serves its queue on")
+parser.add_argument("--queue-host", default=os.getenv("SCRAPER_QUEUE_HOST", "127.0.0.1"),
+                    help="interface the coordinator serves its queue on, 0.0.0.0 for workers on other hosts (needs --queue-token)")
+parser.add_argument("--queue-token", default=os.getenv("SCRAPER_QUEUE_TOKEN"),
+                    help="secret shared by the coordinator and its workers, sent with every request to the queue")
+parser.add_argument("--lease", type=int, default=int(os.getenv("SCRAPER_LEASE", "300")),
+                    help="seconds a worker keeps a link before it is handed to another worker")
+parser.add_argument("--pagination", choices=['direct','click'], default=os.getenv("SCRAPER_PAGINATION", "direct"),
+                    help="open every result page by its number (in parallel with --page-workers), or click through the pager")
+parser.add_argument("--page-workers", type=int, default=int(os.getenv("SCRAPER_PAGE_WORKERS", "0")),
+                    help="browsers opening the result pages of a section in parallel with --pagination direct, 0 for as many as --workers")
+parser.add_argument("--rate", type=float, default=float(os.getenv("SCRAPER_RATE", "2")),
+                    help="starting number of requests per second to a host, adjusted on the fly")
+parser.add_argument("--max-rate", type=float, default=float(os.getenv("SCRAPER_MAX_RATE", "20")),
+                    help="highest number of requests per second to a host")
+parser.add_argument("--retries", type=int, default=int(os.getenv("SCRAPER_RETRIES", "3")),
+                    help="times a failing state is tried again, with exponential backoff, before going to the dead letter file")
+parser.add_argument("--dead-letter", default=os.getenv("SCRAPER_DEAD_LETTER", "remax_dead_letter.jsonl"),
+                    help="json lines file of the states given up, their page snapshots go to the folder of the same name")
+parser.add_argument("--metrics-dir", default=os.getenv("SCRAPER_METRICS_DIR", "."),
+                    help="folder of the json log (remax_metrics.jsonl) and of the prometheus file (remax.prom), e.g. the node_exporter textfile folder")
+parser.add_argument("--metrics-every", type=float, default=float(os.getenv("SCRAPER_METRICS_EVERY", "15")),
+                    help="seconds between two progress lines / prometheus file updates")
+parser.add_argument("--base-url", default=os.getenv("SCRAPER_BASE_URL"),
+                    help="scrape a copy of the site served elsewhere instead of https://www.remax.com.tn (e.g. the benchmark server)")
+parser.add_argument("--archive", default=os.getenv("SCRAPER_ARCHIVE"),
+                    help="folder of a compressed archive keeping every fetched page, to extract them again later with reextract.py")
+parser.add_argument("--recycle-pages", type=int, default=int(os.getenv("SCRAPER_RECYCLE_PAGES", "1000")),
+                    help="pages a browser opens before it is replaced by a fresh one, 0 keeps it for the whole run")
+parser.add_argument("--recycle-rss", type=int, default=int(os.getenv("SCRAPER_RECYCLE_RSS", "1500")),
+                    help="memory (MB) of a browser and its driver above which it is replaced by a fresh one, 0 for no limit")
+parser.add_argument("--warm-browser", action="store_true", default=os.getenv("SCRAPER_WARM_BROWSER")=="1",
+                    help="always keep a browser started in the background, so new and recycled browsers are ready at once")
+parser.add_argument("--sections", default=os.getenv("SCRAPER_SECTIONS", SECTIONS_PATH),
+                    help="csv table of the sections (site, statut, url with {page}, output), the remax rows are scraped")
+parser.add_argument("--only", default=os.getenv("SCRAPER_ONLY"),
+                    help="outputs of the sections to scrape, separated by commas (all the remax sections by default)")
+parser.add_argument("--concurrent-sections", type=int, default=int(os.getenv("SCRAPER_CONCURRENT_SECTIONS", "1")),
+                    help="sections discovered at the same time, each in its own browser, while the --workers browsers scrape the detail pages of all of them")
+parser.add_argument("--snapshot", action="store_true", default=os.getenv("SCRAPER_SNAPSHOT")=="1",
+                    help="only read the cards of the result pages (title, price, surface, address) into <output>_snapshot, no detail page is opened")
+parser.add_argument("--history", default=os.getenv("SCRAPER_HISTORY"),
+                    help="folder of the price history every crawl is appended to (date partitioned parquet + latest state index), see history.py")
+parser.add_argument("--gazetteer", default=os.getenv("SCRAPER_GAZETTEER", GAZETTEER_PATH),
+                    help="csv of tunisian places giving the city, governorate, latitude and longitude columns of every state from its address, empty to leave them out")
+args = parser.parse_args()
+rate_limiter.configure(rate=args.rate,max_rate=args.max_rate)
+browser.configure(max_pages=args.recycle_pages,max_rss_mb=args.recycle_rss)
 
 # 🚀 Setup WebDriver
-service = Service(GeckoDriverManager().install())
-driver = webdriver.Firefox(service=service, options=options)
-statut_lst=['Location','Vente']
-website_link_lst=['https://www.remax.com.tn/PublicListingList.aspx#mode=gallery&tt=260&cur=TND&sb=MostRecent&page=1&sc=1048&sid=7e6fd428-3ad7-4e60-aec1-1d113cdb5f08','https://www.remax.com.tn/PublicListingList.aspx#mode=gallery&tt=261&cur=TND&sb=MostRecent&page=1&sc=1048&lsgeo=0,0,0,0&sid=7e6fd428-3ad7-4e60-aec1-1d113cdb5f08']
-csv_name=['remax_location.csv','remax_vente.csv']
-for p in range(2):
-    driver.get(website_link_lst[p])
-    print("start scraping ",website_link_lst[p])
-    #collecting the data
-    property_details_lst=get_states_links_statut(statut_lst[p])
-    print("Number of states to scrape: ",len(property_details_lst))
-    property_details_lst=get_states_details(property_details_lst)
-    print("end scraping ",website_link_lst[p])
-    #creating the dataframe and transform it into a csv file
-    df=pd.DataFrame(property_details_lst)
-    df.to_csv(csv_name[p],index=False)
+# with the lean profile only the site itself is reachable (plus the hosts of SCRAPER_ALLOWED_HOSTS, e.g. a script cdn)
+allowed_hosts=['remax.com.tn']+([urlparse(args.base_url).hostname] if args.base_url else [])+[host for host in os.getenv("SCRAPER_ALLOWED_HOSTS","").split(",") if host]
+new_driver=new_driver_factory(args.browser,args.lean,allowed_hosts,args.warm_browser)
+page_workers=args.page_workers or args.workers
+browser_stats=BrowserStats('lean' if args.lean else 'full','remax_browser_stats.json')
+dead_letter=DeadLetter(args.dead_letter)
+metrics=Metrics('remax',os.path.join(args.metrics_dir,'remax_metrics.jsonl'),os.path.join(args.metrics_dir,'remax.prom'),args.metrics_every)
+archive=PageArchive(args.archive) if args.archive else None
+gazetteer=Gazetteer(args.gazetteer) if args.gazetteer else None
+history=PriceHistory(args.history) if args.history else None
+# sections whose result pages were not all read, their crawl does not delist anything
+lost_sections=set()
+#the sections come from the section table, their urls open on the first page
+try:
+    sections=load_sections(args.sections,'remax',args.only)
+except ValueError as error:
+    parser.error(str(error))
+statut_lst=[section['statut'] for section in sections]
+website_link_lst=[section['url'].replace('{page}','1') for section in sections]
+if args.base_url:
+    website_link_lst=[link.replace('https://www.remax.com.tn',args.base_url.rstrip('/')) for link in website_link_lst]
+csv_name=[section['output'] for section in sections]
+if args.snapshot and args.role!='standalone':
+    parser.error("--snapshot does not use the detail workers, it runs standalone")
+if args.role=='coordinator' and args.queue_host not in LOOPBACK_HOSTS and not args.queue_token:
+    parser.error("--queue-host "+args.queue_host+" lets other hosts reach the queue, it needs --queue-token")
+if args.role=='worker':
+    # links come from the coordinator, the outputs are written by the coordinator
+    queue=open_queue(args.queue or args.frontier,token=args.queue_token)
+    scrape_states={section:wrap_engine(args.engine,section) for section in csv_name}
+    for worker_thread in start_workers(queue,scrape_states,new_driver,args.workers,args.lease):
+        worker_thread.join()
+    browser_stats.report()
+    dead_letter.summary()
+    metrics.report()
+    if archive is not None:
+        archive.close()
+    raise SystemExit(0)
+# one browser per thread for the listing pages, the sections may be discovered in parallel
+driver = ThreadDrivers(new_driver)
+if args.snapshot:
+    snapshot_at=snapshot_time()
+    if args.concurrent_sections>1:
+        with ThreadPoolExecutor(max_workers=args.concurrent_sections,thread_name_prefix="section") as executor:
+            for future in [executor.submit(snapshot_section,p,True) for p in range(len(csv_name))]:
+                future.result()
+    else:
+        for p in range(len(csv_name)):
+            snapshot_section(p)
+    print("end of snapshot")
+    browser_stats.report()
+    metrics.report()
+    rate_limiter.report()
+    if archive is not None:
+        archive.close()
+    if history is not None:
+        history.close()
+    driver.quit()
+    raise SystemExit(0)
+frontier=Frontier(args.frontier)
+if args.role=='coordinator':
+    serve_queue(frontier,args.queue_host,args.queue_port,args.queue_token)
+    # the workers of this host pull from the frontier directly, until every section is scraped: a long discovery
+    # must not leave them idle past an idle timeout before its first links are queued
+    scraped=threading.Event()
+    scrape_states={section:wrap_engine(args.engine,section) for section in csv_name}
+    local_workers=start_workers(frontier,scrape_states,new_driver,args.workers,args.lease,stop=scraped)
+previous_outputs=[None]*len(csv_name)
+if args.role=='standalone' and args.concurrent_sections>1:
+    # every section is discovered at the same time and one pool of browsers scrapes the links of all of them,
+    # so a browser never idles while a section waits on its listing pages
+    scrape_states={section:wrap_engine(args.engine,section) for section in csv_name}
+    discovered=threading.Event()
+    local_workers=start_workers(frontier,scrape_states,new_driver,args.workers,args.lease,poll=1,stop=discovered)
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrent_sections,thread_name_prefix="section") as executor:
+            for future in [executor.submit(queue_section,p) for p in range(len(csv_name))]:
+                future.result()
+    finally:
+        # the workers leave once the frontier has nothing left for them
+        discovered.set()
+        for worker_thread in local_workers:
+            worker_thread.join()
+    for p in range(len(csv_name)):
+        write_section(p,frontier.rows(csv_name[p]),previous_outputs[p])
+else:
+    try:
+        for p in range(len(csv_name)):
+            section=csv_name[p]
+            property_details_lst=discover_section(p)
+            if args.role=='coordinator':
+                # queueing the links is enough, the workers scrape them while the next section is discovered
+                for property_details_dic in property_details_lst:
+                    pass
+                continue
+            #the states scraped by the interrupted run go first, then every state as soon as it is scraped
+            resumed_lst=frontier.rows(section) if args.resume else []
+            write_section(p,itertools.chain(resumed_lst,get_states_details(property_details_lst,args.workers,args.engine,frontier,section)),previous_outputs[p])
+            print("end scraping ",website_link_lst[p])
+    except BaseException:
+        # the workers of this host would wait for links that will not come
+        if args.role=='coordinator':
+            scraped.set()
+        raise
+if args.role=='coordinator':
+    try:
+        wait_for_sections(frontier,csv_name)
+    finally:
+        scraped.set()
+    for p in range(len(csv_name)):
+        write_section(p,frontier.rows(csv_name[p]),previous_outputs[p])
+    for worker_thread in local_workers:
+        worker_thread.join()
 print("end of scraping")
-driver.quit()
-
-
+browser_stats.report()
+dead_letter.summary()
+metrics.report()
+rate_limiter.report()
+frontier.close()
+if archive is not None:
+    archive.close()
+if history is not None:
+    history.close()
+driver.quit()
\ No newline at end of file
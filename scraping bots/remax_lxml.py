@@ -0,0 +1,41 @@
+from lxml import html
+
+
+def node_text(node):
+    # same whitespace handling as selenium's WebElement.text on a single line element
+    return " ".join(node.text_content().split())
+
+
+def has_classes(*names):
+    """XPath test of an element having every class of names, like By.CLASS_NAME "a.b" in remax.get_state_details."""
+    return " and ".join("contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name for name in names)
+
+
+def first_text(tree, xpath, default):
+    nodes = tree.xpath(xpath)
+    return node_text(nodes[0]) if nodes else default
+
+
+def parse_state_details(page_source, property_details_dic):
+    """
+    This function responsible for filling the detail fields of property_details_dic from the html of a detail page,
+    with the same xpaths and the same dictionary layout as remax.get_state_details.
+    """
+    tree = html.fromstring(page_source)
+    property_details_dic['title'] = first_text(tree, '//div[@class="col-xs-12 key-title"]/h1', "")
+    property_details_dic['prix'] = first_text(tree, '//div[@class="key-price-div"]/a', 0)
+    property_details_dic['address'] = first_text(tree, '//div[@class="col-xs-12 key-address fts-mark"]', "")
+    property_details_dic['statut_marche'] = first_text(tree, '//div[@class="col-xs-12 key-status fts-mark"]', "")
+    rows = tree.xpath('//div[@class="attributes-data-row"]')
+    divs = []
+    if len(rows) > 0:
+        divs.extend(rows[0].xpath('.//*[%s]' % has_classes('attributes-icons', 'attributes-data-col')))
+    if len(rows) > 1:
+        divs.extend(rows[1].xpath('.//*[%s]' % has_classes('attributes-no-icons', 'attributes-data-col')))
+    for div in divs:
+        spans = div.xpath('.//span')
+        if len(spans) >= 2:
+            property_details_dic[node_text(spans[0])] = node_text(spans[1])
+    for caract in tree.xpath('//div[@class="col-xs-6 col-sm-4 col-md-3 fts-mark"]/span'):
+        property_details_dic[node_text(caract)] = 1
+    return property_details_dic
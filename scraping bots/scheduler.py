@@ -0,0 +1,138 @@
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import threading
+
+SCRAPERS_DIR = os.path.dirname(os.path.abspath(__file__))
+SECTIONS_PATH = os.path.join(SCRAPERS_DIR, 'sections.csv')
+SITES = ('properstar', 'remax')
+
+
+def load_sections(path=SECTIONS_PATH, site=None, only=None):
+    """
+    This function responsible for reading the section table, one row per listing section: site, statut,
+    url of its listing pages ({page} stands for the page number) and output (csv name, also the section name).
+    Returns the rows of site (every row without one), only the outputs listed in only when it is given.
+    """
+    with open(path, newline='', encoding='utf-8') as source:
+        rows = [row for row in csv.DictReader(source) if row['site'] and not row['site'].startswith('#')]
+    for row in rows:
+        if row['site'] not in SITES:
+            raise ValueError("%s: unknown site %s" % (path, row['site']))
+        if '{page}' not in row['url']:
+            raise ValueError("%s: the url of %s has no {page}" % (path, row['output']))
+    if site is not None:
+        rows = [row for row in rows if row['site'] == site]
+    if only:
+        outputs = set(output.strip() for output in only.split(',') if output.strip())
+        unknown = outputs - set(row['output'] for row in rows)
+        if unknown:
+            raise ValueError("no such section in %s: %s" % (path, ", ".join(sorted(unknown))))
+        rows = [row for row in rows if row['output'] in outputs]
+    return rows
+
+
+def share_budget(sections_per_site, budget, minimum=1):
+    """
+    Splits `budget` browsers between the sites in proportion to their number of sections (largest remainder),
+    every site getting at least `minimum`.
+    """
+    total = sum(sections_per_site.values())
+    rest = max(0, budget - minimum * len(sections_per_site))
+    shares = {site: minimum + rest * count // total for site, count in sections_per_site.items()}
+    by_remainder = sorted(sections_per_site, key=lambda site: rest * sections_per_site[site] % total, reverse=True)
+    for site in by_remainder:
+        if sum(shares.values()) >= budget:
+            break
+        shares[site] = shares[site] + 1
+    return shares
+
+
+def split_share(share, sections, max_sections=0, discovery_browsers=True):
+    """
+    This function responsible for splitting the browsers of a site between its discovery and its detail pages.
+    Every section discovered at the same time holds one browser: its listing browser, or its result page browser
+    (remax with --page-workers 1). The discovery gets half of the share at most, the detail pages the rest.
+    Returns (sections discovered at the same time, detail browsers).
+    """
+    wanted = sections if not max_sections else min(max_sections, sections)
+    if not discovery_browsers:
+        return wanted, share
+    concurrent = max(1, min(wanted, share // 2))
+    return concurrent, max(1, share - concurrent)
+
+
+def option_value(arguments, option, default=None):
+    """Value of option in a list of command line arguments (--option value or --option=value), default when absent."""
+    value = default
+    for position, argument in enumerate(arguments):
+        if argument == option and position + 1 < len(arguments):
+            value = arguments[position + 1]
+        elif argument.startswith(option + '='):
+            value = argument[len(option) + 1:]
+    return value
+
+
+def relay(site, process):
+    for line in process.stdout:
+        sys.stdout.write("[%s] %s" % (site, line))
+        sys.stdout.flush()
+
+
+def run_sections(path, budget, max_sections=0, only=None, scraper_args=()):
+    """
+    This function responsible for scraping every section of the table at path at the same time: one process per
+    site, each discovering its sections concurrently (at most max_sections at once, 0 for all of them) while a pool
+    of browsers shared by its sections scrapes the detail pages. The `budget` browsers (discovery and detail pages)
+    are split between the sites, then between the discovery and the detail pages of every site (split_share).
+    scraper_args are given to every scraper. Returns the exit code of the worst scraper.
+    """
+    sections = load_sections(path, only=only)
+    per_site = {}
+    for row in sections:
+        per_site.setdefault(row['site'], []).append(row['output'])
+    if budget < 2 * len(per_site):
+        print("every site needs 2 browsers at least (one discovering, one on the detail pages), budget raised to ", 2 * len(per_site))
+        budget = 2 * len(per_site)
+    shares = share_budget({site: len(outputs) for site, outputs in per_site.items()}, budget, 2)
+    # properstar discovers over http or from the sitemap without a browser
+    properstar_discovery = option_value(scraper_args, '--discovery', os.getenv('SCRAPER_DISCOVERY', 'selenium'))
+    processes = {}
+    for site, outputs in per_site.items():
+        discovery_browsers = site != 'properstar' or properstar_discovery == 'selenium'
+        concurrent, workers = split_share(shares[site], len(outputs), max_sections, discovery_browsers)
+        command = [sys.executable, '-u', os.path.join(SCRAPERS_DIR, site + '.py'), '--sections', path,
+                   '--only', ",".join(outputs), '--workers', str(workers), '--concurrent-sections', str(concurrent)]
+        if site == 'remax':
+            # one result page browser per section, not --workers of them
+            command = command + ['--page-workers', '1']
+        command = command + list(scraper_args)
+        print("starting ", site, ": ", len(outputs), " sections, ", concurrent, " discovered at the same time, ",
+              workers, " detail browsers")
+        processes[site] = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                           encoding='utf-8', errors='replace')
+    relays = [threading.Thread(target=relay, args=(site, process), daemon=True) for site, process in processes.items()]
+    for thread in relays:
+        thread.start()
+    returncodes = {site: process.wait() for site, process in processes.items()}
+    for thread in relays:
+        thread.join()
+    for site, returncode in returncodes.items():
+        print(site, " finished with exit code ", returncode)
+    return max(returncodes.values()) if returncodes else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scrape every section of both sites at the same time from the section table",
+                                     epilog="options not listed here (e.g. --engine, --lean, --output-format) are given to every scraper")
+    parser.add_argument("--sections", default=os.getenv("SCRAPER_SECTIONS", SECTIONS_PATH),
+                        help="csv table of the sections: site, statut, url (with {page}), output")
+    parser.add_argument("--only", default=os.getenv("SCRAPER_ONLY"), help="outputs of the sections to scrape, separated by commas")
+    parser.add_argument("--budget", type=int, default=int(os.getenv("SCRAPER_BUDGET", "4")),
+                        help="browsers across every site and section, the ones discovering the sections and the ones on the detail pages")
+    parser.add_argument("--max-sections", type=int, default=int(os.getenv("SCRAPER_MAX_SECTIONS", "0")),
+                        help="sections of a site discovered at the same time (one browser each), 0 for as many as its share of --budget allows")
+    args, scraper_args = parser.parse_known_args()
+    sys.exit(run_sections(os.path.abspath(args.sections), args.budget, args.max_sections, args.only, scraper_args))
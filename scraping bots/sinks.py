@@ -0,0 +1,216 @@
+import csv
+import glob
+import os
+import shutil
+
+
+class CsvSink:
+    """
+    Appends the scraped states to a csv file in batches of batch_size rows, as they are scraped.
+    Columns that show up in the middle of a run are appended to the rows written from then on and added to the
+    header once, at close(), where the rows already written get an empty value for them: a long run bringing
+    new feature names all along rewrites the file once, not once per new column. Until then the header only
+    names the columns of the first batch.
+    """
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self.columns = []
+        # the columns named by the header of the file
+        self.header = []
+        self.batch = []
+        self.rows = 0
+        # a fresh file for every run, the rows of a resumed run are written again from the frontier
+        open(self.path, 'w').close()
+
+    def write(self, property_details_dic):
+        # feature names become columns, the properstar scraper also produces an integer key
+        self.batch.append({str(key): value for key, value in property_details_dic.items()})
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        known = set(self.columns)
+        new_columns = []
+        for row in self.batch:
+            for key in row:
+                if key not in known:
+                    known.add(key)
+                    new_columns.append(key)
+        self.columns = self.columns + new_columns
+        with open(self.path, 'a', newline='', encoding='utf-8') as output:
+            writer = csv.DictWriter(output, fieldnames=self.columns, restval="")
+            if not self.rows:
+                writer.writeheader()
+                self.header = self.columns
+            writer.writerows(self.batch)
+        self.rows = self.rows + len(self.batch)
+        self.batch = []
+
+    def add_columns(self):
+        """Rewrites the file with the header of every column, row by row so the file never sits in memory."""
+        tmp_path = self.path + '.tmp'
+        width = len(self.columns)
+        with open(self.path, newline='', encoding='utf-8') as source, \
+                open(tmp_path, 'w', newline='', encoding='utf-8') as output:
+            reader = csv.reader(source)
+            writer = csv.writer(output)
+            next(reader)
+            writer.writerow(self.columns)
+            for row in reader:
+                writer.writerow(row + [""] * (width - len(row)))
+        os.replace(tmp_path, self.path)
+        self.header = self.columns
+
+    def close(self):
+        self.flush()
+        if len(self.columns) > len(self.header):
+            self.add_columns()
+
+
+class ParquetSink:
+    """
+    Writes the scraped states to a parquet dataset (a directory of part files), one row group per batch.
+    Every value is stored as text, like in the csv. When new columns show up the current part is closed and
+    the next one is written with the wider schema, read_parquet() puts the parts back together.
+    """
+    def __init__(self, path, batch_size=100):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.batch_size = batch_size
+        self.columns = []
+        self.batch = []
+        self.rows = 0
+        self.part = 0
+        self.writer = None
+        os.makedirs(self.path, exist_ok=True)
+        for part_path in glob.glob(os.path.join(self.path, 'part-*.parquet')):
+            os.remove(part_path)
+
+    def write(self, property_details_dic):
+        # feature names become columns, the properstar scraper also produces an integer key
+        self.batch.append({str(key): value for key, value in property_details_dic.items()})
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        known = set(self.columns)
+        new_columns = []
+        for row in self.batch:
+            for key in row:
+                if key not in known:
+                    known.add(key)
+                    new_columns.append(key)
+        if new_columns:
+            self.columns = self.columns + new_columns
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+                self.part = self.part + 1
+        values = {column: [] for column in self.columns}
+        for row in self.batch:
+            for column in self.columns:
+                value = row.get(column)
+                values[column].append(None if value is None else str(value))
+        table = self.pa.table({column: self.pa.array(values[column], self.pa.string()) for column in self.columns})
+        if self.writer is None:
+            part_path = os.path.join(self.path, 'part-%05d.parquet' % self.part)
+            self.writer = self.pq.ParquetWriter(part_path, table.schema, compression='zstd')
+        self.writer.write_table(table)
+        self.rows = self.rows + len(self.batch)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def read_parquet(path):
+    """
+    This function responsible for reading a ParquetSink dataset into one DataFrame,
+    columns missing from the older parts are filled with nulls.
+    """
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+    part_paths = sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+    schema = pyarrow.unify_schemas([pyarrow.parquet.read_schema(part_path) for part_path in part_paths])
+    return pyarrow.dataset.dataset(part_paths, schema=schema, format='parquet').to_table().to_pandas()
+
+
+def open_sink(csv_name, output_format='csv', batch_size=100, source=None):
+    """
+    This function responsible for opening the output of a section, csv_name is the historical csv file name.
+    The 'listing' format writes canonical listings of the given source (see listing.py).
+    """
+    if output_format == 'parquet':
+        return ParquetSink(output_path(csv_name, output_format), batch_size)
+    if output_format == 'listing':
+        from listing import ListingParquetSink
+        return ListingParquetSink(output_path(csv_name, output_format), source, batch_size)
+    return CsvSink(csv_name, batch_size)
+
+
+def output_path(csv_name, output_format='csv'):
+    if output_format == 'parquet':
+        return os.path.splitext(csv_name)[0] + '.parquet'
+    if output_format == 'listing':
+        return os.path.splitext(csv_name)[0] + '.listings.parquet'
+    return csv_name
+
+
+def keep_previous(csv_name, output_format='csv', rotate=True):
+    """
+    This function responsible for moving the output of the last complete run aside before a sink overwrites it,
+    returns the new path of the old output or None when there is none. The output is only moved once a run
+    completed (drop_previous): a .previous still there belongs to a run that did not, it stays the last complete
+    output and the partial one is overwritten. rotate=False never moves anything (a resumed run).
+    """
+    path = output_path(csv_name, output_format)
+    previous_path = path + '.previous'
+    if os.path.exists(previous_path):
+        return previous_path
+    if not rotate or not os.path.exists(path):
+        return None
+    os.replace(path, previous_path)
+    return previous_path
+
+
+def drop_previous(csv_name, output_format='csv'):
+    """
+    This function responsible for removing the output moved aside by keep_previous, once the run wrote a complete
+    output from it.
+    """
+    previous_path = output_path(csv_name, output_format) + '.previous'
+    if os.path.isdir(previous_path):
+        shutil.rmtree(previous_path)
+    elif os.path.exists(previous_path):
+        os.remove(previous_path)
+
+
+def iter_rows(path, output_format='csv'):
+    """
+    This function responsible for reading back the rows of an output one at a time.
+    """
+    if output_format == 'listing':
+        from listing import iter_listings
+        yield from iter_listings(path)
+    elif output_format == 'parquet':
+        import pyarrow.parquet
+        for part_path in sorted(glob.glob(os.path.join(path, 'part-*.parquet'))):
+            for batch in pyarrow.parquet.ParquetFile(part_path).iter_batches():
+                for row in batch.to_pylist():
+                    yield {key: value for key, value in row.items() if value is not None}
+    else:
+        with open(path, newline='', encoding='utf-8') as source:
+            for row in csv.DictReader(source):
+                yield {key: value for key, value in row.items() if value != ""}
@@ -0,0 +1,33 @@
+import os
+import re
+import time
+
+# what the cards of a listing page show, a snapshot row has nothing else
+CARD_COLUMNS = ['statut', 'link', 'title', 'prix', 'surface', 'address']
+# "120 m²", "1 200 m2", "2500m²" (grouped thousands or a bare number, like clean.py), not the "3" of an "S+3"
+SURFACE_RE = re.compile(r'(?<![\d+])(?:\d{1,3}(?:[ .]\d{3})+|\d+)(?:[.,]\d{1,2})?\s*m(?:²|2)', re.IGNORECASE)
+
+
+def card_surface(text):
+    """The surface written on a card ("120 m²"), "" when it shows none."""
+    match = SURFACE_RE.search(" ".join((text or '').split()))
+    return match.group() if match else ""
+
+
+def snapshot_output(csv_name):
+    """Output of the snapshot of a section: properstar_location.csv -> properstar_location_snapshot.csv"""
+    stem, extension = os.path.splitext(csv_name)
+    return stem + '_snapshot' + (extension or '.csv')
+
+
+def snapshot_time():
+    """Time of a snapshot, every row of one run gets the same one."""
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def snapshot_row(snapshot_at, card):
+    """The row of the snapshot table for one card, its fields as the page writes them (clean.py types them)."""
+    row = {'snapshot_at': snapshot_at}
+    for column in CARD_COLUMNS:
+        row[column] = card.get(column) or ""
+    return row
@@ -0,0 +1,179 @@
+import hmac
+import json
+import socket
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from browser import LazyDriver
+
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+
+def serve_queue(frontier, host='127.0.0.1', port=8765, token=None):
+    """
+    This function responsible for exposing the lease/done/failed methods of a frontier over http,
+    so workers on other machines can pull links from the coordinator. Returns the running server.
+    Only this host can reach it by default, serving other hosts needs a token the workers send with every request.
+    """
+    if host not in LOOPBACK_HOSTS and not token:
+        raise ValueError("serving the queue on %s needs a token shared with the workers" % host)
+
+    class QueueHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if token and not hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + token):
+                self.send_error(401)
+                return
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path == '/lease':
+                response = frontier.lease(request['worker'], request['sections'], request['ttl'])
+            elif self.path == '/done':
+                frontier.mark_done(request['section'], request['property_details'])
+                response = True
+            elif self.path == '/failed':
+                frontier.mark_failed(request['section'], request['link'], request['error'])
+                response = True
+            else:
+                self.send_error(404)
+                return
+            body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), QueueHandler)
+    threading.Thread(target=server.serve_forever, name="queue", daemon=True).start()
+    print("work queue listening on ", host, ":", port)
+    return server
+
+
+class RemoteQueue:
+    """
+    Client side of serve_queue, with the same lease/mark_done/mark_failed methods as a Frontier.
+    """
+    def __init__(self, url, token=None, timeout=60):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def call(self, path, request):
+        data = json.dumps(request, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        http_request = urllib.request.Request(self.url + path, data=data, headers=headers)
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def lease(self, worker, sections, ttl=300):
+        return self.call('/lease', {'worker': worker, 'sections': list(sections), 'ttl': ttl})
+
+    def mark_done(self, section, property_details_dic):
+        self.call('/done', {'section': section, 'property_details': property_details_dic})
+
+    def mark_failed(self, section, link, error):
+        self.call('/failed', {'section': section, 'link': link, 'error': error})
+
+
+def open_queue(location, max_attempts=1, token=None):
+    """
+    This function responsible for opening the queue of a worker: http://coordinator:port (token is the one
+    the coordinator was given) or the path of a frontier file.
+    """
+    if location.startswith('http://') or location.startswith('https://'):
+        return RemoteQueue(location, token)
+    from frontier import Frontier
+    return Frontier(location, max_attempts)
+
+
+def report(worker, link, call, *args, retries=3, poll=5):
+    """
+    Tells the queue how a link went, retrying while the coordinator is unreachable. When it stays unreachable the
+    result is dropped: the lease expires and the link is handed out again, a crashed worker is worse.
+    """
+    for attempt in range(retries + 1):
+        try:
+            call(*args)
+            return True
+        except (OSError, socket.timeout) as error:
+            print(worker, ": could not report ", link, " (", error, ")",
+                  ", retrying" if attempt < retries else ", its lease will expire")
+            if attempt < retries:
+                time.sleep(poll)
+    return False
+
+
+def run_worker(queue, scrape_states, new_driver, worker, ttl=300, idle_exit=300, poll=5, stop=None):
+    """
+    This function responsible for pulling links from the queue and scraping them until the queue stays empty
+    for idle_exit seconds, or until it is empty once stop (a threading.Event) is set when one is given.
+    scrape_states maps every section the worker serves to its scrape_state(driver, dic).
+    A worker that dies keeps its links leased until ttl expires, then they are handed to another worker.
+    """
+    driver = LazyDriver(new_driver)
+    idle_since = time.time()
+    scraped = 0
+    try:
+        while True:
+            try:
+                task = queue.lease(worker, list(scrape_states), ttl)
+            except (OSError, socket.timeout) as error:
+                # coordinator restarting or gone
+                print(worker, ": queue unreachable (", error, ")")
+                task = None
+            if task is None:
+                if stop is not None:
+                    # the sections are still being discovered until stop is set
+                    if stop.is_set():
+                        break
+                elif time.time() - idle_since > idle_exit:
+                    break
+                time.sleep(poll)
+                continue
+            idle_since = time.time()
+            property_details_dic = {'statut': task['statut'], 'link': task['link']}
+            print(worker, " scraping ", task['link'])
+            try:
+                property_details_dic = scrape_states[task['section']](driver, property_details_dic)
+            except Exception as error:
+                print(worker, " failed to scrape ", task['link'], ": ", repr(error))
+                report(worker, task['link'], queue.mark_failed, task['section'], task['link'], repr(error), poll=poll)
+                continue
+            if report(worker, task['link'], queue.mark_done, task['section'], property_details_dic, poll=poll):
+                scraped = scraped + 1
+    finally:
+        driver.quit()
+    print(worker, " stopping after ", scraped, " states")
+    return scraped
+
+
+def start_workers(queue, scrape_states, new_driver, workers, ttl=300, idle_exit=300, poll=5, stop=None):
+    """
+    This function responsible for running `workers` run_worker threads of this process, each with its own browser.
+    """
+    threads = []
+    for index in range(workers):
+        worker = "%s-%d" % (socket.gethostname(), index + 1)
+        thread = threading.Thread(target=run_worker, name=worker,
+                                  args=(queue, scrape_states, new_driver, worker, ttl, idle_exit, poll, stop))
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def wait_for_sections(frontier, sections, poll=10):
+    """
+    This function responsible for blocking the coordinator until every link of the sections is scraped
+    (or failed too many times). Expired leases are handed out again by Frontier.lease.
+    """
+    while True:
+        remaining = frontier.remaining(sections)
+        if remaining == 0:
+            return
+        print("waiting for the workers, states left: ", remaining)
+        time.sleep(poll)
@@ -0,0 +1,44 @@
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from browser import LazyDriver
+
+
+def scrape_in_pool(property_details_lst, scrape_state, new_driver, workers, window=None):
+    """
+    This function responsible for sharing property_details_lst between `workers` browsers.
+    Every worker thread gets its own driver, started with new_driver() the first time it is used,
+    and fills the dictionaries with scrape_state(driver, property_details_dic).
+    The results are yielded in the original order, each one as soon as it and the ones before it are done.
+    At most `window` states (2 per worker by default) are taken from property_details_lst ahead of the
+    results, so a streamed discovery is scraped while it still runs.
+    """
+    window = window or 2 * workers
+    local = threading.local()
+    drivers = []
+    drivers_lock = threading.Lock()
+
+    def scrape(indexed_dic):
+        index, property_details_dic = indexed_dic
+        if getattr(local, "driver", None) is None:
+            local.driver = LazyDriver(new_driver)
+            with drivers_lock:
+                drivers.append(local.driver)
+        print("Sraping state number ", index + 1, " on worker ", threading.current_thread().name)
+        return scrape_state(local.driver, property_details_dic)
+
+    futures = collections.deque()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="browser") as executor:
+            # the results are yielded in submission order, whatever worker finished first
+            for indexed_dic in enumerate(property_details_lst):
+                futures.append(executor.submit(scrape, indexed_dic))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        for driver in drivers:
+            driver.quit()